@@ -1,37 +1,124 @@
 import os
-import subprocess
-from flask import Flask, jsonify, request
+import sys
+import time
+import ipaddress
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-from neo4j import GraphDatabase
-from pymongo import MongoClient
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# The scanners live in sibling folders and run in-process inside scan jobs.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "subnet_discovery"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "port_scanner"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "common"))
+
+from arnav_port_scanner import PortScanner
+from himanshu_subnet_discovery import SubnetDiscovery
+from icmp_sweep import IcmpSweeper
+from liveness import host_count
+from metrics import API_SECONDS, CONTENT_TYPE, phase, profiling, render
+from scan_jobs import CANCELLED, COMPLETED, FAILED, ScanCancelled, ScanJobManager
+from scan_history import ScanHistory
+from storage import get_neo4j_driver, get_ports_collection
+from subnet_stats import DEFAULT_TOP_N, MAX_TOP_N, SubnetStats
+from topology import TopologyCache, TopologyQuery, make_etag, stream_topology
+from topology_layout import (BINARY_MIMETYPE, LayoutCache, LayoutQuery, TopologyLayout, make_layout_etag,
+                             render_layout)
+from topology_version import get_topology_version
+
 app = Flask(__name__)
 CORS(app)
 
 # --- Database Connection Setup ---
+# The driver and Mongo client are process-wide singletons shared with the scan jobs.
 try:
-    NEO4J_URI = os.getenv("NEO4J_URI")
-    NEO4J_USER = os.getenv("NEO4J_USER")
-    NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
-    MONGO_URI = os.getenv("MONGO_URI")
-
-    if not all([NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD, MONGO_URI]):
-        raise ValueError("Database environment variables are not fully set.")
-
-    neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client.get_default_database() # Use default DB from URI
+    neo4j_driver = get_neo4j_driver()
+    ports_collection = get_ports_collection()
+    subnet_stats = SubnetStats(ports_collection=ports_collection)
+    scan_history = ScanHistory()
 except Exception as e:
     print(f"FATAL: Could not connect to databases. Please check .env file. Error: {e}")
     neo4j_driver = None
-    db = None
+    ports_collection = None
+    subnet_stats = None
+    scan_history = None
+
+# Packets-per-second ceiling for port scans; unset means only the adaptive window limits them.
+SCAN_MAX_RATE = int(os.getenv("SCAN_MAX_RATE", "0")) or None
+# Banner grabs and protocol probes on every open port found.
+SCAN_FINGERPRINT = os.getenv("SCAN_FINGERPRINT", "").lower() in ("1", "true", "yes")
+
+def run_scan_job(job):
+    # The job id doubles as the history run id.
+    subnet = str(job.network.network_address)
+    scan_history.start_run([subnet], job.incremental, run_id=job.id)
+
+    # The run is closed however the job ends, so failed and cancelled scans
+    # don't stay open in the history.
+    run = {"status": FAILED}
+    try:
+        with profiling(job.profile):
+            job.set_phase("subnet_discovery")
+            job.reset_progress(host_count(job.network))
+            discovery = SubnetDiscovery(history=scan_history)
+            # The sweep reports progress and can be cancelled per probe.
+            sweeper = IcmpSweeper(on_probe=job.record_sweep_probe, on_reply=job.record_reply)
+            with phase("subnet_discovery"):
+                liveness = discovery.discover_and_store_subnet(job.ip_range, incremental=job.incremental,
+                                                               sweeper=sweeper, run_id=job.id,
+                                                               checkpoint=job.check_cancelled)
+            run["hosts_up"] = len(liveness)
+
+            # Only hosts that answered the sweep are port-scanned.
+            job.set_phase("port_scan")
+            job.reset_progress()
+            ips = [str(ip) for ip in liveness]
+            scanner = PortScanner(max_rate=SCAN_MAX_RATE, fingerprint=SCAN_FINGERPRINT, history=scan_history)
+            with phase("port_scan"):
+                scanner.run_scan(ips=ips, on_result=job.record_probe, on_plan=job.expect,
+                                 incremental=job.incremental, subnet=subnet, run_id=job.id)
+        run["status"] = COMPLETED
+    except ScanCancelled:
+        run["status"] = CANCELLED
+        raise
+    finally:
+        scan_history.finish_run(job.id, **run)
+    # Lay out the new version now rather than on the first viewer's request.
+    # The scan itself has succeeded; a failure here only means the first
+    # viewer builds the layout instead.
+    try:
+        with neo4j_driver.session() as session:
+            layout_cache.get(get_topology_version(session), load_layout)
+    except Exception as e:
+        print(f"Scan job {job.id}: could not precompute the topology layout: {e}")
+    if job.profile is not None:
+        print(f"Scan job {job.id} profile:\n{job.profile.format()}")
+
+scan_jobs = ScanJobManager(run_scan_job, max_workers=int(os.getenv("SCAN_WORKERS", "2")))
+
+@app.before_request
+def start_timer():
+    request.started_at = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    # Labelled by route pattern, not path, so per-job and per-host URLs share a series.
+    started = getattr(request, "started_at", None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        API_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method,
+                            status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render(), content_type=CONTENT_TYPE)
 
 @app.route('/api/scan-ip-range', methods=['POST'])
 def scan_ip_range():
-    if not neo4j_driver or not db:
+    if not neo4j_driver or ports_collection is None:
         return jsonify({"error": "Backend database connections are not configured."}), 500
 
     data = request.get_json()
@@ -41,74 +128,200 @@ def scan_ip_range():
         return jsonify({"error": "ip_range is a required field."}), 400
 
     try:
-        # --- Run Subnet Discovery Script ---
-        # The `check=True` flag will raise an error if the script fails
-        subnet_process = subprocess.run(
-            ["python", "../subnet_discovery/himanshu_subnet_discovery.py", ip_range],
-            capture_output=True, text=True, check=True
-        )
-        print("Subnet Discovery Output:", subnet_process.stdout)
-
-        # --- Run Port Scanner Script ---
-        port_scan_process = subprocess.run(
-            ["python", "../port_scanner/arnav_port_scanner.py"],
-            capture_output=True, text=True, check=True
-        )
-        print("Port Scanner Output:", port_scan_process.stdout)
-
-    except subprocess.CalledProcessError as e:
-        # This catches errors if the scripts fail to run
-        print(f"A subprocess failed: {e}")
-        print(f"Stderr: {e.stderr}")
-        return jsonify({"error": "A backend script failed during execution.", "details": e.stderr}), 500
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return jsonify({"error": "An unexpected error occurred during the scan."}), 500
+        network = ipaddress.ip_network(ip_range, strict=False)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid ip_range: {e}"}), 400
+
+    job, created = scan_jobs.submit(ip_range, incremental=bool(data.get('incremental')),
+                                    profile=bool(data.get('profile')))
+    if not created and not network.subnet_of(job.network):
+        return jsonify({"error": "An overlapping scan is already in progress.", "job": job.to_dict()}), 409
+
+    return jsonify({"job_id": job.id, "deduplicated": not created, "job": job.to_dict()}), 202
+
+@app.route('/api/scans/<job_id>', methods=['GET'])
+def get_scan(job_id):
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Scan job not found."}), 404
+    return jsonify(job.to_dict())
 
-    return jsonify({"message": "Scan completed successfully"})
+@app.route('/api/scans/<job_id>', methods=['DELETE'])
+def cancel_scan(job_id):
+    job = scan_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Scan job not found."}), 404
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/scans/<job_id>/events', methods=['GET'])
+def stream_scan(job_id):
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Scan job not found."}), 404
+    return Response(scan_jobs.event_stream(job), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+topology_cache = TopologyCache()
 
 @app.route('/api/topology-data', methods=['GET'])
 def get_topology_data():
-    if not neo4j_driver or not db:
+    if not neo4j_driver or ports_collection is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+
+    try:
+        query = TopologyQuery.from_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Scan writes bump the version, so an unchanged version means an unchanged body.
+    with neo4j_driver.session() as session:
+        version = get_topology_version(session)
+    etag = make_etag(version, query)
+    mimetype = 'application/x-ndjson' if query.format == 'ndjson' else 'application/json'
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = topology_cache.get(version, query)
+        if body is None:
+            body = stream_topology(neo4j_driver, ports_collection, query, version, cache=topology_cache)
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Topology-Version'] = str(version)
+    return response
+
+layout_cache = LayoutCache()
+
+def load_layout(version):
+    stats = subnet_stats.collection if subnet_stats is not None else None
+    return TopologyLayout.load(neo4j_driver, ports_collection, version, stats)
+
+@app.route('/api/topology-layout', methods=['GET'])
+def get_topology_layout():
+    # Precomputed positions for large graphs. view=subnets collapses every
+    # subnet to one node with counts; view=hosts with subnet=... expands
+    # those subnets; view=open keeps only hosts with open ports.
+    if not neo4j_driver or ports_collection is None:
         return jsonify({"error": "Backend database connections are not configured."}), 500
 
-    nodes = []
-    links = []
-    
-    # Use a set to keep track of added nodes to prevent duplicates
-    added_nodes = set()
+    try:
+        query = LayoutQuery.from_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with neo4j_driver.session() as session:
+        version = get_topology_version(session)
+    etag = make_layout_etag(version, query)
+    mimetype = BINARY_MIMETYPE if query.format == 'binary' else 'application/json'
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = topology_cache.get(version, query)
+        if body is None:
+            body = render_layout(layout_cache.get(version, load_layout), query)
+            topology_cache.put(version, query, body)
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Topology-Version'] = str(version)
+    return response
+
+@app.route('/api/topology-summary', methods=['GET'])
+def get_topology_summary():
+    # Reads the per-subnet counters scans maintain, plus an index walk per
+    # subnet for its top hosts: the cost doesn't grow with the number of hosts.
+    if not neo4j_driver or subnet_stats is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+
+    try:
+        top = int(request.args.get('top', DEFAULT_TOP_N))
+    except ValueError:
+        return jsonify({"error": "top must be an integer"}), 400
+    if not 0 <= top <= MAX_TOP_N:
+        return jsonify({"error": f"top must be between 0 and {MAX_TOP_N}"}), 400
+    subnets = sorted(set(request.args.getlist('subnet'))) or None
 
-    # Fetch data from Neo4j
     with neo4j_driver.session() as session:
-        result = session.run("""
-            MATCH (ip:IP)
-            OPTIONAL MATCH (ip)-[:BELONGS_TO]->(subnet:Subnet)
-            RETURN ip.address AS ip_address, subnet.address AS subnet_address
-        """)
-        for record in result:
-            ip = record["ip_address"]
-            subnet = record["subnet_address"]
-            
-            if ip and ip not in added_nodes:
-                nodes.append({"id": ip, "type": "ip"})
-                added_nodes.add(ip)
-                
-            if subnet and subnet not in added_nodes:
-                nodes.append({"id": subnet, "type": "subnet"})
-                added_nodes.add(subnet)
-
-            if ip and subnet:
-                links.append({"source": ip, "target": subnet})
-
-    # Fetch data from MongoDB and enrich the IP nodes
-    ip_node_map = {node['id']: node for node in nodes if node['type'] == 'ip'}
-    for port_info in db.ports.find():
-        ip = port_info.get('ip_address')
-        if ip in ip_node_map:
-            # Add open port info to the existing IP node object
-            ip_node_map[ip]['open_ports'] = [p['port'] for p in port_info.get('open_ports', [])]
-
-    return jsonify({"nodes": nodes, "links": links})
+        version = get_topology_version(session)
+    etag = f"summary-{version}-{top}-{','.join(subnets or [])}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        summary = subnet_stats.summary(subnets, top)
+        summary["version"] = version
+        response = jsonify(summary)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Topology-Version'] = str(version)
+    return response
+
+def _epoch_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a Unix timestamp")
+
+@app.route('/api/history/runs', methods=['GET'])
+def list_history_runs():
+    if scan_history is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not 1 <= limit <= 1000:
+        return jsonify({"error": "limit must be between 1 and 1000"}), 400
+    subnet = request.args.get('subnet')
+    if subnet:
+        try:
+            subnet = str(ipaddress.ip_network(subnet, strict=False).network_address)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid subnet: {e}"}), 400
+    return jsonify({"runs": scan_history.list_runs(subnet, limit)})
+
+@app.route('/api/history/runs/<run_id>', methods=['GET'])
+def get_history_run(run_id):
+    if scan_history is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+    run = scan_history.get_run(run_id)
+    if run is None:
+        return jsonify({"error": "Scan run not found."}), 404
+    return jsonify(run)
+
+@app.route('/api/history/hosts/<ip>', methods=['GET'])
+def get_host_timeline(ip):
+    # e.g. ?port=3389 answers "when did 3389 open on this host?"
+    if scan_history is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+    try:
+        ipaddress.ip_address(ip)
+        since, until = _epoch_arg('since'), _epoch_arg('until')
+        port = request.args.get('port')
+        if port is not None:
+            try:
+                port = int(port)
+            except ValueError:
+                raise ValueError("port must be an integer")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"ip_address": ip, "events": scan_history.timeline(ip, since, until, port)})
+
+@app.route('/api/history/diff', methods=['GET'])
+def get_history_diff():
+    if scan_history is None:
+        return jsonify({"error": "Backend database connections are not configured."}), 500
+    from_run, to_run = request.args.get('from'), request.args.get('to')
+    if not from_run or not to_run:
+        return jsonify({"error": "from and to are required run ids."}), 400
+    diff = scan_history.diff(from_run, to_run)
+    if diff is None:
+        return jsonify({"error": "Scan run not found."}), 404
+    return jsonify(diff)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
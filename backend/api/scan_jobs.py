@@ -0,0 +1,236 @@
+import ipaddress
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from metrics import SCAN_JOBS, ScanProfile
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+MAX_FINISHED_JOBS = 100
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+class ScanJob:
+    def __init__(self, ip_range, incremental=False, profile=False):
+        self.id = uuid.uuid4().hex
+        self.ip_range = ip_range
+        self.incremental = incremental
+        # Per-phase timings, collected only when asked for.
+        self.profile = ScanProfile() if profile else None
+        self.network = ipaddress.ip_network(ip_range, strict=False)
+        self.status = QUEUED
+        self.phase = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {"hosts_total": 0, "hosts_probed": 0, "hosts_up": 0, "ports_found": 0}
+        self.future = None
+        # Bumped on every change so event streams know when to emit.
+        self.version = 0
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+        self._remaining = {}
+        self._seen_up = set()
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATES
+
+    def _touch(self):
+        self.version += 1
+        self._changed.notify_all()
+
+    def set_status(self, status, error=None):
+        with self._changed:
+            self.status = status
+            self.error = error
+            if status == RUNNING:
+                self.started_at = time.time()
+            elif status not in ACTIVE_STATES:
+                self.finished_at = time.time()
+            self._touch()
+
+    def set_phase(self, phase):
+        self.check_cancelled()
+        with self._changed:
+            self.phase = phase
+            self._touch()
+
+    def reset_progress(self, hosts_total=0):
+        # Each phase reports its own progress: the sweep counts the range's
+        # addresses, the port scan only the hosts that answered it.
+        with self._changed:
+            self.progress = {"hosts_total": hosts_total, "hosts_probed": 0, "hosts_up": 0, "ports_found": 0}
+            self._remaining = {}
+            self._seen_up = set()
+            self._touch()
+
+    def record_sweep_probe(self, ip, attempt):
+        # Called by the sweeper for every address it is about to probe; retries
+        # (attempt > 0) don't count again. Also the sweep's cancellation point.
+        self.check_cancelled()
+        if attempt == 0:
+            with self._changed:
+                self.progress["hosts_probed"] += 1
+                self._touch()
+
+    def record_reply(self, ip, rtt):
+        self.check_cancelled()
+        with self._changed:
+            self.progress["hosts_up"] += 1
+            self._touch()
+
+    def expect(self, plan):
+        # plan maps ip -> ports about to be probed; may be called again for a
+        # follow-up pass over hosts that were already counted.
+        with self._changed:
+            for ip, ports in plan.items():
+                left = self._remaining.get(ip)
+                if left is None:
+                    self.progress["hosts_total"] += 1
+                elif left == 0:
+                    self.progress["hosts_probed"] -= 1
+                self._remaining[ip] = (left or 0) + len(ports)
+            self._touch()
+
+    def record_probe(self, ip, port, state):
+        # Called from the scan engine for every probe; also the cancellation point.
+        self.check_cancelled()
+        with self._changed:
+            if state != "filtered" and ip not in self._seen_up:
+                # An open port or a RST both mean something answered.
+                self._seen_up.add(ip)
+                self.progress["hosts_up"] += 1
+            if state == "open":
+                self.progress["ports_found"] += 1
+            left = self._remaining.get(ip)
+            if left is not None:
+                self._remaining[ip] = left - 1
+                if left == 1:
+                    self.progress["hosts_probed"] += 1
+            self._touch()
+
+    def cancel(self):
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.set_status(CANCELLED)
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise ScanCancelled()
+
+    def wait_for_change(self, version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def to_dict(self):
+        with self._changed:
+            data = {
+                "id": self.id,
+                "ip_range": self.ip_range,
+                "incremental": self.incremental,
+                "status": self.status,
+                "phase": self.phase,
+                "error": self.error,
+                "progress": dict(self.progress),
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+        if self.profile is not None:
+            data["profile"] = self.profile.report()
+        return data
+
+
+class ScanJobManager:
+    def __init__(self, runner, max_workers=2):
+        self.runner = runner
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan-job")
+        self.jobs = {}
+        self._lock = threading.Lock()
+        SCAN_JOBS.set_function(self._count_by_status)
+
+    def _count_by_status(self):
+        counts = {(status,): 0 for status in (QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED)}
+        for job in list(self.jobs.values()):
+            counts[(job.status,)] += 1
+        return counts
+
+    def _find_overlap(self, network):
+        for job in self.jobs.values():
+            if job.active and job.network.version == network.version and job.network.overlaps(network):
+                return job
+        return None
+
+    def submit(self, ip_range, incremental=False, profile=False):
+        # Returns (job, created). An active job whose range already covers the
+        # request is reused; a partially overlapping one is reported back as a
+        # conflict (created is False and the job does not cover the range).
+        network = ipaddress.ip_network(ip_range, strict=False)
+        with self._lock:
+            existing = self._find_overlap(network)
+            if existing is not None:
+                return existing, False
+            job = ScanJob(ip_range, incremental, profile)
+            self.jobs[job.id] = job
+            self._prune()
+            job.future = self.executor.submit(self._run, job)
+            return job, True
+
+    def _run(self, job):
+        if job._cancel.is_set():
+            job.set_status(CANCELLED)
+            return
+        job.set_status(RUNNING)
+        try:
+            self.runner(job)
+        except ScanCancelled:
+            job.set_status(CANCELLED)
+        except Exception as e:
+            print(f"Scan job {job.id} failed: {e}")
+            job.set_status(FAILED, error=str(e))
+        else:
+            job.set_status(COMPLETED)
+
+    def _prune(self):
+        finished = sorted((job for job in self.jobs.values() if not job.active),
+                          key=lambda job: job.finished_at or job.created_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and job.active:
+            job.cancel()
+        return job
+
+    def event_stream(self, job, heartbeat=15.0, min_interval=0.25):
+        # Server-Sent Events: one `data:` frame per progress change, coalesced
+        # to at most one every `min_interval` seconds.
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                yield f"data: {json.dumps(job.to_dict())}\n\n"
+                if not job.active:
+                    return
+                time.sleep(min_interval)
+                continue
+            if job.wait_for_change(version, heartbeat) == version:
+                yield ": keep-alive\n\n"
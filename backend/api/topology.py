@@ -0,0 +1,262 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+STATUSES = ("used", "available")
+FORMATS = ("json", "ndjson")
+MAX_PAGE_SIZE = 10000
+# IPs are enriched from Mongo one chunk at a time so neither side is buffered whole.
+ENRICH_CHUNK_SIZE = 1000
+WRITE_SIZE = 64 * 1024
+
+
+class TopologyQuery:
+    def __init__(self, subnets=None, status=None, cursor=None, limit=None, fmt="json"):
+        self.subnets = sorted(set(subnets)) if subnets else None
+        self.status = status
+        self.cursor = cursor
+        self.limit = limit
+        self.format = fmt
+
+    @classmethod
+    def from_args(cls, args):
+        # Raises ValueError with a user-facing message on bad input.
+        status = args.get("status")
+        if status is not None and status not in STATUSES:
+            raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+        fmt = args.get("format", "json")
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        limit = args.get("limit")
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ValueError("limit must be an integer")
+            if not 1 <= limit <= MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        return cls(args.getlist("subnet"), status, args.get("cursor"), limit, fmt)
+
+    def key(self):
+        return json.dumps([self.subnets, self.status, self.cursor, self.limit, self.format])
+
+    def cypher(self):
+        if self.status == "available":
+            return self._range_cypher()
+        filters = []
+        if self.cursor is not None:
+            filters.append("ip.address > $cursor")
+        if self.status is not None:
+            filters.append("ip.status = $status")
+        where = " AND ".join(filters)
+        limit = "LIMIT $limit" if self.limit else ""
+        if self.subnets:
+            return f"""
+                MATCH (subnet:Subnet)
+                WHERE subnet.address IN $subnets OR subnet.cidr IN $subnets
+                MATCH (ip:IP)-[:BELONGS_TO]->(subnet)
+                {"WHERE " + where if where else ""}
+                WITH ip, collect(DISTINCT coalesce(subnet.address, subnet.cidr)) AS subnets
+                ORDER BY ip.address
+                {limit}
+                RETURN ip.address AS ip_address, subnets
+            """
+        # Page over the IP.address index first, then attach subnets to that page only.
+        return f"""
+            MATCH (ip:IP)
+            {"WHERE " + where if where else ""}
+            WITH ip ORDER BY ip.address
+            {limit}
+            OPTIONAL MATCH (ip)-[:BELONGS_TO]->(subnet:Subnet)
+            WITH ip, collect(DISTINCT coalesce(subnet.address, subnet.cidr)) AS subnets
+            RETURN ip.address AS ip_address, subnets
+            ORDER BY ip_address
+        """
+
+    def _range_cypher(self):
+        # Free space is stored as AddressRange nodes, not one IP per free address.
+        where = "WHERE r.start > $cursor" if self.cursor is not None else ""
+        limit = "LIMIT $limit" if self.limit else ""
+        if self.subnets:
+            return f"""
+                MATCH (subnet:Subnet)
+                WHERE subnet.address IN $subnets OR subnet.cidr IN $subnets
+                MATCH (r:AddressRange)-[:BELONGS_TO]->(subnet)
+                {where}
+                RETURN r.start AS start, r.end AS end, r.size AS size,
+                       coalesce(subnet.address, subnet.cidr) AS subnet
+                ORDER BY start
+                {limit}
+            """
+        return f"""
+            MATCH (r:AddressRange)
+            {where}
+            WITH r ORDER BY r.start
+            {limit}
+            MATCH (r)-[:BELONGS_TO]->(subnet:Subnet)
+            RETURN r.start AS start, r.end AS end, r.size AS size,
+                   coalesce(subnet.address, subnet.cidr) AS subnet
+            ORDER BY start
+        """
+
+    def params(self):
+        return {"subnets": self.subnets, "status": self.status,
+                "cursor": self.cursor, "limit": self.limit}
+
+
+def make_etag(version, query):
+    digest = hashlib.sha1(query.key().encode()).hexdigest()[:16]
+    return f"{version}-{digest}"
+
+
+class TopologyCache:
+    # LRU of fully rendered response bodies, keyed on (topology version, query).
+    def __init__(self, max_entries=32, max_body_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version, query):
+        with self._lock:
+            key = (version, query.key())
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, version, query, body):
+        if len(body) > self.max_body_bytes:
+            return
+        with self._lock:
+            # Anything cached for an older version can never be served again.
+            for key in [key for key in self._entries if key[0] != version]:
+                del self._entries[key]
+            self._entries[(version, query.key())] = body
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _range_items(session, query):
+    # Same shape as _topology_items, with a "range" node per free address range.
+    seen_subnets = set()
+    last_start = None
+    count = 0
+    for record in session.run(query.cypher(), **query.params()):
+        start, end, subnet = record["start"], record["end"], record["subnet"]
+        node_id = f"{start}-{end}"
+        yield "node", {"id": node_id, "type": "range", "start": start, "end": end, "size": record["size"]}
+        if subnet not in seen_subnets:
+            seen_subnets.add(subnet)
+            yield "node", {"id": subnet, "type": "subnet"}
+        yield "link", {"source": node_id, "target": subnet}
+        last_start = start
+        count += 1
+
+    more = query.limit is not None and count == query.limit
+    yield "meta", {"next_cursor": last_start if more else None}
+
+
+def _topology_items(session, ports_collection, query):
+    # Yields ("node" | "link", dict) pairs, then ("meta", dict) once at the end.
+    if query.status == "available":
+        yield from _range_items(session, query)
+        return
+    seen_subnets = set()
+    last_ip = None
+    count = 0
+    result = session.run(query.cypher(), **query.params())
+    for chunk in _chunks(result, ENRICH_CHUNK_SIZE):
+        ips = [record["ip_address"] for record in chunk]
+        open_ports = {}
+        for doc in ports_collection.find({"ip_address": {"$in": ips}}, {"ip_address": 1, "open_ports.port": 1}):
+            open_ports[doc["ip_address"]] = [p["port"] for p in doc.get("open_ports", [])]
+
+        for record in chunk:
+            ip = record["ip_address"]
+            node = {"id": ip, "type": "ip"}
+            if ip in open_ports:
+                node["open_ports"] = open_ports[ip]
+            yield "node", node
+            for subnet in record["subnets"]:
+                if subnet not in seen_subnets:
+                    seen_subnets.add(subnet)
+                    yield "node", {"id": subnet, "type": "subnet"}
+                yield "link", {"source": ip, "target": subnet}
+            last_ip = ip
+            count += 1
+
+    more = query.limit is not None and count == query.limit
+    yield "meta", {"next_cursor": last_ip if more else None}
+
+
+def render_ndjson(items, version):
+    for kind, item in items:
+        if kind == "meta":
+            item = dict(item, version=version)
+        yield json.dumps(dict(item, kind=kind)) + "\n"
+
+
+def render_json(items, version):
+    # Same {"nodes": [...], "links": [...]} body as before, written incrementally.
+    # Links are small (ip, subnet) pairs and are held back until the nodes are done.
+    links = []
+    first = True
+    yield '{"nodes": ['
+    for kind, item in items:
+        if kind == "node":
+            yield ("" if first else ", ") + json.dumps(item)
+            first = False
+        elif kind == "link":
+            links.append((item["source"], item["target"]))
+        else:
+            meta = item
+    yield '], "links": ['
+    for i, (source, target) in enumerate(links):
+        yield ("" if i == 0 else ", ") + json.dumps({"source": source, "target": target})
+    yield f'], "next_cursor": {json.dumps(meta["next_cursor"])}, "version": {version}}}'
+
+
+def _coalesce(pieces, size):
+    # Hand the WSGI server ~64KB writes instead of one write per node.
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield "".join(buffer).encode()
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def stream_topology(neo4j_driver, ports_collection, query, version, cache=None):
+    render = render_ndjson if query.format == "ndjson" else render_json
+    # Keep a copy for the cache only while the body stays under the cache's size cap.
+    body = [] if cache is not None else None
+    size = 0
+    with neo4j_driver.session() as session:
+        for data in _coalesce(render(_topology_items(session, ports_collection, query), version), WRITE_SIZE):
+            if body is not None:
+                size += len(data)
+                if size <= cache.max_body_bytes:
+                    body.append(data)
+                else:
+                    body = None
+            yield data
+    if body is not None:
+        cache.put(version, query, b"".join(body))
@@ -0,0 +1,319 @@
+import hashlib
+import ipaddress
+import json
+import math
+import socket
+import struct
+import sys
+import threading
+from array import array
+
+# Server-side layout for large topologies. Positions are computed once per
+# topology version with a hierarchical subnet -> host layout: each subnet is
+# a disc with its hosts on a sunflower spiral (hosts with open ports nearest
+# the centre), and the discs are shelf-packed in address order. Both steps
+# are O(n), so there is no simulation to run in the browser. Views pick
+# columns out of the cached layout and are encoded column by column, as JSON
+# arrays or as little-endian typed arrays.
+
+VIEWS = ("subnets", "hosts", "open")
+FORMATS = ("json", "binary")
+BINARY_MIMETYPE = "application/octet-stream"
+BINARY_MAGIC = b"TOPO"
+BINARY_FORMAT_VERSION = 1
+TYPE_NAMES = {"f": "float32", "I": "uint32", "H": "uint16", "B": "uint8"}
+
+# Layout units: distance between neighbouring hosts, and the gap around each subnet disc.
+HOST_SPACING = 10.0
+SUBNET_PADDING = 40.0
+GOLDEN_ANGLE = math.pi * (3 - math.sqrt(5))
+
+STATUS_CODES = {None: 0, "used": 1, "available": 2}
+
+LAYOUT_QUERY = """
+    MATCH (subnet:Subnet)
+    OPTIONAL MATCH (ip:IP)-[:BELONGS_TO]->(subnet)
+    RETURN coalesce(subnet.address, subnet.cidr) AS subnet, ip.address AS ip, ip.status AS status
+"""
+
+
+def _address_key(value):
+    try:
+        network = ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return (7, 0, value)
+    return (network.version, int(network.network_address), "")
+
+
+def _host_key(value):
+    # inet_pton is several times faster than ipaddress for sorting every host.
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            return (version, socket.inet_pton(family, value), "")
+        except OSError:
+            continue
+    return (7, b"", value)
+
+
+class LayoutQuery:
+    def __init__(self, view="subnets", subnets=None, fmt="json"):
+        self.view = view
+        self.subnets = sorted(set(subnets)) if subnets else None
+        self.format = fmt
+
+    @classmethod
+    def from_args(cls, args):
+        # Raises ValueError with a user-facing message on bad input.
+        view = args.get("view", "subnets")
+        if view not in VIEWS:
+            raise ValueError(f"view must be one of {', '.join(VIEWS)}")
+        fmt = args.get("format", "json")
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        return cls(view, args.getlist("subnet"), fmt)
+
+    def key(self):
+        return json.dumps(["layout", self.view, self.subnets, self.format])
+
+
+def make_layout_etag(version, query):
+    digest = hashlib.sha1(query.key().encode()).hexdigest()[:16]
+    return f"layout-{version}-{digest}"
+
+
+def spiral(count, spacing=HOST_SPACING):
+    # Sunflower (Vogel) spiral: evenly spread points filling a disc whose
+    # radius grows with sqrt(count).
+    xs, ys = array("f"), array("f")
+    for i in range(count):
+        radius = spacing * math.sqrt(i + 0.5)
+        angle = i * GOLDEN_ANGLE
+        xs.append(radius * math.cos(angle))
+        ys.append(radius * math.sin(angle))
+    return xs, ys
+
+
+def disc_radius(count, spacing=HOST_SPACING):
+    return spacing * math.sqrt(count + 0.5) + spacing
+
+
+def pack_discs(radii, padding=SUBNET_PADDING):
+    # Shelf packing in the given order: rows about as wide as the square
+    # root of the total area, each disc placed right of the previous one.
+    widths = [2 * (radius + padding) for radius in radii]
+    row_width = max([math.sqrt(sum(width * width for width in widths))] + widths) if widths else 0
+    centres = []
+    x = y = row_height = 0.0
+    for radius, width in zip(radii, widths):
+        if x and x + width > row_width:
+            x, y, row_height = 0.0, y + row_height, 0.0
+        centres.append((x + width / 2, y + width / 2))
+        x += width
+        row_height = max(row_height, width)
+    return centres
+
+
+class TopologyLayout:
+    # Column-oriented: subnet i is subnet_ids[i], host j belongs to subnet
+    # host_subnet[j]. Host coordinates are absolute.
+    def __init__(self, version, memberships, open_ports=None, subnet_info=None):
+        # memberships yields (subnet, ip or None, status); an IP attached to
+        # several Subnet nodes is drawn under the first. IPs outside any
+        # Subnet have nowhere to go and are left out.
+        open_ports = open_ports or {}
+        subnet_info = subnet_info or {}
+        members = {}
+        placed = set()
+        for subnet, ip, status in memberships:
+            hosts = members.setdefault(subnet, [])
+            if ip is not None and ip not in placed:
+                placed.add(ip)
+                hosts.append((ip, status))
+
+        self.version = version
+        self.subnet_ids = sorted(members, key=_address_key)
+        self.subnet_cidrs = [subnet_info.get(subnet, {}).get("cidr") for subnet in self.subnet_ids]
+        self.subnet_total = array("I", (subnet_info.get(subnet, {}).get("total_ips", 0) for subnet in self.subnet_ids))
+        self.subnet_hosts = array("I")
+        self.subnet_used = array("I")
+        self.subnet_open = array("I")
+        self.subnet_radius = array("f")
+        self.subnet_x = array("f")
+        self.subnet_y = array("f")
+        # Hosts of subnet i are host_start[i]:host_start[i + 1].
+        self.host_start = array("I", [0])
+        self.host_ids = []
+        self.host_subnet = array("I")
+        self.host_x = array("f")
+        self.host_y = array("f")
+        self.host_open = array("H")
+        self.host_status = array("B")
+
+        ordered = []
+        for subnet in self.subnet_ids:
+            hosts = sorted(members[subnet], key=lambda host: (not open_ports.get(host[0]), _host_key(host[0])))
+            ordered.append(hosts)
+            self.subnet_hosts.append(len(hosts))
+            self.subnet_used.append(sum(1 for _, status in hosts if status != "available"))
+            self.subnet_open.append(sum(1 for ip, _ in hosts if open_ports.get(ip)))
+            self.subnet_radius.append(disc_radius(len(hosts)))
+
+        for index, (hosts, (cx, cy)) in enumerate(zip(ordered, pack_discs(self.subnet_radius))):
+            self.subnet_x.append(cx)
+            self.subnet_y.append(cy)
+            xs, ys = spiral(len(hosts))
+            for (ip, status), x, y in zip(hosts, xs, ys):
+                self.host_ids.append(ip)
+                self.host_subnet.append(index)
+                self.host_x.append(cx + x)
+                self.host_y.append(cy + y)
+                self.host_open.append(min(open_ports.get(ip, 0), 0xFFFF))
+                self.host_status.append(STATUS_CODES.get(status, 0))
+            self.host_start.append(len(self.host_ids))
+
+    @classmethod
+    def load(cls, neo4j_driver, ports_collection, version, stats_collection=None):
+        # Open-port counts come from the open_port_count index, so only hosts
+        # with something open are read from Mongo.
+        open_ports = {doc["ip_address"]: doc["open_port_count"] for doc in ports_collection.find(
+            {"open_port_count": {"$gt": 0}}, {"_id": 0, "ip_address": 1, "open_port_count": 1})}
+        subnet_info = {}
+        if stats_collection is not None:
+            subnet_info = {doc["_id"]: doc for doc in stats_collection.find({}, {"cidr": 1, "total_ips": 1})}
+        with neo4j_driver.session() as session:
+            rows = ((record["subnet"], record["ip"], record["status"]) for record in session.run(LAYOUT_QUERY))
+            return cls(version, rows, open_ports, subnet_info)
+
+    def select(self, query):
+        # Returns (subnet indices, host indices) for the query's view.
+        subnets = range(len(self.subnet_ids))
+        if query.subnets:
+            wanted = set(query.subnets)
+            subnets = [i for i, (subnet, cidr) in enumerate(zip(self.subnet_ids, self.subnet_cidrs))
+                       if subnet in wanted or cidr in wanted]
+        if query.view == "subnets":
+            return list(subnets), []
+        hosts = []
+        for i in subnets:
+            start, end = self.host_start[i], self.host_start[i + 1]
+            if query.view == "open":
+                # Open hosts sort first within their subnet.
+                end = start + self.subnet_open[i]
+            hosts.extend(range(start, end))
+        return list(subnets), hosts
+
+    def bounds(self):
+        if not self.subnet_ids:
+            return [0, 0, 0, 0]
+        return [round(min(x - r for x, r in zip(self.subnet_x, self.subnet_radius)), 1),
+                round(min(y - r for y, r in zip(self.subnet_y, self.subnet_radius)), 1),
+                round(max(x + r for x, r in zip(self.subnet_x, self.subnet_radius)), 1),
+                round(max(y + r for y, r in zip(self.subnet_y, self.subnet_radius)), 1)]
+
+    def columns(self, subnets, hosts):
+        # (name, typecode, values) for every numeric column of a view.
+        return [
+            ("subnets.x", "f", array("f", (self.subnet_x[i] for i in subnets))),
+            ("subnets.y", "f", array("f", (self.subnet_y[i] for i in subnets))),
+            ("subnets.radius", "f", array("f", (self.subnet_radius[i] for i in subnets))),
+            ("subnets.hosts", "I", array("I", (self.subnet_hosts[i] for i in subnets))),
+            ("subnets.used", "I", array("I", (self.subnet_used[i] for i in subnets))),
+            ("subnets.open_hosts", "I", array("I", (self.subnet_open[i] for i in subnets))),
+            ("subnets.total_ips", "I", array("I", (self.subnet_total[i] for i in subnets))),
+            # Host -> subnet links, as indices into this view's subnet columns.
+            ("hosts.subnet", "I", _reindex(self.host_subnet, subnets, hosts)),
+            ("hosts.x", "f", array("f", (self.host_x[j] for j in hosts))),
+            ("hosts.y", "f", array("f", (self.host_y[j] for j in hosts))),
+            ("hosts.open_ports", "H", array("H", (self.host_open[j] for j in hosts))),
+            ("hosts.status", "B", array("B", (self.host_status[j] for j in hosts))),
+        ]
+
+
+def _reindex(host_subnet, subnets, hosts):
+    position = {index: i for i, index in enumerate(subnets)}
+    return array("I", (position[host_subnet[j]] for j in hosts))
+
+
+class LayoutCache:
+    # Holds the layout of the newest topology version seen; a request for
+    # that version never recomputes, and concurrent misses build it once.
+    def __init__(self):
+        self._layout = None
+        self._lock = threading.Lock()
+
+    def get(self, version, loader):
+        layout = self._layout
+        if layout is not None and layout.version == version:
+            return layout
+        with self._lock:
+            if self._layout is None or self._layout.version != version:
+                self._layout = loader(version)
+            return self._layout
+
+
+def _header(layout, query, subnets):
+    return {"version": layout.version, "view": query.view, "bounds": layout.bounds(),
+            "subnet_ids": [layout.subnet_ids[i] for i in subnets],
+            "subnet_cidrs": [layout.subnet_cidrs[i] for i in subnets]}
+
+
+def render_layout_json(layout, query):
+    subnets, hosts = layout.select(query)
+    body = _header(layout, query, subnets)
+    body["host_ids"] = [layout.host_ids[j] for j in hosts]
+    for name, typecode, values in layout.columns(subnets, hosts):
+        body[name] = [round(value, 1) for value in values] if typecode == "f" else values.tolist()
+    return json.dumps(body, separators=(",", ":")).encode()
+
+
+def _pack_addresses(addresses):
+    # IPv4-only views use 4 bytes per host, anything else 16 (IPv4-mapped).
+    parsed = [ipaddress.ip_address(address) for address in addresses]
+    if all(address.version == 4 for address in parsed):
+        return 4, b"".join(address.packed for address in parsed)
+    return 16, b"".join((address.packed if address.version == 6
+                         else ipaddress.IPv6Address(b"\0" * 10 + b"\xff\xff" + address.packed).packed)
+                        for address in parsed)
+
+
+def _align(size, to=8):
+    return -size % to
+
+
+def render_layout_binary(layout, query):
+    # "TOPO", format version (uint32), header length (uint32), JSON header,
+    # then each column as little-endian typed-array bytes. Offsets in the
+    # header count from the first column and are 8-byte aligned, so columns
+    # can be viewed in place (new Float32Array(buffer, dataStart + offset, length)).
+    subnets, hosts = layout.select(query)
+    header = _header(layout, query, subnets)
+    width, packed = _pack_addresses([layout.host_ids[j] for j in hosts])
+    columns = [(name, typecode, values.tobytes() if sys.byteorder == "little" else _swapped(values))
+               for name, typecode, values in layout.columns(subnets, hosts)]
+    columns.append(("hosts.address", "B", packed))
+    header["ip_width"] = width
+    header["columns"] = []
+    offset = 0
+    for name, typecode, data in columns:
+        header["columns"].append({"name": name, "type": TYPE_NAMES[typecode], "offset": offset,
+                                  "length": len(data) // array(typecode).itemsize})
+        offset += len(data) + _align(len(data))
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    encoded += b" " * _align(len(BINARY_MAGIC) + 8 + len(encoded))
+    parts = [BINARY_MAGIC, struct.pack("<II", BINARY_FORMAT_VERSION, len(encoded)), encoded]
+    for _, _, data in columns:
+        parts.append(data)
+        parts.append(b"\0" * _align(len(data)))
+    return b"".join(parts)
+
+
+def _swapped(values):
+    values = array(values.typecode, values)
+    values.byteswap()
+    return values.tobytes()
+
+
+def render_layout(layout, query):
+    if query.format == "binary":
+        return render_layout_binary(layout, query)
+    return render_layout_json(layout, query)
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "subnet_discovery"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "port_scanner"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "common"))
+
+from async_scanner import AsyncPortScanner
+from himanshu_subnet_discovery import SubnetDiscovery
+from icmp_sweep import IcmpSweeper
+from liveness import LivenessSet
+from simulated_network import (DEFAULT_BLACKHOLED_PORTS, DEFAULT_CLOSED_PORTS, DEFAULT_OPEN_PORTS, MemoryCollection,
+                               MemoryDriver, SimulatedNetwork, SimulatedPortScanner, SimulatedSweeper)
+from storage import bulk_upsert_ports, close_all, get_neo4j_driver, get_ports_collection
+from subnet_stats import SubnetStats, get_stats_collection
+
+# A phase whose rate falls more than this far below the baseline fails the run.
+DEFAULT_TOLERANCE = 0.2
+
+
+def peak_rss_mb():
+    # Process-wide high-water mark, so each phase reports the peak up to its end.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def raise_fd_limit(needed):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+    except (ValueError, OSError):
+        pass
+
+
+def timed(phase, unit, work):
+    # work() returns (items processed, extra report fields, value to pass on).
+    started = time.perf_counter()
+    items, extra, value = work()
+    seconds = time.perf_counter() - started
+    report = {"phase": phase, "seconds": round(seconds, 4), "items": items, "unit": f"{unit}/s",
+              "rate": round(items / seconds, 1) if seconds else None, "peak_rss_mb": peak_rss_mb()}
+    report.update(extra)
+    return report, value
+
+
+def bench_discovery(net, simulated, rate, timeout):
+    def work():
+        if simulated:
+            sweeper = SimulatedSweeper(net, rate=rate, timeout=timeout)
+        else:
+            sweeper = IcmpSweeper(rate=rate, timeout=timeout)
+        liveness = sweeper.sweep_network(LivenessSet(net.network))
+        extra = {"live": len(liveness), "mode": sweeper.mode or "fallback"}
+        extra.update(sweeper.rate_control.stats())
+        return liveness.host_count, extra, liveness
+    return timed("discovery", "hosts", work)
+
+
+def bench_port_scan(net, hosts, simulated, concurrency, timeout, retries, max_rate=None):
+    def work():
+        options = {"max_concurrency": concurrency, "timeout": timeout, "retries": retries, "max_rate": max_rate}
+        engine = SimulatedPortScanner(net, **options) if simulated else AsyncPortScanner(**options)
+        results = engine.run(hosts, net.ports)
+        expected = net.expected_open()
+        found = {ip: [p["port"] for p in open_ports] for ip, open_ports in results.items() if open_ports}
+        mismatched = sum(1 for ip in hosts if found.get(ip) != expected.get(ip))
+        extra = {"hosts": len(hosts), "open_ports": sum(map(len, found.values())), "mismatched_hosts": mismatched}
+        extra.update(engine.rate_control.stats())
+        return len(hosts) * len(net.ports), extra, results
+    return timed("port_scan", "ports", work)
+
+
+def bench_neo4j_ingest(liveness, driver, stats):
+    def work():
+        discovery = SubnetDiscovery(driver=driver, stats=stats, ports_collection=stats.ports)
+        discovery.prepare_subnet(liveness.network)
+        discovery.store_liveness(liveness)
+        ranges = sum(1 for _ in liveness.free_ranges())
+        return len(liveness) + ranges, {"ip_rows": len(liveness), "range_rows": ranges}, None
+    return timed("neo4j_ingest", "rows", work)
+
+
+def bench_mongo_ingest(results, collection):
+    def work():
+        found = {ip: open_ports for ip, open_ports in results.items() if open_ports}
+        return bulk_upsert_ports(found, collection), {}, None
+    return timed("mongo_ingest", "rows", work)
+
+
+def run_benchmark(net, simulated=False, concurrency=1000, timeout=0.25, retries=1, rate=5000, real_db=False,
+                  max_rate=None):
+    phases = []
+    if not simulated:
+        raise_fd_limit(net.listener_count() + concurrency + 256)
+        net.start()
+    try:
+        report, liveness = bench_discovery(net, simulated, rate, timeout)
+        phases.append(report)
+        # Like a real scan, only hosts that answered discovery are port-scanned.
+        report, results = bench_port_scan(net, [str(ip) for ip in liveness], simulated, concurrency, timeout, retries,
+                                          max_rate)
+        phases.append(report)
+    finally:
+        net.stop()
+
+    driver = get_neo4j_driver() if real_db else MemoryDriver()
+    collection = get_ports_collection() if real_db else MemoryCollection()
+    stats = SubnetStats(get_stats_collection() if real_db else MemoryCollection(), collection)
+    phases.append(bench_neo4j_ingest(liveness, driver, stats)[0])
+    phases.append(bench_mongo_ingest(results, collection)[0])
+    return phases
+
+
+def compare(phases, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Returns one message per phase that got slower than the baseline allows.
+    previous = {phase["phase"]: phase for phase in baseline.get("phases", [])}
+    regressions = []
+    for phase in phases:
+        before = previous.get(phase["phase"])
+        if not before or not before.get("rate") or phase["rate"] is None:
+            continue
+        if phase["rate"] < before["rate"] * (1 - tolerance):
+            regressions.append(f"{phase['phase']}: {phase['rate']} {phase['unit']} "
+                               f"vs baseline {before['rate']} {before['unit']}")
+    return regressions
+
+
+def print_report(phases):
+    print(f"\n{'phase':<14}{'seconds':>10}{'rate':>16}  {'unit':<9}{'peak RSS':>12}{'window':>9}{'loss':>8}")
+    for phase in phases:
+        rss = f"{phase['peak_rss_mb']} MB" if phase["peak_rss_mb"] is not None else "-"
+        print(f"{phase['phase']:<14}{phase['seconds']:>10}{phase['rate']:>16}  {phase['unit']:<9}{rss:>12}"
+              f"{phase.get('window', ''):>9}{phase.get('loss_rate', ''):>8}")
+
+
+def _ports(spec):
+    return tuple(int(port) for port in spec.split(",") if port) if spec else ()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time discovery, port scanning and DB ingestion "
+                                                 "against a simulated network on loopback.")
+    parser.add_argument("--network", default="127.20.0.0/24", help="loopback range to simulate")
+    parser.add_argument("--listening-ratio", type=float, default=0.25, help="share of hosts with listeners")
+    parser.add_argument("--open-ports", type=_ports, default=DEFAULT_OPEN_PORTS)
+    parser.add_argument("--closed-ports", type=_ports, default=DEFAULT_CLOSED_PORTS)
+    parser.add_argument("--blackholed-ports", type=_ports, default=DEFAULT_BLACKHOLED_PORTS)
+    parser.add_argument("--simulated", action="store_true",
+                        help="answer probes from an in-memory table instead of real sockets")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every answered probe (--simulated only)")
+    parser.add_argument("--loss", type=float, default=0.0, help="share of answers dropped (--simulated only)")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="probes in flight before answers get dropped (--simulated only)")
+    parser.add_argument("--concurrency", type=int, default=1000, help="in-flight window cap")
+    parser.add_argument("--timeout", type=float, default=0.25, help="timeout until RTT samples exist")
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--rate", type=int, default=5000, help="discovery packets per second")
+    parser.add_argument("--max-rate", type=int, default=None, help="port scan packets-per-second ceiling")
+    parser.add_argument("--real-db", action="store_true",
+                        help="ingest into the configured Neo4j/MongoDB instead of in-memory stand-ins")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report as JSON")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    if (args.latency or args.loss or args.capacity) and not args.simulated:
+        print("[!] --latency, --loss and --capacity only apply with --simulated; on loopback use "
+              "`tc qdisc add dev lo root netem delay <ms>ms loss <pct>%` instead.", file=sys.stderr)
+    net = SimulatedNetwork(args.network, args.open_ports, args.closed_ports, args.blackholed_ports,
+                           args.listening_ratio, args.latency, args.seed, args.loss, args.capacity)
+    try:
+        phases = run_benchmark(net, args.simulated, args.concurrency, args.timeout, args.retries, args.rate,
+                               args.real_db, args.max_rate)
+    finally:
+        if args.real_db:
+            close_all()
+    print_report(phases)
+
+    report = {"network": str(net.network), "simulated": args.simulated, "listening_hosts": len(net.listening),
+              "ports": net.ports, "created_at": time.time(), "phases": phases}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    mismatched = next(phase for phase in phases if phase["phase"] == "port_scan")["mismatched_hosts"]
+    if mismatched:
+        print(f"[!] {mismatched} host(s) came back with the wrong open ports.", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(phases, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[!] Regression: {regression}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
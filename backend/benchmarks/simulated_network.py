@@ -0,0 +1,230 @@
+import asyncio
+import random
+import selectors
+import socket
+import threading
+from ipaddress import ip_network
+
+from async_scanner import CLOSED, FILTERED, OPEN, AsyncPortScanner
+from icmp_sweep import IcmpSweeper
+
+DEFAULT_OPEN_PORTS = (2222, 8080, 8443)
+DEFAULT_CLOSED_PORTS = (2121, 2323)
+DEFAULT_BLACKHOLED_PORTS = (9090,)
+
+
+class SimulatedNetwork:
+    # A made-up network on 127.0.0.0/8, which Linux routes to lo in full.
+    # A random share of hosts ("listening" hosts) have the open and
+    # blackholed ports. Every other port, and every port on the remaining
+    # hosts, is closed. latency, loss and capacity only apply to SimulatedPortScanner.
+    def __init__(self, network="127.20.0.0/24", open_ports=DEFAULT_OPEN_PORTS, closed_ports=DEFAULT_CLOSED_PORTS,
+                 blackholed_ports=DEFAULT_BLACKHOLED_PORTS, listening_ratio=0.25, latency=0.0, seed=0, loss=0.0,
+                 capacity=None):
+        self.network = ip_network(network, strict=False)
+        if not self.network.is_loopback:
+            raise ValueError(f"{self.network} is not a loopback network.")
+        self.open_ports = tuple(open_ports)
+        self.closed_ports = tuple(closed_ports)
+        self.blackholed_ports = tuple(blackholed_ports)
+        self.latency = latency
+        self.loss = loss
+        self.capacity = capacity
+        self.rng = random.Random(seed)
+        self.listening = {str(ip) for ip in self.network.hosts() if self.rng.random() < listening_ratio}
+        self._sockets = []
+        self._selector = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def ports(self):
+        return sorted(self.open_ports + self.closed_ports + self.blackholed_ports)
+
+    def state(self, ip, port):
+        if ip in self.listening:
+            if port in self.open_ports:
+                return OPEN
+            if port in self.blackholed_ports:
+                return FILTERED
+        return CLOSED
+
+    def expected_open(self):
+        return {ip: sorted(self.open_ports) for ip in self.listening if self.open_ports}
+
+    def listener_count(self):
+        # File descriptors start() needs: one per open port, two per blackholed one.
+        return len(self.listening) * (len(self.open_ports) + 2 * len(self.blackholed_ports))
+
+    def start(self):
+        self._selector = selectors.DefaultSelector()
+        for ip in sorted(self.listening):
+            for port in self.open_ports:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((ip, port))
+                sock.listen(1024)
+                sock.setblocking(False)
+                self._selector.register(sock, selectors.EVENT_READ)
+                self._sockets.append(sock)
+            for port in self.blackholed_ports:
+                # A listener that never accepts, with its one-slot backlog
+                # already taken: the kernel drops every further SYN, so
+                # connects hang like they would behind a DROP rule.
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((ip, port))
+                sock.listen(0)
+                self._sockets.append(sock)
+                self._sockets.append(socket.create_connection((ip, port), timeout=1.0))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name="simulated-network", daemon=True)
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while not self._stop.is_set():
+            for key, _ in self._selector.select(0.05):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                conn.close()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class SimulatedPortScanner(AsyncPortScanner):
+    # The real engine with connects answered from the network's table instead
+    # of the kernel. Answered probes take `latency` and a `loss` share of them
+    # is dropped at random. Above `capacity` probes in flight, the excess share
+    # is dropped too, like a congested link overflowing its queue.
+    def __init__(self, network, **kwargs):
+        super().__init__(**kwargs)
+        self.network = network
+        self.in_flight = 0
+
+    async def _connect_once(self, ip, port, timeout):
+        net = self.network
+        state = net.state(ip, port)
+        drop = net.loss
+        if net.capacity is not None and self.in_flight > net.capacity:
+            drop = max(drop, 1 - net.capacity / self.in_flight)
+        if state != FILTERED and net.rng.random() < drop:
+            state = FILTERED
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(timeout if state == FILTERED else net.latency)
+        finally:
+            self.in_flight -= 1
+        return state
+
+
+class SimulatedProber:
+    def __init__(self, network):
+        self.network = network
+
+    def probe(self, addresses):
+        return {addr for addr in addresses if addr in self.network.listening}
+
+
+class SimulatedSweeper(IcmpSweeper):
+    # Skips the ICMP socket; only listening hosts answer.
+    def __init__(self, network, **kwargs):
+        super().__init__(fallback=[SimulatedProber(network)], **kwargs)
+
+    def _open(self):
+        self.mode = None
+        return None, self.fallback
+
+
+class MemoryResult:
+    def __init__(self, records=()):
+        self._records = list(records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def single(self):
+        return self._records[0] if self._records else {"deleted": 0}
+
+    def consume(self):
+        pass
+
+
+class MemorySession:
+    # Stands in for a neo4j session: accepts every query, counts the UNWIND
+    # rows it was handed and reads back nothing.
+    def __init__(self, driver):
+        self.driver = driver
+
+    def run(self, query, **params):
+        rows = params.get("rows")
+        if rows is not None:
+            self.driver.rows += len(rows)
+        self.driver.queries += 1
+        return MemoryResult()
+
+    def execute_write(self, work, *args, **kwargs):
+        self.driver.transactions += 1
+        return work(self, *args, **kwargs)
+
+    execute_read = execute_write
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class MemoryDriver:
+    def __init__(self):
+        self.rows = 0
+        self.queries = 0
+        self.transactions = 0
+
+    def session(self, **kwargs):
+        return MemorySession(self)
+
+    def close(self):
+        pass
+
+
+class MemoryCollection:
+    # Stands in for a pymongo collection on the write paths the scanners use.
+    def __init__(self):
+        self.rows = 0
+        self.requests = 0
+
+    def bulk_write(self, operations, ordered=True):
+        self.rows += len(operations)
+        self.requests += 1
+
+    def update_many(self, query, update, upsert=False):
+        self.requests += 1
+
+    update_one = update_many
+
+    def find(self, *args, **kwargs):
+        self.requests += 1
+        return iter(())
+
+    def create_index(self, *args, **kwargs):
+        pass
@@ -0,0 +1,165 @@
+import re
+from ipaddress import ip_address, ip_network
+
+# One bit per address: a /8 is 2MB, a /16 8KB. Anything bigger than an IPv4
+# address space is refused rather than allocated.
+MAX_ADDRESSES = 2 ** 32
+
+_NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+def host_bounds(network):
+    # First and last host offsets within the network, matching network.hosts().
+    size = network.num_addresses
+    if network.version == 4 and network.prefixlen < 31:
+        return 1, size - 2
+    if network.version == 6 and network.prefixlen < 127:
+        return 1, size - 1
+    return 0, size - 1
+
+
+def host_count(network):
+    first, last = host_bounds(ip_network(network, strict=False))
+    return last - first + 1
+
+
+def range_row(network, start, end):
+    # An AddressRange row for neo4j_ingest.ingest_ranges; offsets are relative
+    # to the Subnet's network address.
+    base = int(network.network_address)
+    return {"start": str(ip_address(base + start)), "end": str(ip_address(base + end)),
+            "start_offset": start, "end_offset": end, "size": end - start + 1}
+
+
+class LivenessSet:
+    # Bitmap of live hosts, indexed by address offset from the network address.
+    # Live hosts are iterated by skipping zero bytes in C, and free space comes
+    # out as (start, end) intervals, so callers only ever pay for live hosts.
+    # A shard of a larger subnet passes that subnet as `parent`: only the
+    # parent's network/broadcast addresses are excluded, and range rows are
+    # offset from the parent's network address.
+    def __init__(self, network, parent=None):
+        self.network = ip_network(network, strict=False)
+        self.parent = ip_network(parent, strict=False) if parent is not None else self.network
+        if self.network.num_addresses > MAX_ADDRESSES:
+            raise ValueError(f"{self.network} is too large for a liveness bitmap.")
+        self._base = int(self.network.network_address)
+        self._shift = self._base - int(self.parent.network_address)
+        self._bits = bytearray((self.network.num_addresses + 7) // 8)
+        self._count = 0
+        first, last = host_bounds(self.parent)
+        self.first = max(0, first - self._shift)
+        self.last = min(self.network.num_addresses - 1, last - self._shift)
+
+    def offset(self, address):
+        offset = int(ip_address(address)) - self._base
+        if not 0 <= offset < self.network.num_addresses:
+            return None
+        return offset
+
+    def address(self, offset):
+        return ip_address(self._base + offset)
+
+    def add(self, address):
+        # Returns True only for a host address of the range not already live.
+        offset = self.offset(address)
+        if offset is None or not self.first <= offset <= self.last:
+            return False
+        byte, mask = offset >> 3, 1 << (offset & 7)
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def update(self, addresses):
+        for address in addresses:
+            self.add(address)
+
+    def __contains__(self, address):
+        offset = self.offset(address)
+        return offset is not None and bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def host_count(self):
+        return max(0, self.last - self.first + 1)
+
+    @property
+    def free_count(self):
+        return self.host_count - self._count
+
+    def live_offsets(self):
+        for match in _NONZERO_BYTE.finditer(self._bits):
+            byte_index = match.start()
+            value = self._bits[byte_index]
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield (byte_index << 3) | bit
+
+    def __iter__(self):
+        for offset in self.live_offsets():
+            yield self.address(offset)
+
+    def free_offsets(self):
+        # Host offsets that are not live, in order, without building a list.
+        previous = self.first - 1
+        for offset in self.live_offsets():
+            yield from range(previous + 1, offset)
+            previous = offset
+        yield from range(previous + 1, self.last + 1)
+
+    def free_addresses(self):
+        for offset in self.free_offsets():
+            yield self.address(offset)
+
+    def free_ranges(self):
+        # Maximal runs of non-live host offsets as inclusive (start, end) pairs.
+        start = self.first
+        for offset in self.live_offsets():
+            if offset > start:
+                yield start, offset - 1
+            start = max(start, offset + 1)
+        if start <= self.last:
+            yield start, self.last
+
+    def live_ranges(self):
+        start = previous = None
+        for offset in self.live_offsets():
+            if previous is not None and offset == previous + 1:
+                previous = offset
+                continue
+            if start is not None:
+                yield start, previous
+            start = previous = offset
+        if start is not None:
+            yield start, previous
+
+    def to_bytes(self):
+        return bytes(self._bits)
+
+    def changed_offsets(self, previous):
+        # (offset, live) for every host whose bit differs from `previous`, the
+        # to_bytes() of an earlier bitmap of the same network. The XOR runs in
+        # C, so unchanged hosts cost nothing.
+        if len(previous) != len(self._bits):
+            previous = bytes(len(self._bits))
+        size = len(self._bits)
+        diff = (int.from_bytes(self._bits, "little") ^ int.from_bytes(previous, "little")).to_bytes(size, "little")
+        for match in _NONZERO_BYTE.finditer(diff):
+            byte_index = match.start()
+            value = diff[byte_index]
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield (byte_index << 3) | bit, bool(self._bits[byte_index] & (1 << bit))
+
+    @property
+    def parent_bounds(self):
+        # This range's span as (lo, hi) offsets within the parent subnet.
+        return self._shift, self._shift + self.network.num_addresses - 1
+
+    def range_rows(self, ranges):
+        for start, end in ranges:
+            yield range_row(self.parent, start + self._shift, end + self._shift)
@@ -0,0 +1,258 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process counters, gauges and histograms rendered in the Prometheus text
+# format. Every metric is defined here, once per process, and labelled by
+# scanner/operation instead of being redefined per module. Updates take one
+# lock and a dict lookup, cheap enough for per-probe use.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(self.labelnames, values, extra)} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield "_total", key, (), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        # function() returns {label values tuple: value}, read at scrape time.
+        self._function = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            values.update(self._function())
+        for key, value in sorted(values.items()):
+            yield "", key, (), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count.
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", key, (("le", _number(bound)),), cumulative
+            yield "_sum", key, (), total
+            yield "_count", key, (), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def render():
+    return REGISTRY.render()
+
+
+# --- Probes (scanner: tcp, icmp, tcp_ping) ---
+PROBES_SENT = Counter("scanner_probes_sent", "Probe packets or connects sent, retries included.", ("scanner",))
+PROBE_REPLIES = Counter("scanner_probe_replies", "Probes that got an answer.", ("scanner",))
+PROBE_TIMEOUTS = Counter("scanner_probe_timeouts", "Probes that timed out unanswered.", ("scanner",))
+PROBE_SECONDS = Histogram("scanner_probe_seconds", "Round-trip time of answered probes.", ("scanner",))
+PROBES_IN_FLIGHT = Gauge("scanner_probes_in_flight", "Probes sent and not yet answered or timed out.",
+                         ("scanner",))
+FINGERPRINT_SECONDS = Histogram("scanner_fingerprint_seconds", "Time spent fingerprinting one open port.",
+                                ("service",))
+
+# --- Databases ---
+DB_SECONDS = Histogram("db_operation_seconds", "Latency of Neo4j transactions and MongoDB requests.",
+                       ("db", "operation"))
+
+# --- API ---
+API_SECONDS = Histogram("api_request_seconds", "Time to build an API response (streamed bodies excluded).",
+                        ("endpoint", "method", "status"))
+SCAN_JOBS = Gauge("api_scan_jobs", "Scan jobs known to this API process, by status.", ("status",))
+
+# --- Scan phases ---
+PHASE_SECONDS = Histogram("scan_phase_seconds", "Wall time of each scan phase.", ("phase",), buckets=PHASE_BUCKETS)
+
+
+class ScanProfile:
+    # Phase-by-phase wall time of one scan. Nested phases are counted in
+    # their parent too, so shares can add up to more than 100%.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            calls, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (calls + 1, total + seconds)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][1])
+        return {"seconds": round(elapsed, 4),
+                "phases": [{"phase": phase, "calls": calls, "seconds": round(total, 4),
+                            "share": round(total / elapsed, 4) if elapsed else None}
+                           for phase, (calls, total) in phases]}
+
+    def format(self):
+        report = self.report()
+        lines = [f"{'phase':<28}{'calls':>7}{'seconds':>11}{'share':>8}"]
+        for row in report["phases"]:
+            share = f"{row['share'] * 100:.1f}%" if row["share"] is not None else "-"
+            lines.append(f"{row['phase']:<28}{row['calls']:>7}{row['seconds']:>11}{share:>8}")
+        lines.append(f"{'total':<28}{'':>7}{report['seconds']:>11}")
+        return "\n".join(lines)
+
+
+_profile = contextvars.ContextVar("scan_profile", default=None)
+
+
+@contextmanager
+def profiling(profile):
+    # Phases run in this context (asyncio tasks started from it included)
+    # are added to `profile`; None turns profiling off.
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+        if profile is not None:
+            profile.finish()
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, phase=name)
+        profile = _profile.get()
+        if profile is not None:
+            profile.add(name, elapsed)
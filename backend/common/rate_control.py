@@ -0,0 +1,188 @@
+import asyncio
+import time
+from collections import deque
+from ipaddress import ip_address
+
+from metrics import PROBES_IN_FLIGHT
+
+# RFC 6298 smoothing gains and variance multiplier.
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+# RTT is tracked per /24 (IPv4) or /64 (IPv6): hosts on one segment share a path.
+SUBNET_PREFIXES = {4: 24, 6: 64}
+# Loss rate is measured over this many recent answers, and acted on once
+# at least MIN_LOSS_SAMPLES have come in since the last change.
+LOSS_SAMPLE = 200
+MIN_LOSS_SAMPLES = 50
+# Waits shorter than this are skipped (and made up by the next one): poll()
+# and the event loop can't sleep for less than about a millisecond.
+PACING_GRANULARITY = 0.001
+
+
+class RttEstimator:
+    def __init__(self, initial_timeout=1.0, min_timeout=0.05, max_timeout=5.0):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + K * self.rttvar))
+
+
+class AdaptiveRateController:
+    # Shared by every probe of a scan: per-subnet RTT estimates give each
+    # probe its timeout, an AIMD window caps probes in flight, and max_rate
+    # (packets per second) paces sends. A probe that only got an answer on a
+    # retry counts as lost; the window halves while the recent loss rate is
+    # above loss_threshold and grows back with every clean answer. Losses of
+    # probes first sent before the last cut don't cut it again: they were
+    # caused by the old, larger window. If a cut didn't bring loss down, the
+    # loss is the link's rather than ours, and becomes the floor that later
+    # loss is measured against.
+    def __init__(self, max_window=1000, initial_window=None, min_window=8, max_rate=None,
+                 initial_timeout=1.0, min_timeout=0.05, max_timeout=5.0, loss_threshold=0.05):
+        self.max_window = max_window
+        self.min_window = min(min_window, max_window)
+        self.window = float(initial_window or max_window)
+        self.ssthresh = float(max_window)
+        self.max_rate = max_rate
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.loss_threshold = loss_threshold
+        self.answered = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self._estimators = {}
+        self._losses = deque(maxlen=LOSS_SAMPLE)
+        self._lost = 0
+        self._loss_floor = 0.0
+        self._cut_loss = None
+        self._last_decrease = 0.0
+        self._next_send = 0.0
+
+    def _estimator(self, ip):
+        address = ip_address(ip)
+        key = (address.version, int(address) >> (address.max_prefixlen - SUBNET_PREFIXES[address.version]))
+        estimator = self._estimators.get(key)
+        if estimator is None:
+            estimator = self._estimators[key] = RttEstimator(self.initial_timeout, self.min_timeout,
+                                                             self.max_timeout)
+        return estimator
+
+    def timeout(self, ip):
+        return self._estimator(ip).timeout
+
+    @property
+    def limit(self):
+        return max(1, int(self.window))
+
+    @property
+    def loss_rate(self):
+        return self._lost / len(self._losses) if self._losses else 0.0
+
+    def on_answer(self, ip, rtt, retransmit=False, first_sent=None):
+        # first_sent is when the probe's first attempt went out. Without it,
+        # cuts are spaced by at least one smoothed RTT instead.
+        estimator = self._estimator(ip)
+        estimator.observe(rtt)
+        self.answered += 1
+        self.retransmits += retransmit
+        now = time.monotonic()
+        if first_sent is not None:
+            fresh = first_sent >= self._last_decrease
+        else:
+            fresh = now - self._last_decrease >= estimator.srtt
+        if not fresh:
+            return
+        if len(self._losses) == self._losses.maxlen:
+            self._lost -= self._losses[0]
+        self._losses.append(retransmit)
+        self._lost += retransmit
+        if not retransmit:
+            self.window = min(self.max_window, self.window + (1 if self.window < self.ssthresh else 1 / self.window))
+            return
+        if len(self._losses) < MIN_LOSS_SAMPLES or self.loss_rate <= self._loss_floor + self.loss_threshold:
+            return
+        if self._cut_loss is not None and self.loss_rate >= self._cut_loss:
+            self._loss_floor = self.loss_rate
+            self._cut_loss = None
+        else:
+            self.ssthresh = max(self.min_window, self.window / 2)
+            self.window = self.ssthresh
+            self._cut_loss = self.loss_rate
+        # Judge the next step only on probes sent after this one.
+        self._last_decrease = now
+        self._losses.clear()
+        self._lost = 0
+
+    def on_timeout(self, ip):
+        # Silence alone isn't congestion: filtered ports and dead hosts never answer.
+        self.timeouts += 1
+
+    def reserve(self):
+        # Claims the next send slot under max_rate and returns how long to wait for it.
+        if not self.max_rate:
+            return 0.0
+        now = time.monotonic()
+        # Up to one granularity of slots lost to oversleeping can be caught up.
+        slot = max(now - PACING_GRANULARITY, self._next_send)
+        self._next_send = slot + 1.0 / self.max_rate
+        return slot - now if slot - now >= PACING_GRANULARITY else 0.0
+
+    def stats(self):
+        return {"window": round(self.window, 1), "loss_rate": round(self.loss_rate, 4),
+                "loss_floor": round(self._loss_floor, 4),
+                "answered": self.answered, "retransmits": self.retransmits, "timeouts": self.timeouts,
+                "subnets": len(self._estimators)}
+
+
+class InFlightGate:
+    # asyncio side of the controller: `async with gate:` waits for room in the
+    # window and for a send slot under the rate ceiling. asyncio primitives
+    # belong to one event loop, so create a gate per run. scanner labels the
+    # in-flight gauge.
+    def __init__(self, controller, scanner="tcp"):
+        self.controller = controller
+        self.scanner = scanner
+        self.in_flight = 0
+        self._changed = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < self.controller.limit)
+            self.in_flight += 1
+        PROBES_IN_FLIGHT.inc(scanner=self.scanner)
+        delay = self.controller.reserve()
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # __aexit__ never runs for a task cancelled in here; give the slot back.
+            await self._release()
+            raise
+
+    async def __aexit__(self, *exc):
+        await self._release()
+
+    async def _release(self):
+        async with self._changed:
+            self.in_flight -= 1
+            PROBES_IN_FLIGHT.dec(scanner=self.scanner)
+            # The window may have grown by more than the one slot just freed.
+            self._changed.notify(max(1, self.controller.limit - self.in_flight))
@@ -0,0 +1,265 @@
+import os
+import threading
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+from bson import Binary
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from metrics import DB_SECONDS
+from storage import get_database
+
+# Scan history as deltas: each run records only what changed since the run
+# before it -- hosts that came up or went down, ports that opened or closed,
+# services that were re-identified. Events are appended to per-host bucket
+# documents of up to BUCKET_SIZE events, so a host's timeline is a handful of
+# documents however many runs there have been. Host changes are found by
+# XOR-ing the run's liveness bitmap against the previous run's, which is kept
+# compressed in scan_snapshots. Buckets and runs expire after the retention
+# period through TTL indexes. Each host has at most one bucket marked `open`
+# (a unique partial index); a push that doesn't fit in it closes it and
+# starts a new one.
+
+HISTORY_COLLECTION = "scan_history"
+RUNS_COLLECTION = "scan_runs"
+SNAPSHOTS_COLLECTION = "scan_snapshots"
+BUCKET_SIZE = 200
+# Rounds of closing full buckets and retrying before an append gives up.
+MAX_APPEND_ATTEMPTS = 10
+DUPLICATE_KEY = 11000
+DEFAULT_RETENTION_DAYS = 180
+# Larger (compressed) bitmaps wouldn't fit in a document; their host changes aren't recorded.
+MAX_SNAPSHOT_BYTES = 8 * 1024 * 1024
+
+UP = "up"
+DOWN = "down"
+OPENED = "open"
+CLOSED = "close"
+SERVICE = "svc"
+
+_indexed = set()
+_lock = threading.Lock()
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def _now():
+    # Naive UTC, like the datetimes pymongo reads back.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _epoch(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _datetime(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None) if epoch is not None else None
+
+
+def port_events(state, open_ports):
+    # Events turning the stored ports document `state` into `open_ports`.
+    before = {p["port"]: p for p in (state or {}).get("open_ports", [])}
+    after = {p["port"]: p for p in open_ports}
+    events = []
+    for port in sorted(after.keys() - before.keys()):
+        events.append({"e": OPENED, "p": port, "s": after[port].get("service")})
+    for port in sorted(before.keys() - after.keys()):
+        events.append({"e": CLOSED, "p": port})
+    for port in sorted(after.keys() & before.keys()):
+        if after[port].get("service") != before[port].get("service"):
+            events.append({"e": SERVICE, "p": port, "s": after[port].get("service")})
+    return events
+
+
+def fold_events(events):
+    # Net effect of a run of events for one host. Up/down and open/close
+    # alternate, so a key whose first and last events differ is back where
+    # it started.
+    first, last = {}, {}
+    for event in events:
+        key = (event["e"] in (UP, DOWN), event.get("p"), event["e"] == SERVICE)
+        first.setdefault(key, event)
+        last[key] = event
+    return [event for key, event in last.items() if key[2] or first[key]["e"] == event["e"]]
+
+
+class ScanHistory:
+    def __init__(self, database=None, retention_days=None):
+        database = database if database is not None else get_database()
+        self.history = database[HISTORY_COLLECTION]
+        self.runs = database[RUNS_COLLECTION]
+        self.snapshots = database[SNAPSHOTS_COLLECTION]
+        days = retention_days if retention_days is not None else float(
+            os.getenv("HISTORY_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+        self.retention_seconds = int(days * 24 * 60 * 60)
+        self._ensure_indexes(database)
+
+    def _ensure_indexes(self, database):
+        with _lock:
+            if database.name in _indexed:
+                return
+            self.history.create_index([("ip", ASCENDING), ("first", ASCENDING)])
+            self.history.create_index("ip", name="ip_open_bucket", unique=True,
+                                      partialFilterExpression={"open": True})
+            self.history.create_index([("subnet", ASCENDING), ("last", ASCENDING)])
+            self.runs.create_index([("subnets", ASCENDING), ("started_at", DESCENDING)])
+            for collection, field in ((self.history, "last"), (self.runs, "started_at")):
+                try:
+                    collection.create_index(field, expireAfterSeconds=self.retention_seconds)
+                except OperationFailure:
+                    # The retention changed since the TTL index was built.
+                    database.command("collMod", collection.name, index={
+                        "keyPattern": {field: 1}, "expireAfterSeconds": self.retention_seconds})
+            _indexed.add(database.name)
+
+    def start_run(self, subnets, incremental=False, run_id=None):
+        run_id = run_id or new_run_id()
+        self.runs.update_one({"_id": run_id}, {"$setOnInsert": {"started_at": _now(), "incremental": incremental},
+                                               "$addToSet": {"subnets": {"$each": list(subnets)}}}, upsert=True)
+        return run_id
+
+    def finish_run(self, run_id, **fields):
+        self.runs.update_one({"_id": run_id}, {"$set": dict(fields, finished_at=_now())})
+
+    def _append(self, run_id, rows):
+        # rows yields (ip, subnet, event); each host's events go to its open bucket.
+        now = _now()
+        grouped = {}
+        for ip, subnet, event in rows:
+            event = dict(event, t=now, r=run_id)
+            grouped.setdefault((ip, subnet), []).append(event)
+        # (ip, events) per push; no push is larger than a bucket.
+        pushes = [(ip, subnet, events[i:i + BUCKET_SIZE]) for (ip, subnet), events in grouped.items()
+                  for i in range(0, len(events), BUCKET_SIZE)]
+        for _ in range(MAX_APPEND_ATTEMPTS):
+            if not pushes:
+                break
+            pushes = self._push(pushes, now)
+        else:
+            raise RuntimeError(f"History: could not append events for {len(pushes)} host(s).")
+        return sum(len(events) for events in grouped.values())
+
+    def _push(self, pushes, now):
+        # Pushes each batch into its host's open bucket if it has room for all
+        # of it. Otherwise the upsert collides with that bucket on the unique
+        # index; the full bucket is closed and the batch returned for a retry.
+        # Two writers starting the same host's first bucket collide the same way.
+        operations = [UpdateOne({"ip": ip, "open": True, "n": {"$lte": BUCKET_SIZE - len(events)}},
+                                {"$push": {"events": {"$each": events}}, "$inc": {"n": len(events)},
+                                 "$min": {"first": now}, "$max": {"last": now}, "$set": {"subnet": subnet}},
+                                upsert=True)
+                      for ip, subnet, events in pushes]
+        try:
+            with DB_SECONDS.time(db="mongo", operation="append_history"):
+                self.history.bulk_write(operations, ordered=False)
+            return []
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+        retry = [pushes[error["index"]] for error in errors]
+        for ip, _, events in retry:
+            self.history.update_many({"ip": ip, "open": True, "n": {"$gt": BUCKET_SIZE - len(events)}},
+                                     {"$unset": {"open": ""}})
+        return retry
+
+    def record_hosts(self, run_id, liveness):
+        # Diffs the run's LivenessSet (possibly one shard) against the
+        # previous bitmap for the same network and records up/down events.
+        key = str(liveness.network)
+        subnet = str(liveness.parent.network_address)
+        bits = liveness.to_bytes()
+        packed = zlib.compress(bits, 1)
+        if len(packed) > MAX_SNAPSHOT_BYTES:
+            print(f"History: {key} is too large to snapshot; host changes not recorded.")
+            return 0
+        previous = self.snapshots.find_one({"_id": key}, {"bits": 1})
+        previous = zlib.decompress(previous["bits"]) if previous else b""
+        rows = ((str(liveness.address(offset)), subnet, {"e": UP if live else DOWN})
+                for offset, live in liveness.changed_offsets(previous))
+        recorded = self._append(run_id, rows)
+        self.snapshots.update_one({"_id": key}, {"$set": {"subnet": subnet, "bits": Binary(packed), "run": run_id,
+                                                          "at": _now()}}, upsert=True)
+        return recorded
+
+    def record_ports(self, run_id, changes):
+        # changes yields (ip, subnet, state, open_ports) for every ports document
+        # written: the document before the write and the open ports after it.
+        return self._append(run_id, ((ip, subnet, event) for ip, subnet, state, open_ports in changes
+                                     for event in port_events(state, open_ports)))
+
+    def timeline(self, ip, since=None, until=None, port=None):
+        # Every change recorded for the host, oldest first.
+        query = {"ip": ip}
+        if since is not None:
+            query["last"] = {"$gte": _datetime(since)}
+        if until is not None:
+            query["first"] = {"$lte": _datetime(until)}
+        events = []
+        for bucket in self.history.find(query, {"events": 1}).sort("first", ASCENDING):
+            for event in bucket["events"]:
+                at = _epoch(event["t"])
+                if since is not None and at < since or until is not None and at > until:
+                    continue
+                if port is not None and event.get("p") != port:
+                    continue
+                events.append(_render(event))
+        return events
+
+    def list_runs(self, subnet=None, limit=50):
+        query = {"subnets": subnet} if subnet else {}
+        return [_render_run(run) for run in self.runs.find(query).sort("started_at", DESCENDING).limit(limit)]
+
+    def get_run(self, run_id):
+        run = self.runs.find_one({"_id": run_id})
+        return _render_run(run) if run else None
+
+    def diff(self, from_run, to_run):
+        # Net changes between the end of from_run and the end of to_run, over
+        # the subnets to_run scanned. Returns None if either run is unknown.
+        before, after = self.runs.find_one({"_id": from_run}), self.runs.find_one({"_id": to_run})
+        if before is None or after is None:
+            return None
+        if before["started_at"] > after["started_at"]:
+            before, after = after, before
+        start = before.get("finished_at") or before["started_at"]
+        end = after.get("finished_at") or _now()
+        per_host = {}
+        query = {"subnet": {"$in": after.get("subnets", [])}, "last": {"$gt": start}, "first": {"$lte": end}}
+        for bucket in self.history.find(query, {"ip": 1, "events": 1}).sort("first", ASCENDING):
+            per_host.setdefault(bucket["ip"], []).extend(
+                event for event in bucket["events"] if start < event["t"] <= end)
+        result = {"from": _render_run(before), "to": _render_run(after), "hosts_up": [], "hosts_down": [],
+                  "ports_opened": [], "ports_closed": [], "services_changed": []}
+        lists = {UP: "hosts_up", DOWN: "hosts_down", OPENED: "ports_opened", CLOSED: "ports_closed",
+                 SERVICE: "services_changed"}
+        for ip in sorted(per_host):
+            for event in fold_events(per_host[ip]):
+                if event["e"] in (UP, DOWN):
+                    result[lists[event["e"]]].append(ip)
+                else:
+                    result[lists[event["e"]]].append(dict(_render(event), ip=ip))
+        return result
+
+
+def _render(event):
+    row = {"at": _epoch(event["t"]), "run": event.get("r"), "event": event["e"]}
+    if "p" in event:
+        row["port"] = event["p"]
+    if event.get("s") is not None:
+        row["service"] = event["s"]
+    return row
+
+
+def _render_run(run):
+    return {"run_id": run["_id"], "subnets": run.get("subnets", []), "incremental": run.get("incremental", False),
+            "started_at": _epoch(run.get("started_at")), "finished_at": _epoch(run.get("finished_at")),
+            **{key: value for key, value in run.items()
+               if key not in ("_id", "subnets", "incremental", "started_at", "finished_at")}}
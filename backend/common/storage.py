@@ -0,0 +1,114 @@
+import os
+import threading
+from neo4j import GraphDatabase
+from pymongo import DESCENDING, MongoClient, UpdateOne
+from metrics import DB_SECONDS
+
+# One pooled Neo4j driver and one MongoClient per process, shared by the API,
+# the scanners and the scripts. Settings come from the environment unless a
+# script overrides them with configure() before first use.
+
+DEFAULT_MONGO_DB = "network_topology"
+PORTS_COLLECTION = "ports"
+BULK_CHUNK_SIZE = 1000
+
+_settings = {}
+_lock = threading.Lock()
+_clients = {}
+_pid = None
+
+
+def configure(**settings):
+    # Accepts neo4j_uri, neo4j_user, neo4j_password, mongo_uri, mongo_db,
+    # neo4j_pool_size and mongo_pool_size.
+    with _lock:
+        _settings.update({key: value for key, value in settings.items() if value is not None})
+
+
+def _setting(name, default=None):
+    if name in _settings:
+        return _settings[name]
+    return os.getenv(name.upper(), default)
+
+
+def _reset_after_fork():
+    # Drivers and MongoClients are not fork-safe; a child process (e.g. a
+    # process-pool worker) must build its own instead of reusing the parent's.
+    global _pid
+    if _pid != os.getpid():
+        _clients.clear()
+        _pid = os.getpid()
+
+
+def get_neo4j_driver():
+    with _lock:
+        _reset_after_fork()
+        if "neo4j" not in _clients:
+            uri = _setting("neo4j_uri")
+            user = _setting("neo4j_user", "neo4j")
+            password = _setting("neo4j_password")
+            if not all([uri, user, password]):
+                raise ValueError("Neo4j settings are not fully configured.")
+            _clients["neo4j"] = GraphDatabase.driver(
+                uri, auth=(user, password),
+                max_connection_pool_size=int(_setting("neo4j_pool_size", 50)))
+        return _clients["neo4j"]
+
+
+def get_mongo_client():
+    with _lock:
+        _reset_after_fork()
+        if "mongo" not in _clients:
+            uri = _setting("mongo_uri")
+            if not uri:
+                raise ValueError("MongoDB settings are not fully configured.")
+            _clients["mongo"] = MongoClient(uri, maxPoolSize=int(_setting("mongo_pool_size", 100)))
+        return _clients["mongo"]
+
+
+def get_database():
+    return get_mongo_client()[_setting("mongo_db", DEFAULT_MONGO_DB)]
+
+
+def get_ports_collection():
+    # The single ports collection every writer and reader uses, keyed on ip_address.
+    collection = get_database()[PORTS_COLLECTION]
+    with _lock:
+        if "ports_index" not in _clients:
+            collection.create_index("ip_address", unique=True)
+            # Top-N hosts by open ports, overall and per subnet, read straight off an index.
+            collection.create_index([("open_port_count", DESCENDING)])
+            collection.create_index([("subnet", 1), ("open_port_count", DESCENDING)])
+            _clients["ports_index"] = True
+    return collection
+
+
+def port_fields(open_ports, subnet=None, **fields):
+    # The $set for a host's ports document; open_port_count backs the top-N indexes.
+    fields.update(open_ports=open_ports, open_port_count=len(open_ports))
+    if subnet is not None:
+        fields["subnet"] = subnet
+    return fields
+
+
+def bulk_upsert_ports(results, collection=None, subnets=None, **fields):
+    # results maps ip -> open port records; subnets optionally maps ip -> Subnet
+    # address. Extra fields are $set on every document.
+    collection = collection if collection is not None else get_ports_collection()
+    subnets = subnets or {}
+    operations = [UpdateOne({"ip_address": ip}, {"$set": port_fields(open_ports, subnets.get(ip), **fields)},
+                            upsert=True)
+                  for ip, open_ports in results.items()]
+    for i in range(0, len(operations), BULK_CHUNK_SIZE):
+        with DB_SECONDS.time(db="mongo", operation="bulk_upsert_ports"):
+            collection.bulk_write(operations[i:i + BULK_CHUNK_SIZE], ordered=False)
+    return len(operations)
+
+
+def close_all():
+    with _lock:
+        for name in ("neo4j", "mongo"):
+            client = _clients.pop(name, None)
+            if client is not None:
+                client.close()
+        _clients.pop("ports_index", None)
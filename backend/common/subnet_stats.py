@@ -0,0 +1,141 @@
+from pymongo import UpdateOne
+from metrics import DB_SECONDS
+from storage import get_database, get_ports_collection
+
+# Per-subnet counters kept next to the ports collection, one document per
+# Subnet keyed on its network address. Writers $inc them by the difference
+# their write made, so reading a summary costs one document per subnet no
+# matter how many hosts are tracked.
+
+STATS_COLLECTION = "subnet_stats"
+DEFAULT_TOP_N = 10
+MAX_TOP_N = 100
+
+
+def get_stats_collection():
+    return get_database()[STATS_COLLECTION]
+
+
+def service_key(service):
+    # Service names become field names under "services"; Mongo reserves "." and "$".
+    return (service or "unknown").replace(".", "_").replace("$", "_")
+
+
+def _count(deltas, subnet, open_ports, sign):
+    if subnet is None:
+        return
+    inc = deltas.setdefault(subnet, {})
+    inc["hosts_with_open_ports"] = inc.get("hosts_with_open_ports", 0) + sign * bool(open_ports)
+    inc["open_ports"] = inc.get("open_ports", 0) + sign * len(open_ports)
+    for port in open_ports:
+        field = "services." + service_key(port.get("service"))
+        inc[field] = inc.get(field, 0) + sign
+
+
+def port_deltas(changes):
+    # changes yields (state, subnet, open_ports): the host's ports document as
+    # it was before the write (None if new) and what the write puts there.
+    # Documents written before stats existed carry no subnet and were never
+    # counted, so there is nothing to take back for them.
+    deltas = {}
+    for state, subnet, open_ports in changes:
+        if state is not None:
+            _count(deltas, state.get("subnet"), state.get("open_ports", []), -1)
+        _count(deltas, subnet, open_ports, 1)
+    return {subnet: {field: value for field, value in inc.items() if value}
+            for subnet, inc in deltas.items()}
+
+
+class SubnetStats:
+    def __init__(self, collection=None, ports_collection=None):
+        self.collection = collection if collection is not None else get_stats_collection()
+        self._ports = ports_collection
+
+    @property
+    def ports(self):
+        # Only summaries read the ports collection; writers never need it.
+        if self._ports is None:
+            self._ports = get_ports_collection()
+        return self._ports
+
+    def reset_hosts(self, subnet, cidr, total_ips):
+        # A full re-discovery drops every IP node first, so counting restarts at zero.
+        self.collection.update_one({"_id": subnet}, {"$set": {"cidr": cidr, "total_ips": total_ips, "used_ips": 0}},
+                                   upsert=True)
+
+    def set_total(self, subnet, cidr, total_ips):
+        self.collection.update_one({"_id": subnet}, {"$set": {"cidr": cidr, "total_ips": total_ips}}, upsert=True)
+
+    def add_hosts(self, subnet, delta):
+        if delta:
+            self.collection.update_one({"_id": subnet}, {"$inc": {"used_ips": delta}}, upsert=True)
+
+    def set_hosts(self, subnet, cidr, total_ips, used_ips):
+        # For writers that recount a whole subnet in one go.
+        self.collection.update_one({"_id": subnet}, {"$set": {"cidr": cidr, "total_ips": total_ips,
+                                                              "used_ips": used_ips}}, upsert=True)
+
+    def record_ports(self, changes):
+        operations = [UpdateOne({"_id": subnet}, {"$inc": inc}, upsert=True)
+                      for subnet, inc in port_deltas(changes).items() if inc]
+        if operations:
+            with DB_SECONDS.time(db="mongo", operation="record_port_stats"):
+                self.collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    def top_hosts(self, subnet=None, limit=DEFAULT_TOP_N):
+        # Walks the (subnet, open_port_count) index, so only `limit` documents are read.
+        query = {"open_port_count": {"$gt": 0}}
+        if subnet is not None:
+            query["subnet"] = subnet
+        cursor = self.ports.find(query, {"_id": 0, "ip_address": 1, "open_port_count": 1, "open_ports.port": 1,
+                                         "open_ports.service": 1})
+        return list(cursor.sort("open_port_count", -1).limit(limit))
+
+    def summary(self, subnets=None, top=DEFAULT_TOP_N):
+        # subnets may name Subnet addresses or CIDRs; None summarizes all of them.
+        query = {}
+        if subnets:
+            query = {"$or": [{"_id": {"$in": subnets}}, {"cidr": {"$in": subnets}}]}
+        rows = []
+        totals = {"total_ips": 0, "used_ips": 0, "hosts_with_open_ports": 0, "open_ports": 0, "services": {}}
+        for doc in self.collection.find(query).sort("_id", 1):
+            row = _summary_row(doc)
+            row["top_hosts"] = self.top_hosts(doc["_id"], top) if top else []
+            rows.append(row)
+            for field in ("total_ips", "used_ips", "hosts_with_open_ports", "open_ports"):
+                totals[field] += row[field]
+            for service, count in row["services"].items():
+                totals["services"][service] = totals["services"].get(service, 0) + count
+        totals = _with_availability(totals)
+        totals["services"] = _sorted_services(totals["services"])
+        if subnets:
+            hosts = sorted((host for row in rows for host in row["top_hosts"]),
+                           key=lambda host: -host["open_port_count"])
+            totals["top_hosts"] = hosts[:top]
+        else:
+            totals["top_hosts"] = self.top_hosts(None, top) if top else []
+        return {"subnets": rows, "totals": totals}
+
+
+def _with_availability(row):
+    total = row.get("total_ips", 0)
+    used = min(row.get("used_ips", 0), total) if total else row.get("used_ips", 0)
+    row["available_ips"] = max(0, total - used)
+    row["available_percentage"] = round(row["available_ips"] / total * 100, 2) if total else None
+    return row
+
+
+def _sorted_services(services):
+    # Largest first; counters that drained to zero are left out.
+    return dict(sorted(((name, count) for name, count in services.items() if count > 0),
+                       key=lambda item: (-item[1], item[0])))
+
+
+def _summary_row(doc):
+    row = {"subnet": doc["_id"], "cidr": doc.get("cidr"), "total_ips": doc.get("total_ips", 0),
+           "used_ips": doc.get("used_ips", 0), "hosts_with_open_ports": doc.get("hosts_with_open_ports", 0),
+           "open_ports": doc.get("open_ports", 0)}
+    row = _with_availability(row)
+    row["services"] = _sorted_services(doc.get("services", {}))
+    return row
@@ -0,0 +1,285 @@
+import random
+import subprocess
+from bisect import bisect_right
+from ipaddress import (IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network,
+                       summarize_address_range)
+
+from liveness import MAX_ADDRESSES, host_bounds
+
+# Scan targets as merged address intervals instead of address lists. A plan
+# takes CIDRs, "first-last" ranges and single addresses, merges overlaps,
+# cuts out exclusions and iterates what is left lazily in a keyed random
+# order, so a multi-site scan is one pass that never holds the full address
+# list and spreads its probes across every subnet at once. IPv6 ranges too
+# large to walk only contribute candidates: addresses from hint lists or the
+# kernel's neighbour cache that fall inside them.
+
+# IPv6 intervals up to this many addresses (a /112) are walked in full.
+MAX_IPV6_ENUMERATION = 2 ** 16
+# Ranges and single addresses are stored under the /24s (/64s for IPv6)
+# they touch, or under one covering network if that would be more than
+# MAX_RANGE_SITES networks.
+SITE_PREFIX = {4: 24, 6: 64}
+MAX_RANGE_SITES = 4096
+FEISTEL_ROUNDS = 4
+BITS = {4: 32, 6: 128}
+# ip_address(int) guesses the version from the value; ::1 would come back as 0.0.0.1.
+ADDRESSES = {4: IPv4Address, 6: IPv6Address}
+NETWORKS = {4: IPv4Network, 6: IPv6Network}
+
+
+def parse_target(spec, hosts_only=True):
+    # Returns (version, first, last) as integers. CIDRs cover their hosts
+    # only, like network.hosts(), unless hosts_only is False; "first-last"
+    # ranges are taken as given.
+    spec = str(spec).strip()
+    if "-" in spec:
+        first, _, last = spec.partition("-")
+        first, last = ip_address(first.strip()), ip_address(last.strip())
+        if first.version != last.version or first > last:
+            raise ValueError(f"Invalid address range: {spec}")
+        return first.version, int(first), int(last)
+    if "/" in spec:
+        network = ip_network(spec, strict=False)
+        first, last = host_bounds(network) if hosts_only else (0, network.num_addresses - 1)
+        base = int(network.network_address)
+        return network.version, base + first, base + last
+    address = ip_address(spec)
+    return address.version, int(address), int(address)
+
+
+def merge_intervals(intervals):
+    # Sorted, with overlapping and adjacent intervals joined.
+    merged = []
+    for version, first, last in sorted(intervals):
+        if merged and merged[-1][0] == version and first <= merged[-1][2] + 1:
+            merged[-1][2] = max(merged[-1][2], last)
+        else:
+            merged.append([version, first, last])
+    return [tuple(interval) for interval in merged]
+
+
+def subtract_intervals(intervals, excluded):
+    # Both inputs merged; returns the parts of intervals outside excluded.
+    result = []
+    excluded = list(excluded)
+    for version, first, last in intervals:
+        start = first
+        for ex_version, ex_first, ex_last in excluded:
+            if ex_version != version or ex_last < start or ex_first > last:
+                continue
+            if ex_first > start:
+                result.append((version, start, ex_first - 1))
+            start = max(start, ex_last + 1)
+            if start > last:
+                break
+        if start <= last:
+            result.append((version, start, last))
+    return result
+
+
+def covering_network(version, first, last):
+    # Smallest network containing [first, last].
+    prefix = BITS[version] - (first ^ last).bit_length()
+    return NETWORKS[version]((first, prefix), strict=False)
+
+
+def _run_ip(*args):
+    # `ip` output, or nothing where iproute2 isn't available.
+    try:
+        return subprocess.run(["ip", *args], capture_output=True, text=True, timeout=5).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def neighbour_addresses(version=6):
+    # Addresses the kernel has resolved recently (`ip neigh`), failed entries excluded.
+    addresses = []
+    for line in _run_ip(f"-{version}", "neigh", "show").splitlines():
+        fields = line.split()
+        if fields and "FAILED" not in fields and "INCOMPLETE" not in fields:
+            addresses.append(fields[0])
+    return addresses
+
+
+def local_networks():
+    # Every global-scope network this host has an address in, IPv4 and IPv6.
+    networks = []
+    for line in _run_ip("-o", "addr", "show", "scope", "global").splitlines():
+        fields = line.split()
+        if len(fields) > 3 and fields[2] in ("inet", "inet6"):
+            networks.append(ip_network(fields[3], strict=False))
+    return sorted(set(networks), key=lambda network: (network.version, network))
+
+
+def read_hints(path):
+    # One address per line; blank lines and # comments are skipped.
+    with open(path) as f:
+        return [line.split("#", 1)[0].strip() for line in f if line.split("#", 1)[0].strip()]
+
+
+class _Permutation:
+    # Keyed Feistel network over [0, 2**bits), cycle-walked down to [0, n):
+    # a bijection evaluated one index at a time, with no table. The domain
+    # is under 4n, so an index takes at most a few evaluations on average.
+    def __init__(self, n, seed=None):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        bits += bits & 1
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64) for _ in range(FEISTEL_ROUNDS)]
+
+    def _encrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for key in self.keys:
+            # Tuples of ints hash the same in every process, unlike strings.
+            left, right = right, left ^ (hash((key, right)) & self.mask)
+        return (left << self.half) | right
+
+    def __getitem__(self, index):
+        value = self._encrypt(index)
+        while value >= self.n:
+            value = self._encrypt(value)
+        return value
+
+
+class TargetPlan:
+    def __init__(self, targets, exclude=(), hints=(), seed=None, shuffle=True):
+        # targets and exclude take CIDRs, ranges and addresses; hints are
+        # IPv6 candidates, used only inside targeted ranges too large to walk.
+        targets = list(targets)
+        included = merge_intervals(parse_target(spec) for spec in targets)
+        excluded = merge_intervals(parse_target(spec, hosts_only=False) for spec in exclude)
+        walked, sparse = [], []
+        for interval in subtract_intervals(included, excluded):
+            version, first, last = interval
+            if version == 6 and last - first + 1 > MAX_IPV6_ENUMERATION:
+                sparse.append(interval)
+            else:
+                walked.append(interval)
+        candidates = []
+        for hint in hints:
+            address = ip_address(hint)
+            value = int(address)
+            if any(version == address.version and first <= value <= last for version, first, last in sparse):
+                candidates.append((address.version, value, value))
+        self.intervals = merge_intervals(walked + candidates)
+        self.sparse = sparse
+        self.sites = self._sites(targets)
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.shuffle = shuffle
+        self._keys = [(version, first) for version, first, _ in self.intervals]
+        # Sites don't overlap, so the only candidate is the last one starting at or before an address.
+        self._site_keys = [(site.version, int(site.network_address)) for site in self.sites]
+        # Offset of each interval's first address in the plan's index space.
+        self._starts = []
+        total = 0
+        for _, first, last in self.intervals:
+            self._starts.append(total)
+            total += last - first + 1
+        self._total = total
+
+    @staticmethod
+    def _sites(targets):
+        # The networks results are stored under, with those nested inside
+        # another target's network dropped.
+        networks = set()
+        for spec in targets:
+            version, first, last = parse_target(spec)
+            if "/" in str(spec):
+                networks.add(ip_network(str(spec).strip(), strict=False))
+                continue
+            shift = BITS[version] - SITE_PREFIX[version]
+            if (last >> shift) - (first >> shift) >= MAX_RANGE_SITES:
+                networks.add(covering_network(version, first, last))
+                continue
+            for block in range(first >> shift, (last >> shift) + 1):
+                networks.add(NETWORKS[version]((block << shift, SITE_PREFIX[version])))
+        ordered = sorted(networks, key=lambda network: (network.version, network.network_address,
+                                                        network.prefixlen))
+        sites = []
+        for network in ordered:
+            if not (sites and sites[-1].version == network.version and network.subnet_of(sites[-1])):
+                sites.append(network)
+        return sites
+
+    def __len__(self):
+        return self._total
+
+    @property
+    def versions(self):
+        # IP versions with at least one address to probe.
+        return {version for version, _, _ in self.intervals}
+
+    def _address(self, index):
+        position = bisect_right(self._starts, index) - 1
+        version, first, _ = self.intervals[position]
+        return ADDRESSES[version](first + index - self._starts[position])
+
+    def __iter__(self):
+        # Re-iterable: every pass walks the same order for the same seed.
+        if not self.shuffle:
+            for version, first, last in self.intervals:
+                for value in range(first, last + 1):
+                    yield ADDRESSES[version](value)
+            return
+        permutation = _Permutation(self._total, self.seed) if self._total else None
+        for index in range(self._total):
+            yield self._address(permutation[index])
+
+    def __contains__(self, address):
+        address = ip_address(address)
+        value = int(address)
+        position = bisect_right(self._keys, (address.version, value)) - 1
+        if position < 0:
+            return False
+        version, first, last = self.intervals[position]
+        return version == address.version and first <= value <= last
+
+    def site_of(self, address):
+        address = ip_address(address)
+        position = bisect_right(self._site_keys, (address.version, int(address))) - 1
+        if position < 0:
+            return None
+        site = self.sites[position]
+        return site if site.version == address.version and address in site else None
+
+    def is_sparse(self, site):
+        # True when part of site is only probed through candidates.
+        base, top = int(site.network_address), int(site.broadcast_address)
+        return any(version == site.version and first <= top and last >= base for version, first, last in self.sparse)
+
+    def covers(self, site):
+        # True when every host of site is probed, so its stored state can be replaced wholesale.
+        first, last = host_bounds(site)
+        base = int(site.network_address)
+        return any(version == site.version and start <= base + first and base + last <= end
+                   for version, start, end in self.intervals)
+
+    def blocks(self, site):
+        # The plan's addresses inside site as CIDR blocks, for LivenessSet
+        # shards; only for sites small enough for a bitmap.
+        if site.num_addresses > MAX_ADDRESSES:
+            raise ValueError(f"{site} is too large for a liveness bitmap.")
+        base, top = int(site.network_address), int(site.broadcast_address)
+        for version, first, last in self.intervals:
+            if version != site.version or last < base or first > top:
+                continue
+            yield from summarize_address_range(ADDRESSES[version](max(first, base)),
+                                               ADDRESSES[version](min(last, top)))
+
+    def addresses_in(self, site):
+        # The plan's addresses inside site, in order.
+        base, top = int(site.network_address), int(site.broadcast_address)
+        for version, first, last in self.intervals:
+            if version == site.version and last >= base and first <= top:
+                for value in range(max(first, base), min(last, top) + 1):
+                    yield ADDRESSES[version](value)
+
+    def describe(self):
+        text = f"{len(self)} address(es) across {len(self.sites)} site(s)"
+        if self.sparse:
+            text += f"; {len(self.sparse)} IPv6 range(s) too large to walk, probed through candidates only"
+        return text
@@ -0,0 +1,19 @@
+# The topology version is a counter on a single (:Meta {name: "topology"}) node.
+# Every scan write bumps it; the API keys its response cache and ETags on it.
+
+BUMP_QUERY = """
+    MERGE (m:Meta {name: "topology"})
+    SET m.version = coalesce(m.version, 0) + 1
+    RETURN m.version AS version
+"""
+
+READ_QUERY = 'MATCH (m:Meta {name: "topology"}) RETURN m.version AS version'
+
+
+def bump_topology_version(session):
+    return session.execute_write(lambda tx: tx.run(BUMP_QUERY).single()["version"])
+
+
+def get_topology_version(session):
+    record = session.execute_read(lambda tx: tx.run(READ_QUERY).single())
+    return record["version"] if record else 0
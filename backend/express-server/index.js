@@ -13,6 +13,8 @@ app.use(express.json());
 // MongoDB Configuration
 const mongoUri = 'mongodb://localhost:27017';
 const mongoClient = new MongoClient(mongoUri);
+// Same database the Python services use (MONGO_DB).
+const mongoDbName = process.env.MONGO_DB || 'network_topology';
 
 // Neo4j Configuration
 const neo4jUri = 'bolt://localhost:7687';
@@ -76,9 +78,9 @@ app.get('/api/topology-data', async (req, res) => {
 
     // Fetch port data from MongoDB
     await mongoClient.connect();
-    const db = mongoClient.db('network_scan');
-    const collection = db.collection('open_ports');
-    const portData = await collection.find({ ip: { $in: ips } }).toArray();
+    const db = mongoClient.db(mongoDbName);
+    const collection = db.collection('ports');
+    const portData = await collection.find({ ip_address: { $in: ips } }).toArray();
 
     // Combine data
     const topologyData = {
@@ -99,12 +101,12 @@ app.get('/api/topology-data', async (req, res) => {
     });
 
     portData.forEach(scanResult => {
-        const ipNode = ipNodeMap[scanResult.ip];
+        const ipNode = ipNodeMap[scanResult.ip_address];
         if (ipNode && scanResult.open_ports) {
             scanResult.open_ports.forEach(portInfo => {
-                const portNodeId = `${scanResult.ip}:${portInfo.port}`;
+                const portNodeId = `${scanResult.ip_address}:${portInfo.port}`;
                 topologyData.nodes.push({ id: portNodeId, type: 'service', label: `${portInfo.port}/${portInfo.service}`});
-                topologyData.links.push({ source: scanResult.ip, target: portNodeId });
+                topologyData.links.push({ source: scanResult.ip_address, target: portNodeId });
             });
         }
     });
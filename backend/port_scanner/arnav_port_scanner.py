@@ -1,63 +1,227 @@
 import os
-import socket
-from pymongo import MongoClient
-from neo4j import GraphDatabase
+import sys
+import time
+from pymongo import UpdateOne
 from dotenv import load_dotenv
+from async_scanner import AsyncPortScanner, COMMON_PORTS
+from fingerprint import Fingerprinter
+from delta_scan import (DEFAULT_HOST_TTL, DEFAULT_OPEN_PORT_TTL, diff_open_ports, fingerprint_changed,
+                        liveness_changed, merge_open_ports, plan_probes, port_set_signature)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from metrics import DB_SECONDS, ScanProfile, phase, profiling
+from storage import bulk_upsert_ports, close_all, get_neo4j_driver, get_ports_collection, port_fields
+from scan_history import ScanHistory
+from subnet_stats import SubnetStats
+from topology_version import bump_topology_version
 
 load_dotenv()
 
-class PortScanner:
-    def __init__(self, neo4j_uri, neo4j_user, neo4j_password, mongo_uri):
-        self.neo4j_driver = GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_password))
-        self.mongo_client = MongoClient(mongo_uri)
-        self.db = self.mongo_client.network_topology
+STATE_CHUNK_SIZE = 1000
+
+# ip.status belongs to discovery (used/available); the port scan only
+# records whether the host has anything open.
+HOST_PORTS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (ip:IP {address: row.address})
+    SET ip.has_open_ports = row.has_open_ports, ip.last_seen = row.last_seen
+"""
 
-    def close(self):
-        self.neo4j_driver.close()
-        self.mongo_client.close()
+IP_SUBNETS_QUERY = """
+    UNWIND $ips AS address
+    MATCH (ip:IP {address: address})-[:BELONGS_TO]->(s:Subnet)
+    RETURN ip.address AS ip, coalesce(s.address, s.network) AS subnet
+"""
+
+class PortScanner:
+    def __init__(self, neo4j_driver=None, ports_collection=None,
+                 max_concurrency=1000, per_host_limit=64, timeout=1.0, retries=1, max_rate=None,
+                 host_ttl=DEFAULT_HOST_TTL, open_port_ttl=DEFAULT_OPEN_PORT_TTL, stats=None, fingerprint=False,
+                 history=None):
+        self.neo4j_driver = neo4j_driver or get_neo4j_driver()
+        self.ports = ports_collection if ports_collection is not None else get_ports_collection()
+        self.stats = stats or SubnetStats(ports_collection=self.ports)
+        self.history = history or ScanHistory()
+        self.engine = AsyncPortScanner(max_concurrency=max_concurrency, per_host_limit=per_host_limit,
+                                       timeout=timeout, retries=retries, max_rate=max_rate,
+                                       fingerprinter=Fingerprinter() if fingerprint else None)
+        self.host_ttl = host_ttl
+        self.open_port_ttl = open_port_ttl
 
     def get_ips_from_neo4j(self):
         with self.neo4j_driver.session() as session:
             result = session.run("MATCH (i:IP) RETURN i.address AS ip")
             return [record["ip"] for record in result]
 
-    def scan_ports(self, ip_address):
-        open_ports = []
-        common_ports = {
-            21: "FTP", 22: "SSH", 23: "Telnet", 25: "SMTP", 53: "DNS",
-            80: "HTTP", 110: "POP3", 143: "IMAP", 443: "HTTPS", 3306: "MySQL",
-            3389: "RDP", 5900: "VNC"
-        }
-        for port, service in common_ports.items():
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(1)
-                result = sock.connect_ex((ip_address, port))
-                if result == 0:
-                    open_ports.append({"port": port, "service": service})
-        return open_ports
-
-    def store_port_scan_results(self, ip_address, open_ports):
-        self.db.ports.update_one(
-            {"ip_address": ip_address},
-            {"$set": {"open_ports": open_ports}},
-            upsert=True
-        )
-
-    def run_scan(self):
-        ips = self.get_ips_from_neo4j()
-        for ip in ips:
-            open_ports = self.scan_ports(ip)
+    def scan_ports(self, ip_address, ports=None):
+        ports = ports or COMMON_PORTS.keys()
+        return self.engine.run([ip_address], ports)[ip_address]
+
+    def get_ip_subnets(self, ips):
+        # Maps each ip to the address of the Subnet it belongs to, for the per-subnet stats.
+        subnets = {}
+        with self.neo4j_driver.session() as session:
+            for i in range(0, len(ips), STATE_CHUNK_SIZE):
+                result = session.run(IP_SUBNETS_QUERY, ips=ips[i:i + STATE_CHUNK_SIZE])
+                subnets.update((record["ip"], record["subnet"]) for record in result)
+        return subnets
+
+    def load_scan_state(self, ips):
+        states = {}
+        for i in range(0, len(ips), STATE_CHUNK_SIZE):
+            with DB_SECONDS.time(db="mongo", operation="load_scan_state"):
+                for doc in self.ports.find({"ip_address": {"$in": ips[i:i + STATE_CHUNK_SIZE]}}):
+                    states[doc["ip_address"]] = doc
+        return states
+
+    def store_host_rows(self, rows):
+        # rows are {"address", "has_open_ports", "last_seen"} dicts for HOST_PORTS_QUERY.
+        if not rows:
+            return
+        with self.neo4j_driver.session() as session:
+            for i in range(0, len(rows), STATE_CHUNK_SIZE):
+                chunk = rows[i:i + STATE_CHUNK_SIZE]
+                with DB_SECONDS.time(db="neo4j", operation="host_ports"):
+                    session.execute_write(lambda tx: tx.run(HOST_PORTS_QUERY, rows=chunk).consume())
+
+    def run_scan(self, ports=None, ips=None, on_result=None, on_plan=None, incremental=False, bump_version=True,
+                 subnet=None, run_id=None):
+        # Returns True when stored results changed. Sharded callers pass
+        # bump_version=False and bump the topology version once themselves.
+        # subnet is the Subnet address all ips belong to; without it each
+        # ip's subnet is looked up in Neo4j. Port changes are recorded in
+        # run_id's history, or in a run of their own.
+        ips = ips if ips is not None else self.get_ips_from_neo4j()
+        ports = list(ports or COMMON_PORTS.keys())
+        subnets = {ip: subnet for ip in ips} if subnet is not None else self.get_ip_subnets(ips)
+        own_run = run_id is None
+        if own_run:
+            run_id = self.history.start_run(sorted(set(subnets.values()) - {None}), incremental)
+        if incremental:
+            changed = self._run_incremental_scan(ips, ports, on_result, on_plan, subnets, run_id)
+        else:
+            changed = self._run_full_scan(ips, ports, on_result, on_plan, subnets, run_id)
+        if own_run:
+            self.history.finish_run(run_id, hosts_scanned=len(ips))
+        if changed and bump_version:
+            with self.neo4j_driver.session() as session:
+                bump_topology_version(session)
+        return changed
+
+    def _run_full_scan(self, ips, ports, on_result, on_plan, subnets, run_id):
+        if on_plan:
+            on_plan({ip: ports for ip in ips})
+        # All hosts are swept in one pass; the engine caps global and per-host concurrency.
+        results = self.engine.run(ips, ports, on_result)
+        found = {ip: open_ports for ip, open_ports in results.items() if open_ports}
+        for ip, open_ports in found.items():
+            print(f"Found open ports on {ip}: {open_ports}")
+        # The documents being replaced are read first so stats and history move
+        # by the difference. Hosts whose ports all closed are cleared too.
+        with phase("port_scan.load_state"):
+            states = self.load_scan_state(list(results))
+        writes = dict(found)
+        writes.update((ip, []) for ip in results if ip not in found and states.get(ip, {}).get("open_ports"))
+        with phase("port_scan.store"):
+            bulk_upsert_ports(writes, self.ports, subnets)
+        with phase("port_scan.stats"):
+            self.stats.record_ports((states.get(ip), subnets.get(ip), open_ports)
+                                    for ip, open_ports in writes.items())
+        with phase("port_scan.history"):
+            self.history.record_ports(run_id, ((ip, subnets.get(ip), states.get(ip), open_ports)
+                                               for ip, open_ports in writes.items()))
+        # Every scanned host gets the same graph properties the incremental path keeps up to date.
+        now = time.time()
+        with phase("port_scan.hosts"):
+            self.store_host_rows([{"address": ip, "has_open_ports": ip in found,
+                                   "last_seen": now if ip in found else (states.get(ip) or {}).get("last_seen")}
+                                  for ip in results])
+        return True
+
+    def _run_incremental_scan(self, ips, ports, on_result, on_plan, subnets, run_id):
+        now = time.time()
+        with phase("port_scan.load_state"):
+            states = self.load_scan_state(ips)
+        plan, full = plan_probes(ips, ports, states, now, self.host_ttl, self.open_port_ttl)
+        print(f"Incremental scan: probing {len(plan)} of {len(ips)} hosts ({len(full)} full).")
+        if on_plan:
+            on_plan(plan)
+        results = self.engine.run_targets(plan, on_result)
+
+        # Hosts whose known-open ports stopped answering get a full look this run.
+        recheck = {ip: ports for ip in plan if ip not in full and liveness_changed(states.get(ip), results[ip])}
+        if recheck:
+            if on_plan:
+                on_plan(recheck)
+            results.update(self.engine.run_targets(recheck, on_result))
+            full.update(recheck)
+
+        with phase("port_scan.store"):
+            return self._store_deltas(plan, results, full, states, ports, now, subnets, run_id)
+
+    def _store_deltas(self, plan, results, full, states, ports, now, subnets, run_id):
+        signature = port_set_signature(ports)
+        writes = []
+        host_rows = []
+        stat_changes = []
+        written = []
+        # Unchanged hosts only need their probe timestamps moved forward; group
+        # them by the fields to set so each group is a single update_many.
+        touched = {}
+        for ip in plan:
+            state = states.get(ip)
+            open_ports = results[ip]
+            stamps = {"verified_at": now}
+            if ip in full:
+                stamps.update(checked_at=now, port_set=signature)
             if open_ports:
-                self.store_port_scan_results(ip, open_ports)
-                print(f"Found open ports on {ip}: {open_ports}")
+                stamps["last_seen"] = now
+
+            opened, closed = diff_open_ports(state, open_ports)
+            refingerprinted = fingerprint_changed(state, open_ports)
+            if state is not None and not opened and not closed and not refingerprinted:
+                touched.setdefault(tuple(sorted(stamps.items())), []).append(ip)
+                continue
+
+            merged = merge_open_ports(state, open_ports, now)
+            writes.append(UpdateOne(
+                {"ip_address": ip},
+                {"$set": port_fields(merged, subnets.get(ip), **stamps)},
+                upsert=True
+            ))
+            stat_changes.append((state, subnets.get(ip), merged))
+            written.append(ip)
+            if not opened and not closed:
+                # First sighting with nothing open: state only, not a topology change.
+                continue
+            was_up = bool(state and state.get("open_ports"))
+            if was_up != bool(open_ports):
+                host_rows.append({"address": ip, "has_open_ports": bool(open_ports),
+                                  "last_seen": stamps.get("last_seen", (state or {}).get("last_seen"))})
+            print(f"{ip}: opened {opened}, closed {closed}")
+
+        for stamps, group in touched.items():
+            with DB_SECONDS.time(db="mongo", operation="touch_hosts"):
+                self.ports.update_many({"ip_address": {"$in": group}}, {"$set": dict(stamps)})
+        if writes:
+            with DB_SECONDS.time(db="mongo", operation="write_deltas"):
+                self.ports.bulk_write(writes, ordered=False)
+            self.stats.record_ports(stat_changes)
+            self.history.record_ports(run_id, ((ip, subnet, state, merged)
+                                               for ip, (state, subnet, merged) in zip(written, stat_changes)))
+        self.store_host_rows(host_rows)
+
+        changed = sum(1 for ip in plan if any(diff_open_ports(states.get(ip), results[ip]))
+                      or fingerprint_changed(states.get(ip), results[ip]))
+        print(f"Incremental scan stored {changed} changed host(s).")
+        return changed > 0
 
 if __name__ == '__main__':
-    NEO4J_URI = os.getenv("NEO4J_URI")
-    NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-    NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
-    MONGO_URI = os.getenv("MONGO_URI")
-
-    port_scanner = PortScanner(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD, MONGO_URI)
-    port_scanner.run_scan()
-    port_scanner.close()
+    port_scanner = PortScanner(fingerprint="--fingerprint" in sys.argv[1:])
+    profile = ScanProfile() if "--profile" in sys.argv[1:] else None
+    with profiling(profile):
+        port_scanner.run_scan(incremental="--incremental" in sys.argv[1:])
+    if profile is not None:
+        print(profile.format())
+    close_all()
     print("Port scanning complete and data stored in MongoDB.")
\ No newline at end of file
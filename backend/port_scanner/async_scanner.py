@@ -0,0 +1,177 @@
+import asyncio
+import errno
+import os
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from metrics import PROBE_REPLIES, PROBE_SECONDS, PROBE_TIMEOUTS, PROBES_SENT, phase
+from rate_control import AdaptiveRateController, InFlightGate
+
+COMMON_PORTS = {
+    21: "FTP", 22: "SSH", 23: "Telnet", 25: "SMTP", 53: "DNS",
+    80: "HTTP", 110: "POP3", 143: "IMAP", 443: "HTTPS", 3306: "MySQL",
+    3389: "RDP", 5900: "VNC"
+}
+
+OPEN = "open"
+CLOSED = "closed"
+FILTERED = "filtered"
+
+# Errors that mean "something answered and said no" -- retrying won't help.
+_CLOSED_ERRNOS = {errno.ECONNREFUSED, errno.ECONNRESET}
+
+_service_cache = {}
+
+
+def service_name(port):
+    if port in COMMON_PORTS:
+        return COMMON_PORTS[port]
+    if port not in _service_cache:
+        try:
+            _service_cache[port] = socket.getservbyport(port, "tcp").upper()
+        except OSError:
+            _service_cache[port] = "Unknown"
+    return _service_cache[port]
+
+
+def _fd_budget(requested):
+    # Every in-flight connect holds a file descriptor, so keep the global cap
+    # below the soft RLIMIT_NOFILE (raising it to the hard limit if we can).
+    if resource is None:
+        return requested
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = requested + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return requested
+    return max(1, min(requested, soft - 64))
+
+
+class AsyncPortScanner:
+    def __init__(self, max_concurrency=1000, per_host_limit=64, timeout=1.0,
+                 retries=1, max_rate=None, rate_control=None, fingerprinter=None):
+        # max_concurrency caps the in-flight window and timeout only seeds the
+        # per-subnet RTT estimates; see AdaptiveRateController. With a
+        # fingerprinter, open ports are fingerprinted by its own workers while
+        # the sweep goes on.
+        self.fingerprinter = fingerprinter
+        fingerprint_fds = fingerprinter.workers if fingerprinter else 0
+        self.max_concurrency = max(1, _fd_budget(max_concurrency + fingerprint_fds) - fingerprint_fds)
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.rate_control = rate_control or AdaptiveRateController(
+            max_window=self.max_concurrency, max_rate=max_rate, initial_timeout=timeout)
+
+    async def _connect_once(self, ip, port, timeout):
+        loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout)
+            return OPEN
+        except asyncio.TimeoutError:
+            return FILTERED
+        except OSError as e:
+            return CLOSED if e.errno in _CLOSED_ERRNOS else FILTERED
+        finally:
+            sock.close()
+
+    async def probe(self, ip, port, gate=None):
+        gate = gate or InFlightGate(self.rate_control)
+        state = FILTERED
+        first_sent = None
+        for attempt in range(self.retries + 1):
+            # Filtered ports get longer looks in case the SYN or its answer was lost.
+            timeout = self.rate_control.timeout(ip) * 2 ** attempt
+            async with gate:
+                started = time.monotonic()
+                first_sent = first_sent or started
+                PROBES_SENT.inc(scanner="tcp")
+                state = await self._connect_once(ip, port, timeout)
+                rtt = time.monotonic() - started
+            if state != FILTERED:
+                PROBE_REPLIES.inc(scanner="tcp")
+                PROBE_SECONDS.observe(rtt, scanner="tcp")
+                self.rate_control.on_answer(ip, rtt, retransmit=attempt > 0, first_sent=first_sent)
+                return state
+            PROBE_TIMEOUTS.inc(scanner="tcp")
+            self.rate_control.on_timeout(ip)
+        return state
+
+    async def scan_targets(self, targets, on_result=None):
+        # targets maps ip -> ports to probe on that ip.
+        targets = {ip: list(ports) for ip, ports in targets.items()}
+        results = {ip: [] for ip in targets}
+        host_slots = {ip: asyncio.Semaphore(self.per_host_limit) for ip in targets}
+        total = sum(len(ports) for ports in targets.values())
+
+        # Port-major order spreads consecutive probes across hosts so the
+        # per-host cap rarely stalls a worker.
+        def interleave():
+            rounds = max((len(ports) for ports in targets.values()), default=0)
+            for i in range(rounds):
+                for ip, ports in targets.items():
+                    if i < len(ports):
+                        yield ip, ports[i]
+
+        queue = interleave()
+        gate = InFlightGate(self.rate_control)
+        fingerprints = asyncio.Queue() if self.fingerprinter else None
+
+        async def worker():
+            for ip, port in queue:
+                async with host_slots[ip]:
+                    state = await self.probe(ip, port, gate)
+                if state == OPEN:
+                    record = {"port": port, "service": service_name(port)}
+                    results[ip].append(record)
+                    if fingerprints is not None:
+                        fingerprints.put_nowait((ip, port, record))
+                if on_result:
+                    on_result(ip, port, state)
+
+        workers = min(self.max_concurrency, total) or 1
+        if fingerprints is None:
+            with phase("port_scan.connect"):
+                await asyncio.gather(*(worker() for _ in range(workers)))
+        else:
+            fingerprinting = asyncio.ensure_future(self.fingerprinter.run(fingerprints))
+            with phase("port_scan.connect"):
+                await asyncio.gather(*(worker() for _ in range(workers)))
+            for _ in range(self.fingerprinter.workers):
+                fingerprints.put_nowait(None)
+            # Only the fingerprints still outstanding once the sweep is done.
+            with phase("port_scan.fingerprint_tail"):
+                await fingerprinting
+
+        for open_ports in results.values():
+            open_ports.sort(key=lambda p: p["port"])
+        return results
+
+    async def scan_hosts(self, ips, ports, on_result=None):
+        ports = list(ports)
+        return await self.scan_targets({ip: ports for ip in ips}, on_result)
+
+    async def scan_host(self, ip, ports):
+        results = await self.scan_hosts([ip], ports)
+        return results[ip]
+
+    def run(self, ips, ports, on_result=None):
+        return asyncio.run(self.scan_hosts(ips, ports, on_result))
+
+    def run_targets(self, targets, on_result=None):
+        return asyncio.run(self.scan_targets(targets, on_result))
@@ -0,0 +1,71 @@
+import hashlib
+
+# A host gets a full re-probe once its last full probe is older than this.
+DEFAULT_HOST_TTL = 24 * 60 * 60
+# Known-open ports are re-verified more often; they double as the host's liveness check.
+DEFAULT_OPEN_PORT_TTL = 15 * 60
+
+
+def port_set_signature(ports):
+    # Changing the port list invalidates earlier "closed" results.
+    return hashlib.sha1(",".join(str(p) for p in sorted(set(ports))).encode()).hexdigest()[:16]
+
+
+def plan_probes(ips, ports, states, now, host_ttl=DEFAULT_HOST_TTL, open_port_ttl=DEFAULT_OPEN_PORT_TTL):
+    # Returns (plan, full): plan maps ip -> ports to probe this run, full is the
+    # set of ips that get every port. Fresh hosts are left out of the plan.
+    ports = list(ports)
+    signature = port_set_signature(ports)
+    plan = {}
+    full = set()
+    for ip in ips:
+        state = states.get(ip)
+        if (state is None or state.get("port_set") != signature
+                or now - state.get("checked_at", 0) >= host_ttl):
+            plan[ip] = ports
+            full.add(ip)
+        elif state.get("open_ports") and now - state.get("verified_at", 0) >= open_port_ttl:
+            plan[ip] = [p["port"] for p in state["open_ports"]]
+    return plan, full
+
+
+def liveness_changed(state, open_ports):
+    # A previously open port that stopped answering means the host changed;
+    # its cached "closed" results can't be trusted any more.
+    before = {p["port"] for p in (state or {}).get("open_ports", [])}
+    return bool(before - {p["port"] for p in open_ports})
+
+
+def merge_open_ports(state, open_ports, now):
+    # Keeps first_seen for ports that were already open, and their earlier
+    # fingerprint when this run didn't take a new one.
+    before = {p["port"]: p for p in (state or {}).get("open_ports", [])}
+    merged = []
+    for p in open_ports:
+        previous = before.get(p["port"], {})
+        if "fingerprint" not in p and "fingerprint" in previous:
+            p = dict(p, service=previous.get("service", p.get("service")), fingerprint=previous["fingerprint"])
+        merged.append(dict(p, first_seen=previous.get("first_seen", now)))
+    return merged
+
+
+def _stable_fingerprint(port):
+    # Banners, info strings and negotiated TLS parameters vary between probes
+    # of the same service; only these fields mean it actually changed.
+    fingerprint = port.get("fingerprint")
+    if fingerprint is None:
+        return None
+    tls = fingerprint.get("tls") or {}
+    return port.get("service"), fingerprint.get("product"), fingerprint.get("version"), tls.get("cert_sha256")
+
+
+def fingerprint_changed(state, open_ports):
+    # True when this run fingerprinted a port differently from what is stored.
+    before = {p["port"]: _stable_fingerprint(p) for p in (state or {}).get("open_ports", [])}
+    return any("fingerprint" in p and before.get(p["port"]) != _stable_fingerprint(p) for p in open_ports)
+
+
+def diff_open_ports(state, open_ports):
+    before = {p["port"] for p in (state or {}).get("open_ports", [])}
+    after = {p["port"] for p in open_ports}
+    return sorted(after - before), sorted(before - after)
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import re
+import os
+import ssl
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from metrics import FINGERPRINT_SECONDS
+
+# Service fingerprinting for ports the connect sweep found open. Each probe
+# opens its own connection, reads at most MAX_BANNER_BYTES and gives up after
+# PROBE_TIMEOUT seconds; a bounded pool of workers runs them alongside the
+# sweep, so slow services never hold connect slots.
+
+MAX_BANNER_BYTES = 1024
+PROBE_TIMEOUT = 3.0
+# Server-first protocols (SSH, SMTP, FTP, ...) greet within this long; a
+# silent port is then asked an HTTP question.
+GREETING_WAIT = 0.5
+DEFAULT_WORKERS = 64
+BANNER_CHARS = 160
+
+# Ports where the handshake comes before any banner.
+TLS_PORTS = {443, 465, 636, 853, 993, 995, 5986, 8443}
+TLS_RECORD_PREFIXES = (b"\x15\x03", b"\x16\x03")
+
+HTTP_PROBE = b"HEAD / HTTP/1.0\r\nUser-Agent: topology-scanner\r\nAccept: */*\r\n\r\n"
+
+# (service, literal prefix or None, pattern). Patterns are bytes regexes
+# anchored at the start of the banner; named groups product/version/info end
+# up in the port record. Signatures are only tried on banners that start
+# with their prefix's first PREFIX_KEY bytes; those without one are tried on
+# every banner. Within a group, earlier signatures win.
+SIGNATURES = [
+    ("SSH", b"SSH-", rb"SSH-(?P<info>[\d.]+)-(?P<product>OpenSSH)_(?P<version>[\w.]+)"),
+    ("SSH", b"SSH-", rb"SSH-(?P<info>[\d.]+)-(?P<product>dropbear)_(?P<version>[\w.]+)"),
+    ("SSH", b"SSH-", rb"SSH-(?P<info>[\d.]+)-(?P<product>[^\s_-]+)(?:[_-](?P<version>[^\s]+))?"),
+    ("SMTP", b"220", rb"220[ -](?P<info>\S+) ESMTP (?P<product>Postfix|Exim|Sendmail|Microsoft ESMTP MAIL Service)"
+                     rb"(?: (?P<version>[\d.]+))?"),
+    ("SMTP", b"220", rb"220[ -](?P<info>\S+) (?:E?SMTP)"),
+    ("FTP", b"220", rb"220[ -].*?(?P<product>vsFTPd|ProFTPD|Pure-FTPd|FileZilla Server)[ ]?(?P<version>[\d.]+\w*)?"),
+    ("FTP", b"220", rb"220[ -].*FTP"),
+    ("HTTP", b"HTTP/", rb"HTTP/(?P<info>\d(?:\.\d)?) \d{3}"),
+    ("POP3", b"+OK", rb"\+OK(?: (?P<product>Dovecot))?"),
+    ("IMAP", b"* OK", rb"\* OK(?: \[CAPABILITY [^\]]*\])?(?: (?P<product>Dovecot|Cyrus))?"),
+    ("VNC", b"RFB ", rb"RFB (?P<version>\d{3}\.\d{3})"),
+    ("MySQL", None, rb".{4}\x0a(?P<version>\d+\.\d+\.\d+[\w.-]*)\x00"),
+    ("Redis", b"-ERR", rb"-ERR (?:unknown command|wrong number)"),
+    ("Telnet", None, rb"\xff[\xfb-\xfe]"),
+]
+
+# Pulled from HTTP responses after the status line matched.
+HTTP_SERVER = re.compile(rb"\r\nServer:[ \t]*(?P<product>[^/\r\n ]+)(?:/(?P<version>[^\s\r\n]+))?", re.IGNORECASE)
+
+# The index is keyed on this many leading bytes.
+PREFIX_KEY = 3
+
+
+def _compile_bucket(entries):
+    # One alternation per bucket: a single regex pass finds which signature
+    # matched (via lastgroup) before its own pattern extracts the fields.
+    combined = b"|".join(b"(?P<s%d>%s)" % (i, re.sub(rb"\(\?P<\w+>", b"(?:", pattern))
+                         for i, (_, _, pattern, _) in enumerate(entries))
+    return re.compile(combined, re.DOTALL), entries
+
+
+class SignatureIndex:
+    def __init__(self, signatures=SIGNATURES):
+        buckets = {}
+        generic = []
+        for service, prefix, pattern in signatures:
+            entry = (service, prefix, pattern, re.compile(pattern, re.DOTALL))
+            if prefix is None:
+                generic.append(entry)
+            else:
+                buckets.setdefault(prefix[:PREFIX_KEY], []).append(entry)
+        self._buckets = {key: _compile_bucket(entries) for key, entries in buckets.items()}
+        self._generic = _compile_bucket(generic) if generic else None
+
+    def match(self, banner):
+        # Returns (service, fields) for the first matching signature, or None.
+        for bucket in (self._buckets.get(banner[:PREFIX_KEY]), self._generic):
+            if bucket is None:
+                continue
+            combined, entries = bucket
+            found = combined.match(banner)
+            if found is None:
+                continue
+            service, _, _, compiled = entries[int(found.lastgroup[1:])]
+            fields = {key: value.decode("utf-8", "replace")
+                      for key, value in compiled.match(banner).groupdict().items() if value}
+            return service, fields
+        return None
+
+
+DEFAULT_INDEX = SignatureIndex()
+
+
+def _printable(banner):
+    text = banner.decode("utf-8", "replace")
+    return "".join(ch if ch.isprintable() else " " for ch in text).strip()[:BANNER_CHARS]
+
+
+class Fingerprinter:
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=PROBE_TIMEOUT, max_bytes=MAX_BANNER_BYTES,
+                 greeting_wait=GREETING_WAIT, index=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.greeting_wait = min(greeting_wait, timeout)
+        self.index = index or DEFAULT_INDEX
+        self._tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # Identification only: any certificate is accepted and recorded.
+        self._tls_context.check_hostname = False
+        self._tls_context.verify_mode = ssl.CERT_NONE
+        self._tls_context.set_alpn_protocols(["http/1.1"])
+
+    async def _read(self, reader, wait):
+        # Reads until max_bytes, EOF or `wait` seconds without the limit being hit.
+        data = b""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while len(data) < self.max_bytes:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(self.max_bytes - len(data)), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data += chunk
+            # A complete line is enough for every greeting we match on.
+            if b"\n" in data and not data.startswith(b"HTTP/"):
+                break
+            if data.startswith(b"HTTP/") and b"\r\n\r\n" in data:
+                break
+        return data
+
+    async def _exchange(self, ip, port, tls=False):
+        # One connection: wait for a greeting, else send the HTTP probe.
+        # Returns (banner, tls details or None).
+        reader, writer = await asyncio.open_connection(
+            ip, port, ssl=self._tls_context if tls else None,
+            ssl_handshake_timeout=self.timeout if tls else None)
+        try:
+            details = self._tls_details(writer) if tls else None
+            banner = await self._read(reader, self.greeting_wait)
+            if not banner:
+                writer.write(HTTP_PROBE)
+                await writer.drain()
+                banner = await self._read(reader, self.timeout)
+            return banner, details
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _tls_details(writer):
+        tls = writer.get_extra_info("ssl_object")
+        details = {"version": tls.version(), "cipher": tls.cipher()[0]}
+        if tls.selected_alpn_protocol():
+            details["alpn"] = tls.selected_alpn_protocol()
+        certificate = tls.getpeercert(binary_form=True)
+        if certificate:
+            details["cert_sha256"] = hashlib.sha256(certificate).hexdigest()
+        return details
+
+    async def _fingerprint(self, ip, port):
+        tls = port in TLS_PORTS
+        banner, details = await self._exchange(ip, port, tls)
+        if not tls and banner.startswith(TLS_RECORD_PREFIXES):
+            # A TLS alert in answer to plain HTTP: the service wants a handshake.
+            banner, details = await self._exchange(ip, port, True)
+        return banner, details
+
+    async def fingerprint(self, ip, port):
+        # Returns the fields to merge into the port record; empty if nothing answered.
+        started = time.perf_counter()
+        fields = await self._identify(ip, port)
+        FINGERPRINT_SECONDS.observe(time.perf_counter() - started, service=fields.get("service", "none"))
+        return fields
+
+    async def _identify(self, ip, port):
+        try:
+            banner, details = await asyncio.wait_for(self._fingerprint(ip, port), self.timeout)
+        except (asyncio.TimeoutError, OSError, ssl.SSLError, EOFError):
+            return {}
+        fields = {}
+        match = self.index.match(banner) if banner else None
+        if match is not None:
+            service, found = match
+            if service == "HTTP":
+                server = HTTP_SERVER.search(banner)
+                if server:
+                    found.update({key: value.decode("utf-8", "replace")
+                                  for key, value in server.groupdict().items() if value})
+                if details is not None:
+                    service = "HTTPS"
+            fields["service"] = service
+            fields["fingerprint"] = found
+        else:
+            fields["fingerprint"] = {}
+        if details is not None:
+            fields["fingerprint"]["tls"] = details
+            fields.setdefault("service", "TLS")
+        if banner:
+            fields["fingerprint"]["banner"] = _printable(banner)
+        if not fields["fingerprint"]:
+            return {}
+        return fields
+
+    async def run(self, queue):
+        # Worker pool over a queue of (ip, port, record) items; each record is
+        # updated in place. A None item stops one worker.
+        async def worker():
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    ip, port, record = item
+                    record.update(await self.fingerprint(ip, port))
+                finally:
+                    queue.task_done()
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
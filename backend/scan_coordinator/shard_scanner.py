@@ -0,0 +1,253 @@
+import argparse
+import os
+import socket
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ipaddress import ip_network
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "subnet_discovery"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "port_scanner"))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "common"))
+
+from arnav_port_scanner import PortScanner
+from himanshu_subnet_discovery import SubnetDiscovery
+from icmp_sweep import IcmpSweeper
+from liveness import LivenessSet
+from metrics import ScanProfile, phase, profiling
+from scan_history import ScanHistory
+from storage import close_all, get_database, get_neo4j_driver
+from topology_version import bump_topology_version
+
+load_dotenv()
+
+DEFAULT_SHARD_PREFIX = 24
+SHARD_COLLECTION = "scan_shards"
+# A claimed shard whose worker hasn't finished within the lease goes back to the queue.
+DEFAULT_LEASE_SECONDS = 15 * 60
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+def split_network(network, shard_prefix=DEFAULT_SHARD_PREFIX):
+    network = ip_network(network, strict=False)
+    if network.prefixlen >= shard_prefix:
+        return [network]
+    return list(network.subnets(new_prefix=shard_prefix))
+
+
+def parse_ports(spec):
+    if not spec:
+        return None
+    ports = []
+    for part in spec.split(","):
+        start, _, end = part.partition("-")
+        ports.extend(range(int(start), int(end or start) + 1))
+    return ports
+
+
+def scan_shard(parent, shard, incremental=False, ports=None, concurrency=1000, run_id=None, profile=False):
+    # Runs inside a worker process: sweep the shard's slice of parent.hosts(),
+    # store its live IPs and free ranges under the parent subnet's node, then
+    # port-scan the live hosts. Each process gets its own pooled clients.
+    started = time.monotonic()
+    profile = ScanProfile() if profile else None
+    with profiling(profile):
+        with phase("discovery.sweep"):
+            liveness = IcmpSweeper().sweep_network(LivenessSet(shard, parent))
+        discovered = SubnetDiscovery().store_liveness(liveness, incremental, run_id)
+        scanner = PortScanner(max_concurrency=concurrency)
+        with phase("port_scan"):
+            changed = scanner.run_scan(ports=ports, ips=[str(ip) for ip in liveness], incremental=incremental,
+                                       bump_version=False, subnet=str(liveness.parent.network_address),
+                                       run_id=run_id)
+    summary = {"shard": str(liveness.network), "hosts": liveness.host_count, "live": len(liveness),
+               "changed": bool(discovered or changed), "seconds": round(time.monotonic() - started, 2)}
+    if profile is not None:
+        summary["profile"] = profile.report()
+    return summary
+
+
+def _print_summary(summary):
+    print(f"Shard {summary['shard']}: {summary['live']}/{summary['hosts']} hosts up in {summary['seconds']}s")
+    for row in summary.get("profile", {}).get("phases", []):
+        print(f"    {row['phase']:<28}{row['calls']:>7}{row['seconds']:>11}")
+
+
+def _publish():
+    with get_neo4j_driver().session() as session:
+        return bump_topology_version(session)
+
+
+def scan_local(ranges, shard_prefix=DEFAULT_SHARD_PREFIX, processes=None, incremental=False, ports=None,
+               total_concurrency=2000, profile=False):
+    # Farms sub-blocks of every range out to a process pool on this machine.
+    processes = processes or os.cpu_count() or 1
+    per_process = max(64, total_concurrency // processes)
+    discovery = SubnetDiscovery()
+    shards = []
+    for cidr in ranges:
+        network = ip_network(cidr, strict=False)
+        discovery.prepare_subnet(network, incremental)
+        shards.extend((str(network), str(shard)) for shard in split_network(network, shard_prefix))
+    history = ScanHistory()
+    run_id = history.start_run(sorted({str(ip_network(parent).network_address) for parent, _ in shards}),
+                               incremental)
+    # Drop the parent's clients; forked workers must not share its sockets.
+    close_all()
+
+    print(f"Scanning {len(shards)} shard(s) across {processes} process(es)...")
+    summaries = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(scan_shard, parent, shard, incremental, ports, per_process, run_id, profile): shard
+                   for parent, shard in shards}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"Shard {futures[future]} failed: {e}", file=sys.stderr)
+                continue
+            summaries.append(summary)
+            _print_summary(summary)
+
+    ScanHistory().finish_run(run_id, shards=len(shards), hosts_up=sum(summary["live"] for summary in summaries))
+    _publish()
+    return summaries
+
+
+def shard_queue():
+    collection = get_database()[SHARD_COLLECTION]
+    collection.create_index([("status", 1), ("claimed_at", 1)])
+    collection.create_index("run_id")
+    return collection
+
+
+def enqueue(ranges, shard_prefix=DEFAULT_SHARD_PREFIX, incremental=False, ports=None):
+    # Coordinator side of the distributed mode: prepares the subnets once and
+    # queues one document per shard for any number of `worker` processes.
+    run_id = uuid.uuid4().hex
+    discovery = SubnetDiscovery()
+    docs = []
+    for cidr in ranges:
+        network = ip_network(cidr, strict=False)
+        discovery.prepare_subnet(network, incremental)
+        for shard in split_network(network, shard_prefix):
+            docs.append({"_id": f"{run_id}:{shard}", "run_id": run_id, "parent": str(network),
+                         "shard": str(shard), "incremental": incremental, "ports": ports,
+                         "status": PENDING, "attempts": 0, "claimed_at": None, "claimed_by": None})
+    if docs:
+        ScanHistory().start_run(sorted({str(ip_network(doc["parent"]).network_address) for doc in docs}),
+                                incremental, run_id)
+        shard_queue().insert_many(docs, ordered=False)
+    print(f"Queued {len(docs)} shard(s) for run {run_id}.")
+    return run_id
+
+
+def claim_shard(queue, worker_id, lease=DEFAULT_LEASE_SECONDS):
+    now = time.time()
+    # Shards whose last allowed attempt timed out are given up on.
+    queue.update_many({"status": CLAIMED, "claimed_at": {"$lt": now - lease}, "attempts": {"$gte": MAX_ATTEMPTS}},
+                      {"$set": {"status": FAILED, "error": "lease expired"}})
+    return queue.find_one_and_update(
+        {"$or": [{"status": PENDING},
+                 {"status": CLAIMED, "claimed_at": {"$lt": now - lease}, "attempts": {"$lt": MAX_ATTEMPTS}}]},
+        {"$set": {"status": CLAIMED, "claimed_at": now, "claimed_by": worker_id}, "$inc": {"attempts": 1}},
+        sort=[("claimed_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def run_worker(follow=False, poll_interval=5.0, concurrency=1000, profile=False):
+    # Pulls shards until the queue is empty (or forever with follow=True).
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    queue = shard_queue()
+    finished_runs = set()
+    while True:
+        doc = claim_shard(queue, worker_id)
+        if doc is None:
+            if not follow:
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            summary = scan_shard(doc["parent"], doc["shard"], doc["incremental"], doc["ports"], concurrency,
+                                 doc["run_id"], profile)
+        except Exception as e:
+            status = FAILED if doc["attempts"] >= MAX_ATTEMPTS else PENDING
+            queue.update_one({"_id": doc["_id"]}, {"$set": {"status": status, "error": str(e)}})
+            print(f"Shard {doc['shard']} failed: {e}", file=sys.stderr)
+            continue
+        queue.update_one({"_id": doc["_id"]}, {"$set": {"status": DONE, "result": summary,
+                                                        "finished_at": time.time()}})
+        _print_summary(summary)
+        if not queue.count_documents({"run_id": doc["run_id"], "status": {"$in": [PENDING, CLAIMED]}}, limit=1):
+            finished_runs.add(doc["run_id"])
+            ScanHistory().finish_run(doc["run_id"])
+            _publish()
+    return finished_runs
+
+
+def wait_for_run(run_id, poll_interval=5.0):
+    queue = shard_queue()
+    while queue.count_documents({"run_id": run_id, "status": {"$in": [PENDING, CLAIMED]}}, limit=1):
+        time.sleep(poll_interval)
+    failed = queue.count_documents({"run_id": run_id, "status": FAILED})
+    print(f"Run {run_id} finished with {failed} failed shard(s).")
+
+
+def _worker_process(follow, concurrency, profile):
+    run_worker(follow=follow, concurrency=concurrency, profile=profile)
+    close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded subnet discovery and port scanning.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("local", "enqueue"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("ranges", nargs="+", help="CIDR ranges to scan")
+        cmd.add_argument("--shard-prefix", type=int, default=DEFAULT_SHARD_PREFIX)
+        cmd.add_argument("--incremental", action="store_true")
+        cmd.add_argument("--ports", help="e.g. 22,80,443 or 1-1024 (default: common ports)")
+    sub.choices["local"].add_argument("--processes", type=int, default=None)
+    sub.choices["local"].add_argument("--profile", action="store_true", help="report time spent per scan phase")
+    sub.choices["enqueue"].add_argument("--wait", action="store_true")
+
+    worker = sub.add_parser("worker")
+    worker.add_argument("--processes", type=int, default=1)
+    worker.add_argument("--follow", action="store_true", help="keep polling for new shards")
+    worker.add_argument("--concurrency", type=int, default=1000, help="connects in flight per process")
+    worker.add_argument("--profile", action="store_true", help="report time spent per scan phase")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "local":
+            scan_local(args.ranges, args.shard_prefix, args.processes, args.incremental, parse_ports(args.ports),
+                       profile=args.profile)
+        elif args.command == "enqueue":
+            run_id = enqueue(args.ranges, args.shard_prefix, args.incremental, parse_ports(args.ports))
+            if args.wait:
+                wait_for_run(run_id)
+        elif args.processes > 1:
+            close_all()
+            with ProcessPoolExecutor(max_workers=args.processes) as pool:
+                for future in [pool.submit(_worker_process, args.follow, args.concurrency, args.profile)
+                               for _ in range(args.processes)]:
+                    future.result()
+        else:
+            run_worker(follow=args.follow, concurrency=args.concurrency, profile=args.profile)
+    finally:
+        close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
-import socket
-from neo4j import GraphDatabase
-from pymongo import MongoClient
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "port_scanner"))
+from async_scanner import AsyncPortScanner
+from fingerprint import Fingerprinter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from storage import bulk_upsert_ports, close_all, configure, get_neo4j_driver, get_ports_collection
+from scan_history import ScanHistory
+from subnet_stats import SubnetStats
+from topology_version import bump_topology_version
 
 # --- Neo4j Configuration ---
 NEO4J_URI = "bolt://localhost:7687"
@@ -10,47 +19,60 @@ NEO4J_PASSWORD = "Himanshu@07"  # ✅ Your actual password
 # --- MongoDB Configuration ---
 MONGO_URI = "mongodb://localhost:27017"
 
-# --- Get IPs from Neo4j ---
+configure(neo4j_uri=NEO4J_URI, neo4j_user=NEO4J_USER, neo4j_password=NEO4J_PASSWORD, mongo_uri=MONGO_URI)
+
+# --- Get IPs (and the subnet each belongs to) from Neo4j ---
 def get_discovered_ips():
-    driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
-    ips = []
-    with driver.session() as session:
-        result = session.run("MATCH (ip:IP) RETURN ip.address AS address")
-        ips = [record["address"] for record in result]
-    driver.close()
-    return ips
-
-# --- Scan open ports on an IP ---
-def scan_ports(ip, ports_to_check):
-    open_ports = []
-    for port in ports_to_check:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(0.5)
-            try:
-                s.connect((ip, port))
-                open_ports.append(port)
-            except:
-                continue
-    return open_ports
-
-# --- Save result to MongoDB ---
-def save_scan_result(ip, open_ports, uri=MONGO_URI):
-    client = MongoClient(uri)
-    db = client["network_scan"]
-    collection = db["open_ports"]
-    collection.update_one({"ip": ip}, {"$set": {"open_ports": open_ports}}, upsert=True)
-    print(f"✅ Stored scan results for {ip}")
+    with get_neo4j_driver().session() as session:
+        result = session.run("""
+            MATCH (ip:IP)
+            OPTIONAL MATCH (ip)-[:BELONGS_TO]->(s:Subnet)
+            RETURN ip.address AS address, coalesce(s.address, s.network) AS subnet
+        """)
+        return {record["address"]: record["subnet"] for record in result}
+
+# --- Scan open ports on a batch of IPs concurrently ---
+# Timeouts adapt to the measured RTT; max_rate caps packets per second.
+# fingerprint adds banner grabs and protocol probes on the open ports.
+def scan_ports(ips, ports_to_check, max_rate=None, fingerprint=False):
+    scanner = AsyncPortScanner(max_rate=max_rate, fingerprinter=Fingerprinter() if fingerprint else None)
+    return scanner.run(ips, ports_to_check)
+
+# --- Save results to MongoDB in bulk ---
+def save_scan_results(results, subnets):
+    # Read the documents being replaced so the subnet stats move by the difference.
+    collection = get_ports_collection()
+    ips = list(results)
+    states = {}
+    for i in range(0, len(ips), 1000):
+        for doc in collection.find({"ip_address": {"$in": ips[i:i + 1000]}}, {"open_ports": 1, "subnet": 1,
+                                                                             "ip_address": 1}):
+            states[doc["ip_address"]] = doc
+    stored = bulk_upsert_ports(results, collection, subnets)
+    SubnetStats(ports_collection=collection).record_ports(
+        (states.get(ip), subnets.get(ip), open_ports) for ip, open_ports in results.items())
+    history = ScanHistory()
+    run_id = history.start_run(sorted({subnet for subnet in subnets.values() if subnet}))
+    history.record_ports(run_id, ((ip, subnets.get(ip), states.get(ip), open_ports)
+                                  for ip, open_ports in results.items()))
+    history.finish_run(run_id, hosts_scanned=len(results))
+    print(f"✅ Stored scan results for {stored} hosts")
 
 # --- Main script ---
 if __name__ == "__main__":
-    ips = get_discovered_ips()
+    subnets = get_discovered_ips()
+    ips = list(subnets)
     ports_to_scan = list(range(1, 1025))
 
 
-    for ip in ips:
-        print(f"🔍 Scanning {ip}...")
-        open_ports = scan_ports(ip, ports_to_scan)
-        print(f"✅ Open ports on {ip}: {open_ports}")
-        save_scan_result(ip, open_ports)
+    print(f"🔍 Scanning {len(ips)} hosts...")
+    results = scan_ports(ips, ports_to_scan, fingerprint="--fingerprint" in sys.argv[1:])
+    for ip, open_ports in results.items():
+        print(f"✅ Open ports on {ip}: {[(p['port'], p['service']) for p in open_ports]}")
+    save_scan_results(results, subnets)
+
+    with get_neo4j_driver().session() as session:
+        bump_topology_version(session)
+    close_all()
 
     print("🎉 Scanning complete. Results saved to MongoDB.")
@@ -1,28 +1,48 @@
+import os
 import socket
 import ipaddress
-import subprocess
-import platform
 import psutil
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from neo4j import GraphDatabase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "subnet_discovery"))
+from icmp_sweep import IcmpSweeper
+from neo4j_ingest import (delete_ips, delete_subnet_ranges, ensure_schema, host_row, ingest_hosts, ingest_ranges,
+                          subnet_ip_addresses)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from liveness import LivenessSet
+from storage import close_all, configure, get_neo4j_driver
+from subnet_stats import SubnetStats
+from topology_version import bump_topology_version
 
 # Neo4j Configuration
 NEO4J_URI = "bolt://localhost:7687"
 NEO4J_USER = "neo4j"
 NEO4J_PASSWORD = "Himanshu@07"  # <<< Replace with your Neo4j password
 
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+# MongoDB Configuration (subnet counters for the summary endpoint)
+MONGO_URI = "mongodb://localhost:27017"
 
-def get_local_ip_and_netmask():
-    interfaces = psutil.net_if_addrs()
-    for interface in interfaces.values():
+configure(neo4j_uri=NEO4J_URI, neo4j_user=NEO4J_USER, neo4j_password=NEO4J_PASSWORD, mongo_uri=MONGO_URI)
+driver = get_neo4j_driver()
+
+def get_local_networks():
+    # (ip, netmask) for every IPv4 interface on a real network, one per subnet.
+    found = {}
+    for interface in psutil.net_if_addrs().values():
         for addr in interface:
             if addr.family == socket.AF_INET:
                 ip = addr.address
                 if not ip.startswith("127.") and not ip.startswith("169.254."):
-                    return ip, addr.netmask
+                    found.setdefault(get_subnet(ip, addr.netmask), (ip, addr.netmask))
+    return list(found.values())
+
+def get_local_ip_and_netmask():
+    networks = get_local_networks()
+    if networks:
+        return networks[0]
 
+    interfaces = psutil.net_if_addrs()
     for interface in interfaces.values():
         for addr in interface:
             if addr.family == socket.AF_INET and addr.address.startswith("169.254."):
@@ -36,37 +56,28 @@ def get_local_ip_and_netmask():
 def get_subnet(ip, netmask):
     return ipaddress.IPv4Network(f"{ip}/{netmask}", strict=False)
 
-def ping_ip(ip):
-    param = '-n' if platform.system().lower() == 'windows' else '-c'
-    command = ['ping', param, '1', '-w', '500', str(ip)] if platform.system().lower() == 'windows' \
-              else ['ping', param, '1', '-W', '1', str(ip)]
-    try:
-        subprocess.check_output(command, stderr=subprocess.DEVNULL)
-        return str(ip), True
-    except subprocess.CalledProcessError:
-        return str(ip), False
-
-def discover_hosts_parallel(subnet, max_workers=100):
-    used_ips = []
-    available_ips = []
-
-    print(f"[*] Scanning {len(list(subnet.hosts()))} IPs in parallel...\n")
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(ping_ip, ip): ip for ip in subnet.hosts()}
-
-        for future in as_completed(futures):
-            ip_str, is_up = future.result()
-            if is_up:
-                used_ips.append(ip_str)
-                print(f"[+] Host {ip_str} is UP")
-            else:
-                available_ips.append(ip_str)
-                print(f"[-] Host {ip_str} is DOWN")
-
-    return used_ips, available_ips
-
-def store_in_neo4j(local_ip, netmask, subnet, used_ips, available_ips, available_percentage):
+def ping_ip(ip, timeout=1.0):
+    is_up = str(ip) in IcmpSweeper(timeout=timeout).sweep([ip])
+    return str(ip), is_up
+
+def discover_hosts_parallel(subnet, rate=5000, timeout=1.0, retries=1):
+    # Returns a LivenessSet: a bitmap of live hosts, with free space as ranges.
+    liveness = LivenessSet(subnet)
+    print(f"[*] Scanning {liveness.host_count} IPs in parallel...\n")
+
+    # One ICMP socket for the whole subnet instead of a ping process per address.
+    sweeper = IcmpSweeper(rate=rate, timeout=timeout, retries=retries)
+    sweeper.sweep_network(liveness)
+    if sweeper.mode is None:
+        print("[!] No ICMP socket available (needs root or ping_group_range); used TCP/ARP probes.")
+
+    for ip in liveness:
+        print(f"[+] Host {ip} is UP")
+
+    return liveness
+
+def store_in_neo4j(local_ip, netmask, subnet, liveness, available_percentage):
+    ensure_schema(driver)
     with driver.session() as session:
         # Store subnet node with statistics
         session.execute_write(lambda tx: tx.run("""
@@ -80,68 +91,68 @@ def store_in_neo4j(local_ip, netmask, subnet, used_ips, available_ips, available
         """, cidr=subnet.with_prefixlen,
              netmask=netmask,
              network=str(subnet.network_address),
-             total=len(list(subnet.hosts())),
-             used=len(used_ips),
-             available=len(available_ips),
+             total=liveness.host_count,
+             used=len(liveness),
+             available=liveness.free_count,
              available_pct=round(available_percentage, 2)))
 
         # Store used IPs with host/interface nodes
-        for ip in used_ips:
-            interface_type = "primary" if ip == local_ip else "secondary"
-            host_name = f"host-{ip.replace('.', '-')}"
-            interface_name = f"{host_name}-{interface_type}"
-
-            session.execute_write(lambda tx: tx.run("""
-                MERGE (h:Host {name: $host})
-                MERGE (i:Interface {name: $interface})
-                SET i.type = $type
-                MERGE (h)-[:HAS_INTERFACE]->(i)
-                MERGE (ip:IP {address: $ip})
-                SET ip.status = "used"
-                MERGE (i)-[:HAS_IP]->(ip)
-                MERGE (s:Subnet {cidr: $cidr})
-                MERGE (ip)-[:BELONGS_TO]->(s)
-            """, host=host_name, interface=interface_name, type=interface_type,
-                 ip=ip, cidr=subnet.with_prefixlen))
-
-        # Store available IPs as nodes
-        for ip in available_ips:
-            session.execute_write(lambda tx: tx.run("""
-                MERGE (ip:IP {address: $ip})
-                SET ip.status = "available"
-                MERGE (s:Subnet {cidr: $cidr})
-                MERGE (ip)-[:BELONGS_TO]->(s)
-            """, ip=ip, cidr=subnet.with_prefixlen))
+        def used_rows():
+            for ip in map(str, liveness):
+                interface_type = "primary" if ip == local_ip else "secondary"
+                host_name = f"host-{ip.replace('.', '-')}"
+                yield host_row(ip, host_name, f"{host_name}-{interface_type}", interface_type, status="used")
 
-if __name__ == "__main__":
-    print("[*] Discovering local IP and subnet mask...")
-    local_ip, netmask = get_local_ip_and_netmask()
-    subnet = get_subnet(local_ip, netmask)
-    print(f"[*] Local IP: {local_ip}")
-    print(f"[*] Subnet Mask: {netmask}")
-    print(f"[*] Subnet: {subnet}\n")
-
-    used_ips, available_ips = discover_hosts_parallel(subnet)
+        # Drop IPs that stopped answering, so the graph agrees with used_ips.
+        silent = [ip for ip in subnet_ip_addresses(session, subnet.with_prefixlen, subnet_key="cidr")
+                  if ip not in liveness]
+        if silent:
+            delete_ips(session, silent)
+            print(f"Removed {len(silent)} IP(s) that no longer answer in {subnet}.")
 
-    total_ips = len(list(subnet.hosts()))
-    num_available = len(available_ips)
-    available_percentage = (num_available / total_ips) * 100 if total_ips > 0 else 0
+        ingest_hosts(session, subnet.with_prefixlen, used_rows())
 
-    print("\n================== RESULTS ==================")
-    print(f"Subnet: {subnet}")
-    print(f"Total Usable IPs: {total_ips}")
+        # Store available space as address ranges rather than one node per free IP
+        delete_subnet_ranges(session, subnet.with_prefixlen, subnet_key="cidr")
+        ingest_ranges(session, subnet.with_prefixlen, liveness.range_rows(liveness.free_ranges()),
+                      subnet_key="cidr")
 
-    print(f"\nUsed IPs (alive): {len(used_ips)}")
-    for ip in used_ips:
-        print(f" - {ip}")
+        bump_topology_version(session)
 
-    print(f"\nAvailable IPs (no response): {num_available}")
-    for ip in available_ips:
-        print(f" - {ip}")
+    # Counters for the topology summary endpoint.
+    SubnetStats().set_hosts(str(subnet.network_address), subnet.with_prefixlen, liveness.host_count, len(liveness))
 
-    print(f"\nPercentage of Available IPs: {available_percentage:.2f}%")
-
-    # Store results in Neo4j
-    print("\n[*] Storing results in Neo4j...")
-    store_in_neo4j(local_ip, netmask, subnet, used_ips, available_ips, available_percentage)
+if __name__ == "__main__":
+    print("[*] Discovering local networks...")
+    networks = get_local_networks() or [get_local_ip_and_netmask()]
+    for local_ip, netmask in networks:
+        subnet = get_subnet(local_ip, netmask)
+        print(f"[*] Local IP: {local_ip}")
+        print(f"[*] Subnet Mask: {netmask}")
+        print(f"[*] Subnet: {subnet}\n")
+
+        liveness = discover_hosts_parallel(subnet)
+
+        total_ips = liveness.host_count
+        num_available = liveness.free_count
+        available_percentage = (num_available / total_ips) * 100 if total_ips > 0 else 0
+
+        print("\n================== RESULTS ==================")
+        print(f"Subnet: {subnet}")
+        print(f"Total Usable IPs: {total_ips}")
+
+        print(f"\nUsed IPs (alive): {len(liveness)}")
+        for ip in liveness:
+            print(f" - {ip}")
+
+        print(f"\nAvailable IPs (no response): {num_available}")
+        for row in liveness.range_rows(liveness.free_ranges()):
+            print(f" - {row['start']}" if row["size"] == 1 else f" - {row['start']} - {row['end']} ({row['size']} IPs)")
+
+        print(f"\nPercentage of Available IPs: {available_percentage:.2f}%")
+
+        # Store results in Neo4j
+        print("\n[*] Storing results in Neo4j...")
+        store_in_neo4j(local_ip, netmask, subnet, liveness, available_percentage)
+    close_all()
     print("[*] Data stored in Neo4j successfully.")
@@ -1,69 +1,294 @@
+import argparse
 import os
 import sys
-from ipaddress import ip_network
-from neo4j import GraphDatabase
+from ipaddress import ip_address, ip_network
 from dotenv import load_dotenv
+from icmp_sweep import IcmpSweeper
+from neo4j_ingest import (DEFAULT_BATCH_SIZE, chunked, delete_ips, delete_subnet_ips, delete_subnet_ranges,
+                          ensure_schema, existing_subnet_ips, ingest_ips, ingest_ranges, ip_row,
+                          subnet_ip_addresses, subnet_ranges)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from liveness import MAX_ADDRESSES, LivenessSet, host_count, range_row
+from metrics import phase
+from scan_history import ScanHistory
+from storage import bulk_upsert_ports, close_all, get_neo4j_driver, get_ports_collection
+from subnet_stats import SubnetStats
+from target_planner import TargetPlan, local_networks, neighbour_addresses, read_hints
+from topology_version import bump_topology_version
 
 load_dotenv()
 
+def _outside_ranges(ranges, lo, hi):
+    # Offsets in [lo, hi] not covered by any of the (start, end) ranges.
+    position = lo
+    for start, end in sorted(ranges):
+        if start > position:
+            yield from range(position, min(start, hi + 1))
+        position = max(position, end + 1)
+        if position > hi:
+            return
+    yield from range(position, hi + 1)
+
 class SubnetDiscovery:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(self, driver=None, batch_size=DEFAULT_BATCH_SIZE, stats=None, history=None, ports_collection=None):
+        self.driver = driver or get_neo4j_driver()
+        self.batch_size = batch_size
+        self.stats = stats or SubnetStats()
+        self._history = history
+        self._ports = ports_collection
 
-    def close(self):
-        self.driver.close()
+    @property
+    def ports(self):
+        if self._ports is None:
+            self._ports = get_ports_collection()
+        return self._ports
 
-    def discover_and_store_subnet(self, ip_range):
-        with self.driver.session() as session:
-            # Use execute_write for modern py-driver compatibility
-            session.execute_write(self._create_subnet_and_ips, ip_range)
+    @property
+    def history(self):
+        if self._history is None:
+            self._history = ScanHistory()
+        return self._history
 
-    @staticmethod
-    def _create_subnet_and_ips(tx, ip_range):
+    def discover_and_store_subnet(self, ip_range, incremental=False, sweeper=None, run_id=None, checkpoint=None):
+        # Returns the LivenessSet so callers can port-scan just the live hosts.
+        # Without a run_id the discovery is recorded in history as a run of its own.
+        # checkpoint() runs before each step that rewrites the subnet and may raise to stop there.
         network = ip_network(ip_range, strict=False) # Use strict=False to allow host bits in network address
+        own_run = run_id is None
+        if own_run:
+            run_id = self.history.start_run([str(network.network_address)], incremental)
+        with phase("discovery.sweep"):
+            liveness = (sweeper or IcmpSweeper()).sweep_network(LivenessSet(network))
+        print(f"{len(liveness)} of {liveness.host_count} host(s) in {network} are up.")
+        if checkpoint:
+            checkpoint()
+        with phase("discovery.prepare"):
+            changed = self.prepare_subnet(network, incremental, run_id)
+        if checkpoint:
+            checkpoint()
+        changed = self.store_liveness(liveness, incremental, run_id) or changed
+        if changed:
+            with self.driver.session() as session:
+                bump_topology_version(session)
+        if own_run:
+            self.history.finish_run(run_id, hosts_up=len(liveness))
+        return liveness
+
+    def discover_targets(self, plan, incremental=False, sweeper=None, run_id=None):
+        # One sweep over every site of a TargetPlan, then per-site storage.
+        # Sites the plan only partly covers (exclusions, ranges, candidates)
+        # are stored incrementally and block by block, so addresses that
+        # weren't probed keep what was stored for them. Returns the live
+        # addresses.
+        print(f"Sweeping {plan.describe()}.")
+        own_run = run_id is None
+        if own_run:
+            run_id = self.history.start_run([str(site.network_address) for site in plan.sites], incremental)
+        with phase("discovery.sweep"):
+            alive = (sweeper or IcmpSweeper()).sweep_targets(plan)
+        print(f"{len(alive)} of {len(plan)} target(s) are up.")
+
+        by_site = {}
+        for addr in alive:
+            by_site.setdefault(plan.site_of(addr), []).append(addr)
+        changed = False
+        for site in plan.sites:
+            if site.num_addresses > MAX_ADDRESSES or plan.is_sparse(site):
+                changed = self.store_candidates(site, plan.addresses_in(site), by_site.get(site, []),
+                                                run_id) or changed
+                continue
+            covered = plan.covers(site)
+            with phase("discovery.prepare"):
+                changed = self.prepare_subnet(site, incremental or not covered, run_id) or changed
+            for block in ([site] if covered else plan.blocks(site)):
+                liveness = LivenessSet(block, site)
+                liveness.update(by_site.get(site, []))
+                changed = self.store_liveness(liveness, incremental or not covered, run_id) or changed
+        if changed:
+            with self.driver.session() as session:
+                bump_topology_version(session)
+        if own_run:
+            self.history.finish_run(run_id, hosts_up=len(alive))
+        return alive
+
+    def store_candidates(self, network, candidates, alive, run_id=None):
+        # For IPv6 networks too large for a bitmap, only probed candidates
+        # are known: live ones become IP nodes, stored ones that went quiet
+        # are removed, and nothing is said about the rest of the network.
+        # Neither free ranges, the network's size nor host history (which
+        # diffs bitmaps) are stored.
         subnet_address = str(network.network_address)
-        
-        # Clear old data for this subnet to avoid duplicates on re-scan
-        tx.run("""
-            MATCH (s:Subnet {address: $subnet_address})
-            OPTIONAL MATCH (s)<-[:BELONGS_TO]-(ip:IP)
-            DETACH DELETE s, ip
-        """, subnet_address=subnet_address)
-
-        # Create Subnet node
-        tx.run("MERGE (s:Subnet {address: $address})", address=subnet_address)
+        live = set(alive)
+        ensure_schema(self.driver)
+        added = removed = 0
+        dropped = []
+        with phase("discovery.store"), self.driver.session() as session:
+            session.execute_write(self._create_subnet, subnet_address)
+            for chunk in chunked((str(addr) for addr in candidates), self.batch_size):
+                existing = existing_subnet_ips(session, subnet_address, chunk)
+                up = [addr for addr in chunk if addr in live]
+                silent = [addr for addr in chunk if addr not in live and addr in existing]
+                added += sum(1 for addr in up if addr not in existing)
+                ingest_ips(session, subnet_address, (ip_row(addr, status="used") for addr in up),
+                           batch_size=self.batch_size)
+                if silent:
+                    delete_ips(session, silent, batch_size=self.batch_size)
+                    removed += len(silent)
+                    dropped.extend(silent)
+        self.stats.add_hosts(subnet_address, added - removed)
+        self.close_ports(self.port_states(dropped), run_id)
+        print(f"Stored {len(live)} live candidate(s) for {network}: {added} new, {removed} gone quiet.")
+        return bool(added or removed)
 
-        # Create IP nodes and relationships
-        for ip in network.hosts():
-            ip_address = str(ip)
-            tx.run("""
-                MATCH (s:Subnet {address: $subnet_address})
-                MERGE (i:IP {address: $ip_address})
-                MERGE (i)-[:BELONGS_TO]->(s)
-            """, subnet_address=subnet_address, ip_address=ip_address)
+    def prepare_subnet(self, network, incremental=False, run_id=None):
+        # Runs once per subnet, before any (possibly sharded) store_liveness calls.
+        subnet_address = str(network.network_address)
+        ensure_schema(self.driver)
+        with self.driver.session() as session:
+            if not incremental:
+                # Clear old data for this subnet to avoid duplicates on re-scan
+                delete_subnet_ips(session, subnet_address, batch_size=self.batch_size)
+                delete_subnet_ranges(session, subnet_address, batch_size=self.batch_size)
+                session.execute_write(self._create_subnet, subnet_address)
+                self.stats.reset_hosts(subnet_address, network.with_prefixlen, host_count(network))
+                return True
 
-if __name__ == '__main__':
-    # *** FIX: Read the IP range from the command-line arguments ***
-    if len(sys.argv) < 2:
-        print("Error: Please provide an IP range as a command-line argument.", file=sys.stderr)
-        sys.exit(1)
-    
-    target_ip_range = sys.argv[1]
-    
-    try:
-        NEO4J_URI = os.getenv("NEO4J_URI")
-        NEO4J_USER = os.getenv("NEO4J_USER")
-        NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+            # Incremental: keep existing IP nodes (and the status/last_seen the
+            # port scanner put on them); only drop ones now outside the range.
+            session.execute_write(self._create_subnet, subnet_address)
+            self.stats.set_total(subnet_address, network.with_prefixlen, host_count(network))
+            removed = [ip for ip in subnet_ip_addresses(session, subnet_address) if ip_address(ip) not in network]
+            if removed:
+                delete_ips(session, removed, batch_size=self.batch_size)
+                self.stats.add_hosts(subnet_address, -len(removed))
+                self.close_ports(self.port_states(removed), run_id)
+                print(f"Removed {len(removed)} IP(s) no longer in {network}.")
+            dropped = delete_subnet_ranges(session, subnet_address, lo=network.num_addresses,
+                                           batch_size=self.batch_size)
+            return bool(removed or dropped)
 
-        if not all([NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD]):
-            raise ValueError("Database environment variables are not fully set in .env file.")
+    def store_liveness(self, liveness, incremental=False, run_id=None):
+        # Live hosts become IP nodes and the free space between them becomes
+        # AddressRange nodes, so the graph grows with live hosts rather than
+        # with the size of the range. liveness may cover one shard of the subnet.
+        # With a run_id, hosts that came up or went down are added to its history.
+        network = liveness.parent
+        subnet_address = str(network.network_address)
+        base = int(network.network_address)
+        lo, hi = liveness.parent_bounds
+        added = removed = 0
+        transactions = 0
+        silent = []
+        with phase("discovery.store"), self.driver.session() as session:
+            for chunk in chunked((str(ip) for ip in liveness), self.batch_size):
+                if incremental:
+                    existing = existing_subnet_ips(session, subnet_address, chunk)
+                    added += sum(1 for ip in chunk if ip not in existing)
+                else:
+                    added += len(chunk)
+                transactions += ingest_ips(session, subnet_address, (ip_row(ip, status="used") for ip in chunk),
+                                           batch_size=self.batch_size)
+
+            stored = subnet_ranges(session, subnet_address, lo, hi)
+            if incremental:
+                # Hosts in this span that stopped answering are free space now.
+                # Stored hosts can only be where the stored free ranges are not,
+                # so only those addresses are looked up: listing the whole
+                # subnet here would cost every shard the full subnet.
+                address = type(network.network_address)
+                unlisted = (str(address(base + offset)) for offset in _outside_ranges(stored, lo, hi))
+                for chunk in chunked((ip for ip in unlisted if ip not in liveness), self.batch_size):
+                    silent.extend(existing_subnet_ips(session, subnet_address, chunk))
+                if silent:
+                    transactions += delete_ips(session, silent, batch_size=self.batch_size)
+                    removed = len(silent)
+
+            # Stored ranges may reach past this span (e.g. written by an
+            # unsharded run); keep their outside parts when replacing them.
+            free = [(row["start_offset"], row["end_offset"]) for row in liveness.range_rows(liveness.free_ranges())]
+            if sorted((max(start, lo), min(end, hi)) for start, end in stored) == free:
+                ranges_changed = False
+            else:
+                ranges_changed = True
+                kept = [(start, lo - 1) for start, _ in stored if start < lo]
+                kept += [(hi + 1, end) for _, end in stored if end > hi]
+                delete_subnet_ranges(session, subnet_address, lo, hi, batch_size=self.batch_size)
+                transactions += ingest_ranges(session, subnet_address,
+                                              (range_row(network, start, end) for start, end in free + kept),
+                                              batch_size=self.batch_size)
+        self.stats.add_hosts(subnet_address, added - removed)
+        # Hosts that went down keep no open ports. A full store has no list of
+        # the hosts it replaced, so it checks the subnet's hosts with open ports.
+        if incremental:
+            down = self.port_states(silent)
+        else:
+            down = [state for state in self.ports.find({"subnet": subnet_address, "open_port_count": {"$gt": 0}})
+                    if lo <= int(ip_address(state["ip_address"])) - base <= hi
+                    and state["ip_address"] not in liveness]
+        self.close_ports(down, run_id)
+        if run_id is not None:
+            with phase("discovery.history"):
+                self.history.record_hosts(run_id, liveness)
+        print(f"Stored {len(liveness)} live IP(s) and {len(free)} free range(s) for {liveness.network} "
+              f"in {transactions} transaction(s).")
+        return bool(added or removed or ranges_changed)
+
+    def port_states(self, ips):
+        # Ports documents that still list open ports, for the given hosts.
+        states = []
+        for chunk in chunked(ips, self.batch_size):
+            states.extend(self.ports.find({"ip_address": {"$in": chunk}, "open_port_count": {"$gt": 0}}))
+        return states
+
+    def close_ports(self, states, run_id=None):
+        # Empties the ports documents of hosts discovery dropped, so the
+        # subnet counters and top hosts stop counting them, and records the
+        # closures in run_id's history.
+        if not states:
+            return
+        bulk_upsert_ports({state["ip_address"]: [] for state in states}, self.ports,
+                          {state["ip_address"]: state.get("subnet") for state in states})
+        self.stats.record_ports((state, state.get("subnet"), []) for state in states)
+        if run_id is not None:
+            self.history.record_ports(run_id, ((state["ip_address"], state.get("subnet"), state, [])
+                                               for state in states))
+        print(f"Closed the open ports of {len(states)} host(s) that went down.")
+
+    @staticmethod
+    def _create_subnet(tx, subnet_address):
+        tx.run("MERGE (s:Subnet {address: $address})", address=subnet_address)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep address ranges and store live hosts in Neo4j.")
+    parser.add_argument("targets", nargs="*", help="CIDRs, first-last ranges or addresses")
+    parser.add_argument("--exclude", action="append", default=[], help="CIDR, range or address to skip")
+    parser.add_argument("--local", action="store_true", help="add every network this host has an address in")
+    parser.add_argument("--hints", action="append", default=[], help="file of IPv6 candidate addresses")
+    parser.add_argument("--neighbours", action="store_true", help="use the IPv6 neighbour cache as candidates")
+    parser.add_argument("--seed", type=int, default=None, help="fixes the randomized probe order")
+    parser.add_argument("--incremental", action="store_true")
+    args = parser.parse_args()
 
-        print(f"Starting subnet discovery for: {target_ip_range}")
-        subnet_discovery = SubnetDiscovery(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
-        subnet_discovery.discover_and_store_subnet(target_ip_range)
-        subnet_discovery.close()
-        print(f"Subnet discovery complete for {target_ip_range}. Data stored in Neo4j.")
+    targets = list(args.targets)
+    if args.local:
+        targets += [network.with_prefixlen for network in local_networks()]
+    if not targets:
+        parser.error("give at least one target or --local")
+    hints = [hint for path in args.hints for hint in read_hints(path)]
+    if args.neighbours:
+        hints += neighbour_addresses()
 
+    try:
+        plan = TargetPlan(targets, args.exclude, hints, seed=args.seed)
+        print(f"Starting subnet discovery for: {', '.join(targets)}")
+        SubnetDiscovery().discover_targets(plan, incremental=args.incremental)
+        print("Subnet discovery complete. Data stored in Neo4j.")
     except Exception as e:
         print(f"An error occurred: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        close_all()
+
+if __name__ == '__main__':
+    main()
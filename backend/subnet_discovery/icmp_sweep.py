@@ -0,0 +1,376 @@
+import asyncio
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from metrics import PROBE_REPLIES, PROBE_SECONDS, PROBE_TIMEOUTS, PROBES_IN_FLIGHT, PROBES_SENT
+from rate_control import AdaptiveRateController, InFlightGate
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+RAW = "raw"
+DGRAM = "dgram"
+
+ARP_CACHE_PATH = "/proc/net/arp"
+ATF_COM = 0x2
+
+# Ports that answer (or RST) on most hosts that drop ICMP.
+DEFAULT_TCP_PROBE_PORTS = (80, 443, 22, 445, 3389)
+
+_HEADER = struct.Struct("!BBHHH")
+_PAYLOAD = struct.Struct("!d")
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+if hasattr(select, "poll"):
+    def _ready(sock, writable, timeout):
+        # poll() has no FD_SETSIZE limit, unlike select() with many sockets open.
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+        return bool(poller.poll(max(0.0, timeout) * 1000))
+else:  # Windows
+    def _ready(sock, writable, timeout):
+        readable, ready, _ = select.select([] if writable else [sock], [sock] if writable else [], [],
+                                           max(0.0, timeout))
+        return bool(readable or ready)
+
+
+def build_echo_request(ident, seq, sent_at):
+    payload = _PAYLOAD.pack(sent_at)
+    header = _HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return _HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+
+def open_icmp_socket():
+    # Raw sockets need root/CAP_NET_RAW. Linux also offers unprivileged ICMP
+    # datagram sockets when the gid is inside net.ipv4.ping_group_range.
+    for mode, sock_type in ((RAW, socket.SOCK_RAW), (DGRAM, socket.SOCK_DGRAM)):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        except (PermissionError, OSError):
+            continue
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        return mode, sock
+    return None, None
+
+
+class ArpCacheProber:
+    # Reads the kernel neighbour table: hosts on the local segment that were
+    # resolved during the sweep are alive even if they ignore ICMP and TCP.
+    def __init__(self, path=ARP_CACHE_PATH):
+        self.path = path
+
+    def probe(self, addresses):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            return set()
+        resolved = set()
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 4 and int(fields[2], 16) & ATF_COM and fields[3] != "00:00:00:00:00:00":
+                resolved.add(fields[0])
+        if not resolved:
+            return set()
+        # addresses may be a lazy walk over a huge range; never build a set of it.
+        return {addr for addr in addresses if addr in resolved}
+
+
+class TcpConnectProber:
+    # A completed connect or a RST both prove the host is up. Timeouts and
+    # the number of connects in flight adapt like the port scanner's.
+    def __init__(self, ports=DEFAULT_TCP_PROBE_PORTS, timeout=1.0, concurrency=512, rate_control=None):
+        self.ports = ports
+        self.concurrency = concurrency
+        self.rate_control = rate_control or AdaptiveRateController(max_window=concurrency, initial_timeout=timeout)
+
+    async def _answers(self, addr, port, gate):
+        loop = asyncio.get_running_loop()
+        timeout = self.rate_control.timeout(addr)
+        sock = socket.socket(socket.AF_INET6 if ":" in addr else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        async with gate:
+            started = time.monotonic()
+            PROBES_SENT.inc(scanner="tcp_ping")
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (addr, port)), timeout)
+                answered = True
+            except asyncio.TimeoutError:
+                answered = False
+            except OSError as e:
+                answered = e.errno in (errno.ECONNREFUSED, errno.ECONNRESET)
+            finally:
+                sock.close()
+        if answered:
+            PROBE_REPLIES.inc(scanner="tcp_ping")
+            PROBE_SECONDS.observe(time.monotonic() - started, scanner="tcp_ping")
+            self.rate_control.on_answer(addr, time.monotonic() - started)
+        else:
+            PROBE_TIMEOUTS.inc(scanner="tcp_ping")
+            self.rate_control.on_timeout(addr)
+        return answered
+
+    async def _probe_all(self, addresses):
+        alive = set()
+        targets = iter(addresses)
+        gate = InFlightGate(self.rate_control, scanner="tcp_ping")
+
+        async def worker():
+            for addr in targets:
+                answers = await asyncio.gather(*(self._answers(addr, port, gate) for port in self.ports))
+                if any(answers):
+                    alive.add(addr)
+
+        # Each worker holds len(ports) sockets at once; idle workers just find
+        # the shared iterator exhausted.
+        workers = max(1, self.concurrency // max(1, len(self.ports)))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return alive
+
+    def probe(self, addresses):
+        return asyncio.run(self._probe_all(addresses))
+
+
+class IcmpSweeper:
+    # rate is a packets-per-second ceiling and timeout the reply wait used
+    # until a subnet has RTT samples; both go to an AdaptiveRateController.
+    # Echo probes are cheap, so the window starts at what the ceiling allows
+    # in one initial timeout and only shrinks when replies get lost.
+    # on_probe(addr, attempt) is called before each address is probed and
+    # on_reply(addr, rtt) for each echo reply; either may raise to abort.
+    def __init__(self, rate=5000, timeout=1.0, retries=1, fallback=None, on_reply=None, rate_control=None,
+                 on_probe=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.fallback = fallback
+        self.on_reply = on_reply
+        self.on_probe = on_probe
+        self.rate_control = rate_control or AdaptiveRateController(
+            max_window=max(1, int(rate * timeout)) if rate else 65536, max_rate=rate, initial_timeout=timeout)
+        self.ident = os.getpid() & 0xFFFF
+        self.mode = None
+
+    def _send(self, sock, addr, seq):
+        packet = build_echo_request(self.ident, seq & 0xFFFF, time.monotonic())
+        while True:
+            try:
+                sock.sendto(packet, (addr, 0))
+                return True
+            except BlockingIOError:
+                _ready(sock, True, self.timeout)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    time.sleep(0.001)
+                    continue
+                # Unreachable network/host: no point waiting for a reply.
+                return False
+
+    def _parse_reply(self, data):
+        if self.mode == RAW:
+            # Raw sockets see every ICMP packet, IP header included.
+            data = data[(data[0] & 0x0F) * 4:]
+        if len(data) < _HEADER.size:
+            return None
+        icmp_type, _, _, ident, _ = _HEADER.unpack_from(data)
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+        # The kernel rewrites the id of datagram sockets and filters replies for us.
+        if self.mode == RAW and ident != self.ident:
+            return None
+        if len(data) >= _HEADER.size + _PAYLOAD.size:
+            return time.monotonic() - _PAYLOAD.unpack_from(data, _HEADER.size)[0]
+        return 0.0
+
+    def _drain(self, sock, accept, in_flight, previous_round, wait):
+        # previous_round is when the last round started, or None in the first.
+        # Returns how many wanted replies arrived.
+        if not _ready(sock, False, wait or 0.0):
+            return 0
+        accepted = 0
+        while True:
+            try:
+                data, (addr, _) = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return accepted
+            except OSError:
+                return accepted
+            rtt = self._parse_reply(data)
+            if rtt is None:
+                continue
+            sent_at = in_flight.pop(addr, None)
+            # A reply slower than the timeout answers an earlier round's probe;
+            # only a quick answer to a retry means the first probe was lost.
+            lost = previous_round is not None and rtt < self.rate_control.timeout(addr)
+            if not accept(addr):
+                continue
+            PROBE_REPLIES.inc(scanner="icmp")
+            PROBE_SECONDS.observe(rtt, scanner="icmp")
+            self.rate_control.on_answer(addr, rtt, retransmit=lost, first_sent=previous_round if lost else sent_at)
+            accepted += 1
+            if self.on_reply:
+                self.on_reply(addr, rtt)
+
+    def _expire(self, in_flight):
+        # Drops probes whose timeout has passed; returns the wait until the next one does.
+        now = time.monotonic()
+        while in_flight:
+            addr, sent_at = next(iter(in_flight.items()))
+            deadline = sent_at + self.rate_control.timeout(addr)
+            if deadline > now:
+                return deadline - now
+            del in_flight[addr]
+            PROBE_TIMEOUTS.inc(scanner="icmp")
+            self.rate_control.on_timeout(addr)
+        return None
+
+    def _sweep_icmp(self, sock, pending, accept):
+        # pending() yields the addresses still unanswered, once per round;
+        # accept(addr) records a reply and says whether it was one we wanted.
+        control = self.rate_control
+        previous_round = None
+        for attempt in range(self.retries + 1):
+            # Probes awaiting a reply, oldest first: address -> send time.
+            in_flight = OrderedDict()
+            round_started = time.monotonic()
+            for seq, addr in enumerate(self._announced(pending(), attempt)):
+                # Collect replies (in any order) while waiting for room in the
+                # window, then for the next send slot under the rate ceiling.
+                while len(in_flight) >= control.limit:
+                    self._drain(sock, accept, in_flight, previous_round, self._expire(in_flight))
+                send_at = time.monotonic() + control.reserve()
+                self._drain(sock, accept, in_flight, previous_round, send_at - time.monotonic())
+                while time.monotonic() < send_at:
+                    self._drain(sock, accept, in_flight, previous_round, send_at - time.monotonic())
+                if self._send(sock, addr, seq):
+                    PROBES_SENT.inc(scanner="icmp")
+                    in_flight[addr] = time.monotonic()
+                    PROBES_IN_FLIGHT.set(len(in_flight), scanner="icmp")
+            while in_flight:
+                self._drain(sock, accept, in_flight, previous_round, self._expire(in_flight))
+                PROBES_IN_FLIGHT.set(len(in_flight), scanner="icmp")
+            previous_round = round_started
+
+    def _announced(self, addresses, attempt):
+        # Passes addresses through, reporting each to on_probe as it is taken.
+        for addr in addresses:
+            if self.on_probe:
+                self.on_probe(addr, attempt)
+            yield addr
+
+    def _open(self):
+        self.mode, sock = open_icmp_socket()
+        if sock is not None:
+            fallback = self.fallback if self.fallback is not None else [ArpCacheProber()]
+        else:
+            fallback = self.fallback if self.fallback is not None else [TcpConnectProber(timeout=self.timeout),
+                                                                       ArpCacheProber()]
+        return sock, fallback
+
+    def sweep(self, addresses):
+        addresses = [str(addr) for addr in addresses]
+        pending = {addr for addr in addresses if ":" not in addr}
+        alive = set()
+
+        def accept(addr):
+            if addr not in pending:
+                return False
+            pending.discard(addr)
+            alive.add(addr)
+            return True
+
+        sock, fallback = self._open()
+        if sock is not None:
+            try:
+                self._sweep_icmp(sock, lambda: [addr for addr in addresses if addr in pending], accept)
+            finally:
+                sock.close()
+
+        # Hosts the echo rounds already probed only count as retries.
+        attempt = self.retries + 1 if sock is not None else 0
+        for prober in fallback:
+            remaining = [addr for addr in addresses if addr not in alive]
+            if not remaining:
+                break
+            alive |= prober.probe(self._announced(remaining, attempt))
+            attempt += 1
+        return alive
+
+    def sweep_targets(self, targets):
+        # Sweeps a TargetPlan: re-iterable, supports `in` and lists its `versions`.
+        # Each round walks it again, skipping hosts already found, so only
+        # live hosts are ever held in memory.
+        alive = set()
+
+        def accept(addr):
+            if addr in alive or addr not in targets:
+                return False
+            alive.add(addr)
+            return True
+
+        def pending(version=4):
+            return (addr for addr in map(str, targets) if addr not in alive and (":" in addr) == (version == 6))
+
+        # Every pass walks the whole plan, so passes for a version it has no addresses of are skipped.
+        if 4 in targets.versions:
+            sock, fallback = self._open()
+            if sock is not None:
+                try:
+                    self._sweep_icmp(sock, pending, accept)
+                finally:
+                    sock.close()
+            attempt = self.retries + 1 if sock is not None else 0
+            for prober in fallback:
+                alive |= prober.probe(self._announced(pending(), attempt))
+                attempt += 1
+        if 6 in targets.versions:
+            # Echo sweeps are IPv4-only here; IPv6 targets are found by connect probes.
+            alive |= TcpConnectProber(timeout=self.timeout).probe(self._announced(pending(6), 0))
+        return alive
+
+    def sweep_network(self, liveness):
+        # Sweeps every host of a LivenessSet's range and marks the live ones in
+        # it. Targets are walked lazily from the bitmap each round, so memory
+        # stays flat however large the range is.
+        def pending():
+            return (str(addr) for addr in liveness.free_addresses())
+
+        if liveness.network.version == 6:
+            # Echo sweeps are IPv4-only here; IPv6 hosts are found by connect probes.
+            self.mode, sock = None, None
+            fallback = self.fallback if self.fallback is not None else [TcpConnectProber(timeout=self.timeout)]
+        else:
+            sock, fallback = self._open()
+        if sock is not None:
+            try:
+                self._sweep_icmp(sock, pending, liveness.add)
+            finally:
+                sock.close()
+
+        attempt = self.retries + 1 if sock is not None else 0
+        for prober in fallback:
+            if not liveness.free_count:
+                break
+            liveness.update(prober.probe(self._announced(pending(), attempt)))
+            attempt += 1
+        return liveness
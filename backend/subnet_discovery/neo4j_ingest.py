@@ -0,0 +1,207 @@
+import os
+import sys
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from metrics import DB_SECONDS
+
+DEFAULT_BATCH_SIZE = 5000
+
+SCHEMA_STATEMENTS = [
+    "CREATE CONSTRAINT ip_address IF NOT EXISTS FOR (i:IP) REQUIRE i.address IS UNIQUE",
+    "CREATE CONSTRAINT subnet_address IF NOT EXISTS FOR (s:Subnet) REQUIRE s.address IS UNIQUE",
+    "CREATE CONSTRAINT subnet_cidr IF NOT EXISTS FOR (s:Subnet) REQUIRE s.cidr IS UNIQUE",
+    "CREATE CONSTRAINT host_name IF NOT EXISTS FOR (h:Host) REQUIRE h.name IS UNIQUE",
+    "CREATE CONSTRAINT interface_name IF NOT EXISTS FOR (i:Interface) REQUIRE i.name IS UNIQUE",
+    "CREATE CONSTRAINT meta_name IF NOT EXISTS FOR (m:Meta) REQUIRE m.name IS UNIQUE",
+    "CREATE INDEX address_range_offset IF NOT EXISTS FOR (r:AddressRange) ON (r.start_offset)",
+    "CREATE INDEX address_range_start IF NOT EXISTS FOR (r:AddressRange) ON (r.start)",
+]
+
+# Subnet nodes are keyed by `address` in subnet_discovery and by `cidr` in the
+# scripts variant. Property keys can't be Cypher parameters, so only these two
+# are ever interpolated into a query.
+SUBNET_KEYS = ("address", "cidr")
+
+IP_ROWS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (s:Subnet {%s: $subnet})
+    MERGE (ip:IP {address: row.address})
+    SET ip += row.props
+    MERGE (ip)-[:BELONGS_TO]->(s)
+"""
+
+HOST_ROWS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (s:Subnet {%s: $subnet})
+    MERGE (h:Host {name: row.host})
+    MERGE (i:Interface {name: row.interface})
+    SET i.type = row.type
+    MERGE (h)-[:HAS_INTERFACE]->(i)
+    MERGE (ip:IP {address: row.address})
+    SET ip += row.props
+    MERGE (i)-[:HAS_IP]->(ip)
+    MERGE (ip)-[:BELONGS_TO]->(s)
+"""
+
+DELETE_SUBNET_IPS_QUERY = """
+    MATCH (s:Subnet {%s: $subnet})<-[:BELONGS_TO]-(ip:IP)
+    WITH ip LIMIT $limit
+    DETACH DELETE ip
+    RETURN count(*) AS deleted
+"""
+
+SUBNET_IPS_QUERY = """
+    MATCH (s:Subnet {%s: $subnet})<-[:BELONGS_TO]-(ip:IP)
+    RETURN ip.address AS address
+"""
+
+EXISTING_IPS_QUERY = """
+    UNWIND $rows AS address
+    MATCH (s:Subnet {%s: $subnet})<-[:BELONGS_TO]-(ip:IP {address: address})
+    RETURN ip.address AS address
+"""
+
+DELETE_IPS_QUERY = """
+    UNWIND $rows AS address
+    MATCH (ip:IP {address: address})
+    DETACH DELETE ip
+"""
+
+# Free address space is stored as AddressRange nodes (inclusive offsets from
+# the subnet's network address) rather than one IP node per unused address.
+RANGE_ROWS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (s:Subnet {%s: $subnet})
+    CREATE (r:AddressRange)
+    SET r = row
+    CREATE (r)-[:BELONGS_TO]->(s)
+"""
+
+SUBNET_RANGES_QUERY = """
+    MATCH (s:Subnet {%s: $subnet})<-[:BELONGS_TO]-(r:AddressRange)
+    WHERE r.start_offset <= $hi AND r.end_offset >= $lo
+    RETURN r.start_offset AS start, r.end_offset AS end
+"""
+
+DELETE_SUBNET_RANGES_QUERY = """
+    MATCH (s:Subnet {%s: $subnet})<-[:BELONGS_TO]-(r:AddressRange)
+    WHERE r.start_offset <= $hi AND r.end_offset >= $lo
+    WITH r LIMIT $limit
+    DETACH DELETE r
+    RETURN count(*) AS deleted
+"""
+
+# Largest offset a range can have; used as the open end of a span.
+MAX_OFFSET = 2 ** 63 - 1
+
+_schema_ready = set()
+
+
+def ensure_schema(driver):
+    # Constraints double as the indexes MERGE needs; only run them once per driver.
+    if id(driver) in _schema_ready:
+        return
+    with driver.session() as session:
+        for statement in SCHEMA_STATEMENTS:
+            session.run(statement).consume()
+    _schema_ready.add(id(driver))
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _subnet_query(query, subnet_key):
+    if subnet_key not in SUBNET_KEYS:
+        raise ValueError(f"Unsupported subnet key: {subnet_key}")
+    return query % subnet_key
+
+
+def _run_rows(tx, query, rows, params):
+    tx.run(query, rows=rows, **params).consume()
+
+
+def write_rows(session, query, rows, batch_size=DEFAULT_BATCH_SIZE, operation="write_rows", **params):
+    # One transaction per chunk keeps each commit bounded in memory on the server.
+    transactions = 0
+    for chunk in chunked(rows, batch_size):
+        with DB_SECONDS.time(db="neo4j", operation=operation):
+            session.execute_write(_run_rows, query, chunk, params)
+        transactions += 1
+    return transactions
+
+
+def ip_row(address, **props):
+    return {"address": address, "props": props}
+
+
+def host_row(address, host, interface, interface_type, **props):
+    return {"address": address, "host": host, "interface": interface,
+            "type": interface_type, "props": props}
+
+
+def ingest_ips(session, subnet, rows, subnet_key="address", batch_size=DEFAULT_BATCH_SIZE):
+    query = _subnet_query(IP_ROWS_QUERY, subnet_key)
+    return write_rows(session, query, rows, batch_size, "ingest_ips", subnet=subnet)
+
+
+def ingest_hosts(session, subnet, rows, subnet_key="cidr", batch_size=DEFAULT_BATCH_SIZE):
+    query = _subnet_query(HOST_ROWS_QUERY, subnet_key)
+    return write_rows(session, query, rows, batch_size, "ingest_hosts", subnet=subnet)
+
+
+def delete_subnet_ips(session, subnet, subnet_key="address", batch_size=DEFAULT_BATCH_SIZE):
+    query = _subnet_query(DELETE_SUBNET_IPS_QUERY, subnet_key)
+    deleted = 0
+    while True:
+        with DB_SECONDS.time(db="neo4j", operation="delete_subnet_ips"):
+            count = session.execute_write(
+                lambda tx: tx.run(query, subnet=subnet, limit=batch_size).single()["deleted"])
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def subnet_ip_addresses(session, subnet, subnet_key="address"):
+    query = _subnet_query(SUBNET_IPS_QUERY, subnet_key)
+    return {record["address"] for record in session.run(query, subnet=subnet)}
+
+
+def existing_subnet_ips(session, subnet, addresses, subnet_key="address"):
+    # Index lookups for just these addresses, instead of listing the whole subnet.
+    query = _subnet_query(EXISTING_IPS_QUERY, subnet_key)
+    return {record["address"] for record in session.run(query, rows=list(addresses), subnet=subnet)}
+
+
+def delete_ips(session, addresses, batch_size=DEFAULT_BATCH_SIZE):
+    return write_rows(session, DELETE_IPS_QUERY, addresses, batch_size, "delete_ips")
+
+
+def ingest_ranges(session, subnet, rows, subnet_key="address", batch_size=DEFAULT_BATCH_SIZE):
+    query = _subnet_query(RANGE_ROWS_QUERY, subnet_key)
+    return write_rows(session, query, rows, batch_size, "ingest_ranges", subnet=subnet)
+
+
+def subnet_ranges(session, subnet, lo=0, hi=MAX_OFFSET, subnet_key="address"):
+    # (start, end) offsets of the stored ranges that overlap [lo, hi].
+    query = _subnet_query(SUBNET_RANGES_QUERY, subnet_key)
+    return [(record["start"], record["end"]) for record in session.run(query, subnet=subnet, lo=lo, hi=hi)]
+
+
+def delete_subnet_ranges(session, subnet, lo=0, hi=MAX_OFFSET, subnet_key="address",
+                         batch_size=DEFAULT_BATCH_SIZE):
+    query = _subnet_query(DELETE_SUBNET_RANGES_QUERY, subnet_key)
+    deleted = 0
+    while True:
+        with DB_SECONDS.time(db="neo4j", operation="delete_subnet_ranges"):
+            count = session.execute_write(
+                lambda tx: tx.run(query, subnet=subnet, lo=lo, hi=hi, limit=batch_size).single()["deleted"])
+        deleted += count
+        if count < batch_size:
+            return deleted
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The components import each other as flat modules from sibling folders, so
+# the tests put those folders on the path the same way the scripts do.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("common", "port_scanner", "subnet_discovery", "api"):
+    sys.path.insert(0, os.path.join(BACKEND_DIR, folder))
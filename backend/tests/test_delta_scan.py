@@ -0,0 +1,50 @@
+from delta_scan import DEFAULT_HOST_TTL, DEFAULT_OPEN_PORT_TTL, plan_probes, port_set_signature
+
+PORTS = [22, 80, 443]
+NOW = 1_000_000.0
+
+
+def state(checked_ago, verified_ago, open_ports=(), ports=PORTS):
+    return {"port_set": port_set_signature(ports), "checked_at": NOW - checked_ago,
+            "verified_at": NOW - verified_ago, "open_ports": [{"port": port} for port in open_ports]}
+
+
+def test_unknown_host_gets_every_port():
+    plan, full = plan_probes(["10.0.0.1"], PORTS, {}, NOW)
+    assert plan == {"10.0.0.1": PORTS}
+    assert full == {"10.0.0.1"}
+
+
+def test_fresh_host_is_left_out():
+    states = {"10.0.0.1": state(60, 60, open_ports=[22])}
+    assert plan_probes(["10.0.0.1"], PORTS, states, NOW) == ({}, set())
+
+
+def test_stale_open_ports_are_reverified_alone():
+    states = {"10.0.0.1": state(60, DEFAULT_OPEN_PORT_TTL, open_ports=[22, 443])}
+    plan, full = plan_probes(["10.0.0.1"], PORTS, states, NOW)
+    assert plan == {"10.0.0.1": [22, 443]}
+    assert full == set()
+
+
+def test_host_without_open_ports_waits_for_host_ttl():
+    states = {"10.0.0.1": state(DEFAULT_HOST_TTL - 1, DEFAULT_HOST_TTL - 1)}
+    assert plan_probes(["10.0.0.1"], PORTS, states, NOW) == ({}, set())
+
+
+def test_expired_host_gets_a_full_probe():
+    states = {"10.0.0.1": state(DEFAULT_HOST_TTL, 60, open_ports=[22])}
+    plan, full = plan_probes(["10.0.0.1"], PORTS, states, NOW)
+    assert plan == {"10.0.0.1": PORTS}
+    assert full == {"10.0.0.1"}
+
+
+def test_changed_port_list_invalidates_closed_results():
+    states = {"10.0.0.1": state(60, 60, ports=[22, 80])}
+    plan, full = plan_probes(["10.0.0.1"], PORTS, states, NOW)
+    assert plan == {"10.0.0.1": PORTS}
+    assert full == {"10.0.0.1"}
+
+
+def test_signature_ignores_order_and_duplicates():
+    assert port_set_signature([443, 22, 80, 22]) == port_set_signature(PORTS)
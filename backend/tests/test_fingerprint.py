@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+from delta_scan import fingerprint_changed
+from fingerprint import SIGNATURES, SignatureIndex
+
+
+@pytest.fixture(scope="module")
+def index():
+    return SignatureIndex()
+
+
+@pytest.mark.parametrize("banner, service, fields", [
+    (b"SSH-2.0-OpenSSH_9.6p1 Ubuntu-3ubuntu13\r\n", "SSH", {"info": "2.0", "product": "OpenSSH", "version": "9.6p1"}),
+    (b"SSH-2.0-dropbear_2022.83\r\n", "SSH", {"info": "2.0", "product": "dropbear", "version": "2022.83"}),
+    (b"SSH-2.0-libssh-0.9.6\r\n", "SSH", {"info": "2.0", "product": "libssh", "version": "0.9.6"}),
+    (b"220 mail.example.com ESMTP Postfix\r\n", "SMTP", {"info": "mail.example.com", "product": "Postfix"}),
+    (b"220 (vsFTPd 3.0.5)\r\n", "FTP", {"product": "vsFTPd", "version": "3.0.5"}),
+    (b"HTTP/1.1 200 OK\r\nServer: nginx\r\n", "HTTP", {"info": "1.1"}),
+    (b"RFB 003.008\n", "VNC", {"version": "003.008"}),
+    (b"J\x00\x00\x00\x0a8.0.36\x00rest", "MySQL", {"version": "8.0.36"}),
+    (b"\xff\xfd\x18", "Telnet", {}),
+])
+def test_known_banners(index, banner, service, fields):
+    assert index.match(banner) == (service, fields)
+
+
+def test_unknown_banner(index):
+    assert index.match(b"hello there") is None
+
+
+def test_earlier_signature_wins_within_a_prefix(index):
+    # Both SMTP signatures match; the more specific one comes first.
+    assert index.match(b"220 mx ESMTP Exim 4.97\r\n")[1]["product"] == "Exim"
+
+
+def test_index_agrees_with_trying_every_signature(index):
+    banners = [b"SSH-2.0-OpenSSH_8.9", b"220 ftp.example.com FTP server ready", b"220 mx SMTP",
+               b"+OK Dovecot ready.", b"* OK [CAPABILITY IMAP4rev1] Dovecot ready.", b"-ERR unknown command 'HEAD'",
+               b"HTTP/1.0 404 Not Found", b"nothing"]
+    for banner in banners:
+        expected = None
+        for service, _, pattern in SIGNATURES:
+            found = re.compile(pattern, re.DOTALL).match(banner)
+            if found:
+                expected = service, {key: value.decode() for key, value in found.groupdict().items() if value}
+                break
+        assert index.match(banner) == expected, banner
+
+
+def port(service="SSH", product="OpenSSH", version="9.6", banner="SSH-2.0-OpenSSH_9.6", cert=None, cipher=None):
+    tls = {"cert_sha256": cert, "cipher": cipher} if cert or cipher else None
+    return {"port": 22, "service": service,
+            "fingerprint": {"product": product, "version": version, "banner": banner, "tls": tls}}
+
+
+def test_fingerprint_changes_on_stable_fields_only():
+    state = {"open_ports": [port(cert="aa", cipher="TLS_AES_128_GCM_SHA256")]}
+    assert not fingerprint_changed(state, [port(banner="SSH-2.0-OpenSSH_9.6 other", cert="aa",
+                                                cipher="TLS_AES_256_GCM_SHA384")])
+    assert fingerprint_changed(state, [port(version="9.7", cert="aa")])
+    assert fingerprint_changed(state, [port(cert="bb")])
+    assert fingerprint_changed(state, [port(service="HTTP", cert="aa")])
+
+
+def test_first_fingerprint_is_a_change():
+    assert fingerprint_changed({"open_ports": [{"port": 22, "service": "SSH"}]}, [port()])
+    # A run without fingerprinting never reports one.
+    assert not fingerprint_changed({"open_ports": [port()]}, [{"port": 22, "service": "SSH"}])
@@ -0,0 +1,91 @@
+from ipaddress import ip_address, ip_network
+
+import pytest
+
+from liveness import LivenessSet, host_bounds, host_count
+
+
+@pytest.mark.parametrize("cidr", ["10.0.0.0/24", "10.0.0.0/30", "10.0.0.0/31", "10.0.0.7/32", "2001:db8::/120",
+                                  "2001:db8::/127"])
+def test_host_bounds_match_hosts(cidr):
+    network = ip_network(cidr)
+    hosts = list(network.hosts()) or [network.network_address]
+    first, last = host_bounds(network)
+    base = int(network.network_address)
+    assert (base + first, base + last) == (int(hosts[0]), int(hosts[-1]))
+    assert host_count(cidr) == len(hosts)
+
+
+def test_offsets_and_membership():
+    liveness = LivenessSet("10.0.0.0/24")
+    assert liveness.offset("10.0.0.9") == 9
+    assert liveness.offset("10.0.1.0") is None
+    assert liveness.address(9) == ip_address("10.0.0.9")
+    assert liveness.add("10.0.0.9")
+    assert not liveness.add("10.0.0.9")
+    # Network and broadcast addresses aren't hosts.
+    assert not liveness.add("10.0.0.0")
+    assert not liveness.add("10.0.0.255")
+    assert "10.0.0.9" in liveness
+    assert "10.0.0.10" not in liveness
+    assert len(liveness) == 1
+    assert liveness.free_count == 253
+
+
+def test_free_and_live_ranges():
+    liveness = LivenessSet("10.0.0.0/24")
+    liveness.update(["10.0.0.1", "10.0.0.5", "10.0.0.6", "10.0.0.7", "10.0.0.200"])
+    assert list(liveness.free_ranges()) == [(2, 4), (8, 199), (201, 254)]
+    assert list(liveness.live_ranges()) == [(1, 1), (5, 7), (200, 200)]
+    assert [str(ip) for ip in liveness] == ["10.0.0.1", "10.0.0.5", "10.0.0.6", "10.0.0.7", "10.0.0.200"]
+    free = list(liveness.free_offsets())
+    assert len(free) == liveness.free_count
+    assert free[:3] == [2, 3, 4]
+    assert not set(free) & set(liveness.live_offsets())
+
+
+def test_empty_and_full():
+    empty = LivenessSet("10.0.0.0/29")
+    assert list(empty.free_ranges()) == [(1, 6)]
+    full = LivenessSet("10.0.0.0/29")
+    full.update(str(ip) for ip in ip_network("10.0.0.0/29").hosts())
+    assert list(full.free_ranges()) == []
+    assert full.free_count == 0
+
+
+def test_shard_offsets_are_relative_to_parent():
+    parent = ip_network("10.0.0.0/16")
+    first = LivenessSet("10.0.0.0/24", parent)
+    middle = LivenessSet("10.0.5.0/24", parent)
+    last = LivenessSet("10.0.255.0/24", parent)
+    # Only the parent's network and broadcast addresses are excluded.
+    assert (first.first, first.last) == (1, 255)
+    assert (middle.first, middle.last) == (0, 255)
+    assert (last.first, last.last) == (0, 254)
+    assert middle.parent_bounds == (5 * 256, 5 * 256 + 255)
+    middle.add("10.0.5.10")
+    rows = list(middle.range_rows(middle.free_ranges()))
+    assert [(row["start_offset"], row["end_offset"]) for row in rows] == [(1280, 1289), (1291, 1535)]
+    assert (rows[0]["start"], rows[0]["end"], rows[0]["size"]) == ("10.0.5.0", "10.0.5.9", 10)
+
+
+def test_changed_offsets():
+    before = LivenessSet("10.0.0.0/24")
+    before.update(["10.0.0.1", "10.0.0.2"])
+    after = LivenessSet("10.0.0.0/24")
+    after.update(["10.0.0.2", "10.0.0.3"])
+    assert sorted(after.changed_offsets(before.to_bytes())) == [(1, False), (3, True)]
+    # No earlier bitmap: every live host is a change.
+    assert sorted(after.changed_offsets(b"")) == [(2, True), (3, True)]
+
+
+def test_ipv6_offsets():
+    liveness = LivenessSet("2001:db8::/120")
+    assert liveness.add("2001:db8::ff")
+    assert liveness.offset("2001:db8::ff") == 255
+    assert list(liveness.free_ranges()) == [(1, 254)]
+
+
+def test_too_large_for_a_bitmap():
+    with pytest.raises(ValueError):
+        LivenessSet("2001:db8::/64")
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+
+from scan_history import CLOSED, DOWN, OPENED, SERVICE, UP, ScanHistory, fold_events, port_events
+
+# Recent enough for the retention TTL index, which mongomock enforces.
+T0 = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0) - timedelta(days=1)
+
+
+def at(minutes):
+    return T0 + timedelta(minutes=minutes)
+
+
+@pytest.fixture
+def history():
+    # Reads only: the runs and buckets are inserted directly.
+    history = ScanHistory(mongomock.MongoClient().db)
+    history.runs.insert_many([
+        {"_id": "r1", "subnets": ["10.0.0.0"], "started_at": at(0), "finished_at": at(10)},
+        {"_id": "r2", "subnets": ["10.0.0.0"], "started_at": at(20), "finished_at": at(30)},
+    ])
+    buckets = {
+        "10.0.0.1": [{"e": UP, "t": at(5), "r": "r1"}, {"e": DOWN, "t": at(25), "r": "r2"}],
+        "10.0.0.2": [{"e": OPENED, "p": 22, "s": "SSH", "t": at(21), "r": "r2"},
+                     {"e": CLOSED, "p": 22, "t": at(22), "r": "r2"},
+                     {"e": OPENED, "p": 80, "s": "HTTP", "t": at(23), "r": "r2"}],
+        "10.0.0.3": [{"e": UP, "t": at(25), "r": "r2"}],
+        "10.0.0.4": [{"e": SERVICE, "p": 443, "s": "HTTPS", "t": at(26), "r": "r2"}],
+        "10.0.1.1": [{"e": UP, "t": at(25), "r": "r3"}],
+    }
+    history.history.insert_many([
+        {"ip": ip, "subnet": "10.0.1.0" if ip.startswith("10.0.1.") else "10.0.0.0", "events": events,
+         "n": len(events), "first": events[0]["t"], "last": events[-1]["t"]}
+        for ip, events in buckets.items()])
+    return history
+
+
+def test_diff_reports_net_changes_since_the_earlier_run(history):
+    diff = history.diff("r1", "r2")
+    assert diff["hosts_up"] == ["10.0.0.3"]
+    assert diff["hosts_down"] == ["10.0.0.1"]
+    assert [(row["ip"], row["port"], row["service"]) for row in diff["ports_opened"]] == [("10.0.0.2", 80, "HTTP")]
+    # 22 opened and closed again within the window.
+    assert diff["ports_closed"] == []
+    assert [(row["ip"], row["port"]) for row in diff["services_changed"]] == [("10.0.0.4", 443)]
+    assert (diff["from"]["run_id"], diff["to"]["run_id"]) == ("r1", "r2")
+
+
+def test_diff_is_symmetric_in_argument_order(history):
+    diff = history.diff("r1", "r2")
+    assert diff is not None
+    assert history.diff("r2", "r1") == diff
+
+
+def test_diff_of_unknown_run(history):
+    assert history.diff("r1", "missing") is None
+
+
+def test_timeline_filters(history):
+    assert [row["event"] for row in history.timeline("10.0.0.2")] == [OPENED, CLOSED, OPENED]
+    assert [row["port"] for row in history.timeline("10.0.0.2", port=80)] == [80]
+    since = at(22).replace(tzinfo=timezone.utc).timestamp()
+    assert [row["event"] for row in history.timeline("10.0.0.2", since=since)] == [CLOSED, OPENED]
+
+
+def test_port_events():
+    before = {"open_ports": [{"port": 22, "service": "SSH"}, {"port": 80, "service": "HTTP"}]}
+    after = [{"port": 80, "service": "nginx"}, {"port": 443, "service": "HTTPS"}]
+    assert port_events(before, after) == [{"e": OPENED, "p": 443, "s": "HTTPS"}, {"e": CLOSED, "p": 22},
+                                          {"e": SERVICE, "p": 80, "s": "nginx"}]
+    assert port_events(None, []) == []
+
+
+def test_fold_events_keeps_only_net_changes():
+    events = [{"e": UP}, {"e": DOWN}, {"e": UP}, {"e": OPENED, "p": 22}, {"e": CLOSED, "p": 22},
+              {"e": SERVICE, "p": 80, "s": "a"}, {"e": SERVICE, "p": 80, "s": "b"}]
+    assert fold_events(events) == [{"e": UP}, {"e": SERVICE, "p": 80, "s": "b"}]
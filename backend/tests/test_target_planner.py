@@ -0,0 +1,96 @@
+from ipaddress import ip_address, ip_network
+
+import pytest
+
+from target_planner import TargetPlan, merge_intervals, parse_target, subtract_intervals
+
+TARGETS = ["10.0.0.0/24", "10.0.1.10-10.0.1.40", "10.0.0.200", "192.168.5.7", "2001:db8::/120"]
+
+
+def test_parse_target():
+    assert parse_target("10.0.0.0/30") == (4, int(ip_address("10.0.0.1")), int(ip_address("10.0.0.2")))
+    assert parse_target("10.0.0.0/30", hosts_only=False)[1:] == (int(ip_address("10.0.0.0")),
+                                                                  int(ip_address("10.0.0.3")))
+    assert parse_target(" 10.0.0.9 ") == (4, int(ip_address("10.0.0.9")), int(ip_address("10.0.0.9")))
+    with pytest.raises(ValueError):
+        parse_target("10.0.0.9-10.0.0.1")
+    with pytest.raises(ValueError):
+        parse_target("10.0.0.1-::1")
+
+
+def test_merge_and_subtract():
+    assert merge_intervals([(4, 5, 9), (4, 1, 4), (6, 1, 2), (4, 20, 30)]) == [(4, 1, 9), (4, 20, 30), (6, 1, 2)]
+    assert subtract_intervals([(4, 1, 30)], [(4, 5, 9), (4, 20, 40)]) == [(4, 1, 4), (4, 10, 19)]
+
+
+@pytest.mark.parametrize("seed", [1, 2, 12345])
+def test_shuffle_is_a_bijection(seed):
+    plan = TargetPlan(TARGETS, seed=seed)
+    ordered = list(TargetPlan(TARGETS, shuffle=False))
+    shuffled = list(plan)
+    assert len(shuffled) == len(plan) == len(ordered) == len(set(shuffled))
+    assert set(shuffled) == set(ordered)
+    assert shuffled != ordered
+    # Same seed, same order on every pass.
+    assert list(plan) == shuffled
+
+
+def test_exclusions():
+    plan = TargetPlan(["10.0.0.0/24"], exclude=["10.0.0.0/25", "10.0.0.200"], shuffle=False)
+    addresses = list(plan)
+    assert len(plan) == 126
+    assert addresses[0] == ip_address("10.0.0.128") and addresses[-1] == ip_address("10.0.0.254")
+    assert "10.0.0.200" not in plan and "10.0.0.5" not in plan and "10.0.0.201" in plan
+
+
+def test_empty_plan():
+    plan = TargetPlan(["10.0.0.0/24"], exclude=["10.0.0.0/24"])
+    assert len(plan) == 0 and list(plan) == [] and plan.versions == set()
+
+
+def test_site_of_matches_linear_scan():
+    plan = TargetPlan(TARGETS + ["10.0.0.0/16", "172.16.0.0/30"])
+    probes = ["10.0.0.1", "10.0.200.1", "10.1.0.1", "10.0.1.20", "192.168.5.7", "192.168.5.8",
+              "172.16.0.2", "172.16.0.4", "2001:db8::5", "2001:db8::1:0", "0.0.0.1", "::1"]
+    for probe in probes:
+        address = ip_address(probe)
+        expected = next((site for site in plan.sites if site.version == address.version and address in site), None)
+        assert plan.site_of(probe) == expected
+    # 10.0.0.0/24 is nested inside the /16 and not kept as a site of its own.
+    assert plan.site_of("10.0.0.1") == ip_network("10.0.0.0/16")
+    assert plan.site_of("::1") is None
+
+
+def test_sites_of_ranges():
+    plan = TargetPlan(["10.0.1.250-10.0.2.5", "192.168.5.7"])
+    assert plan.sites == [ip_network("10.0.1.0/24"), ip_network("10.0.2.0/24"), ip_network("192.168.5.0/24")]
+
+
+def test_covers():
+    plan = TargetPlan(["10.0.0.0/24", "10.0.1.10-10.0.1.40"], exclude=["10.0.0.77"])
+    assert not plan.covers(ip_network("10.0.0.0/24"))
+    assert not plan.covers(ip_network("10.0.1.0/24"))
+    assert TargetPlan(["10.0.0.0/24"]).covers(ip_network("10.0.0.0/24"))
+    assert TargetPlan(["10.0.0.0/23"]).covers(ip_network("10.0.1.0/24"))
+    # The network and broadcast addresses aren't hosts, so ranges missing them still cover.
+    assert TargetPlan(["10.0.0.1-10.0.0.254"]).covers(ip_network("10.0.0.0/24"))
+
+
+def test_versions_and_sparse_ranges():
+    assert TargetPlan(["10.0.0.0/24"]).versions == {4}
+    assert TargetPlan(["2001:db8::/120"]).versions == {6}
+    assert TargetPlan(TARGETS).versions == {4, 6}
+    plan = TargetPlan(["2001:db8::/64"], hints=["2001:db8::5", "2001:db9::5"])
+    assert plan.sparse and len(plan) == 1 and list(plan) == [ip_address("2001:db8::5")]
+    assert plan.is_sparse(ip_network("2001:db8::/64"))
+    assert not TargetPlan(["2001:db8::/64"]).versions
+
+
+def test_blocks_and_addresses_in():
+    plan = TargetPlan(["10.0.1.10-10.0.1.40"])
+    site = ip_network("10.0.1.0/24")
+    blocks = list(plan.blocks(site))
+    assert sum(block.num_addresses for block in blocks) == 31
+    assert [str(a) for a in plan.addresses_in(site)] == [f"10.0.1.{i}" for i in range(10, 41)]
+    with pytest.raises(ValueError):
+        list(TargetPlan(["2001:db8::/120"]).blocks(ip_network("2001:db8::/64")))
@@ -0,0 +1,94 @@
+import ipaddress
+import json
+import struct
+from array import array
+
+import pytest
+
+from topology_layout import BINARY_FORMAT_VERSION, BINARY_MAGIC, LayoutQuery, TopologyLayout, render_layout
+
+TYPECODES = {"float32": "f", "uint32": "I", "uint16": "H", "uint8": "B"}
+
+MEMBERSHIPS = [
+    ("10.0.0.0", "10.0.0.10", "used"),
+    ("10.0.0.0", "10.0.0.2", "used"),
+    ("10.0.0.0", "10.0.0.3", None),
+    ("192.168.1.0", "192.168.1.5", "used"),
+    ("172.16.0.0", None, None),
+]
+
+
+def parse_binary(body):
+    assert body[:4] == BINARY_MAGIC
+    version, header_length = struct.unpack_from("<II", body, 4)
+    assert version == BINARY_FORMAT_VERSION
+    data_start = 12 + header_length
+    assert data_start % 8 == 0
+    header = json.loads(body[12:data_start])
+    columns = {}
+    for column in header["columns"]:
+        assert column["offset"] % 8 == 0
+        values = array(TYPECODES[column["type"]])
+        start = data_start + column["offset"]
+        values.frombytes(body[start:start + column["length"] * values.itemsize])
+        # Little-endian on the wire.
+        if struct.pack("=H", 1) != struct.pack("<H", 1):
+            values.byteswap()
+        columns[column["name"]] = values
+    return header, columns
+
+
+def layout(memberships=MEMBERSHIPS):
+    return TopologyLayout(7, memberships, open_ports={"10.0.0.3": 2, "192.168.1.5": 1},
+                          subnet_info={"10.0.0.0": {"cidr": "10.0.0.0/24", "total_ips": 254}})
+
+
+@pytest.mark.parametrize("view", ["subnets", "hosts", "open"])
+def test_binary_matches_json(view):
+    topology = layout()
+    query = LayoutQuery(view, fmt="binary")
+    header, columns = parse_binary(render_layout(topology, query))
+    expected = json.loads(render_layout(topology, LayoutQuery(view)))
+    assert header["subnet_ids"] == expected["subnet_ids"]
+    for name, values in columns.items():
+        if name == "hosts.address":
+            continue
+        if values.typecode == "f":
+            assert [round(value, 1) for value in values] == expected[name]
+        else:
+            assert values.tolist() == expected[name]
+
+
+def test_layout_order_and_counts():
+    topology = layout()
+    assert topology.subnet_ids == ["10.0.0.0", "172.16.0.0", "192.168.1.0"]
+    # Hosts with open ports first, then by address (not string order).
+    assert topology.host_ids[:3] == ["10.0.0.3", "10.0.0.2", "10.0.0.10"]
+    assert list(topology.subnet_hosts) == [3, 0, 1]
+    assert list(topology.subnet_open) == [1, 0, 1]
+    subnets, hosts = topology.select(LayoutQuery("open", subnets=["10.0.0.0/24"]))
+    assert (subnets, [topology.host_ids[j] for j in hosts]) == ([0], ["10.0.0.3"])
+
+
+def test_ipv4_addresses_are_four_bytes():
+    header, columns = parse_binary(render_layout(layout(), LayoutQuery("hosts", fmt="binary")))
+    assert header["ip_width"] == 4
+    packed = columns["hosts.address"].tobytes()
+    addresses = [str(ipaddress.IPv4Address(packed[i:i + 4])) for i in range(0, len(packed), 4)]
+    assert addresses == ["10.0.0.3", "10.0.0.2", "10.0.0.10", "192.168.1.5"]
+
+
+def test_mixed_views_use_sixteen_byte_addresses():
+    memberships = MEMBERSHIPS + [("2001:db8::", "2001:db8::5", "used")]
+    header, columns = parse_binary(render_layout(layout(memberships), LayoutQuery("hosts", fmt="binary")))
+    assert header["ip_width"] == 16
+    packed = columns["hosts.address"].tobytes()
+    addresses = [ipaddress.IPv6Address(packed[i:i + 16]) for i in range(0, len(packed), 16)]
+    assert [str(address.ipv4_mapped or address) for address in addresses] == [
+        "10.0.0.3", "10.0.0.2", "10.0.0.10", "192.168.1.5", "2001:db8::5"]
+
+
+def test_empty_topology():
+    header, columns = parse_binary(render_layout(TopologyLayout(1, []), LayoutQuery("hosts", fmt="binary")))
+    assert header["subnet_ids"] == []
+    assert all(len(values) == 0 for values in columns.values())
@@ -5,9 +5,26 @@ import Button from './Button';
 const IPScanForm = ({ onScanStart, onScanComplete, isScanning }) => {
   const [ipRange, setIpRange] = useState('192.168.1.1/24');
   const [error, setError] = useState('');
+  const [progress, setProgress] = useState(null);
 
   const API_BASE_URL = 'http://127.0.0.1:5000/api';
 
+  const waitForScan = (jobId) => new Promise((resolve, reject) => {
+    const events = new EventSource(`${API_BASE_URL}/scans/${jobId}/events`);
+    events.onmessage = (event) => {
+      const job = JSON.parse(event.data);
+      setProgress(job.progress);
+      if (!['queued', 'running'].includes(job.status)) {
+        events.close();
+        resolve(job);
+      }
+    };
+    events.onerror = () => {
+      events.close();
+      reject(new Error('Lost connection to the scan progress stream.'));
+    };
+  });
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (!/^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\/\d{1,2}$/.test(ipRange)) {
@@ -15,6 +32,7 @@ const IPScanForm = ({ onScanStart, onScanComplete, isScanning }) => {
         return;
     }
     setError('');
+    setProgress(null);
     onScanStart();
 
     try {
@@ -28,7 +46,14 @@ const IPScanForm = ({ onScanStart, onScanComplete, isScanning }) => {
         const errData = await scanResponse.json().catch(() => ({ error: `Scan failed with status: ${scanResponse.status}` }));
         throw new Error(errData.error || `Scan failed with status: ${scanResponse.status}`);
       }
-      
+
+      // The scan runs as a background job; follow its progress stream until it finishes.
+      const { job_id: jobId } = await scanResponse.json();
+      const job = await waitForScan(jobId);
+      if (job.status !== 'completed') {
+        throw new Error(job.error || `Scan ${job.status}.`);
+      }
+
       const dataResponse = await fetch(`${API_BASE_URL}/topology-data`);
       if (!dataResponse.ok) {
           throw new Error(`Fetching data failed with status: ${dataResponse.status}`);
@@ -71,6 +96,11 @@ const IPScanForm = ({ onScanStart, onScanComplete, isScanning }) => {
           ) : 'Scan Network'}
         </Button>
       </div>
+      {isScanning && progress && (
+        <p className="text-gray-600 text-sm mt-2">
+          Probed {progress.hosts_probed}/{progress.hosts_total} hosts, {progress.hosts_up} up, {progress.ports_found} open ports
+        </p>
+      )}
       {error && <p className="text-red-500 text-sm mt-2">{error}</p>}
     </form>
   );